@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+'''
+Baseflow separation of the daily flow records of all gauges at once.
+
+Baseflow functions
+==================
+
+    - lyne_hollick:   Lyne-Hollick recursive digital filter (multiple passes).
+    - eckhardt:       Eckhardt two-parameter recursive digital filter.
+    - baseflow_index: Baseflow / total flow per water year.
+    - run:            Separate every local flow record and write baseflow_index.csv.
+    - main:           Command-line entry point.
+
+The daily discharge of all gauges is stacked into one (day x gauge) array
+(discharge.stack_daily). The filters step through time once; every step
+updates all gauges and all parameter sets together, so the only Python
+loop is over days, however many gauges and parameters are run. Parameters
+are given as lists and every combination is computed in the same pass.
+
+Missing days break a record: the filter output is NaN on the missing day
+and restarts from the first valid day after it (baseflow = discharge).
+Baseflow is kept between 0 and the discharge.
+
+The baseflow index of a water year (Oct - Sep, or a season of it) is the
+sum of baseflow over the sum of discharge on the days that have both. Years
+with less than ``min_valid`` of their days are NaN. It is written to
+data/baseflow_index.csv, next to winter_q.csv, with one row per filter,
+parameter set and water year and one column per gauge.
+
+Examples
+--------
+
+    >>> run(filters={'lyne_hollick': {'alpha': [0.9, 0.925, 0.95]},
+    ...              'eckhardt': {'alpha': [0.98], 'bfi_max': [0.5, 0.8]}})
+
+    From the notebooks folder:
+
+        $ python baseflow.py --water-years 2002 2013 --months 10 11 12 1 2 3
+
+'''
+
+import argparse
+import glob
+import itertools
+import os
+
+import numpy as np
+import pandas as pd
+
+import cache
+import discharge
+from nwis import FLOW_DIR, read_flow
+
+BFI_CSV = os.path.join(cache.DATA_DIR, 'baseflow_index.csv')
+# filter -> parameter -> values; every combination is computed
+FILTERS = {'lyne_hollick': {'alpha': [0.925]},
+           'eckhardt': {'alpha': [0.98], 'bfi_max': [0.5, 0.8]}}
+
+
+def _columns(values, n):
+    '''Parameter values as a column vector broadcasting against (n gauges).'''
+    return np.asarray(values, dtype='float64').reshape(-1, 1) * np.ones((1, n))
+
+
+def _lyne_hollick_pass(q, alpha):
+    '''One forward pass over q (day x set x gauge); returns baseflow.'''
+    quick = np.zeros(q.shape[1:])
+    base = np.full(q.shape, np.nan)
+    previous = np.full(q.shape[1:], np.nan)
+    for t in range(q.shape[0]):
+        qt = q[t]
+        valid = ~np.isnan(qt)
+        restart = valid & np.isnan(previous)
+        with np.errstate(invalid='ignore'):
+            step = alpha * quick + (1 + alpha) / 2 * (qt - previous)
+        step = np.where(restart, 0.0, step)
+        step = np.clip(step, 0.0, np.where(valid, qt, 0.0))
+        quick = np.where(valid, step, 0.0)
+        base[t] = np.where(valid, qt - quick, np.nan)
+        previous = qt
+    return base
+
+
+def lyne_hollick(q, alpha=(0.925,), passes=3):
+    '''
+    Function to separate baseflow with the Lyne-Hollick filter,
+    qf[t] = alpha qf[t-1] + (1 + alpha) / 2 (Q[t] - Q[t-1]), applied forward,
+    backward and forward again (``passes``), each pass on the baseflow of
+    the previous one.
+
+    Parameters:
+        - q: (day x gauge) array of daily discharge, NaN where missing.
+        - alpha: filter parameters, one per parameter set.
+        - passes: number of alternating passes.
+
+    Returns:
+        - baseflow: (set x day x gauge) array.
+    '''
+    alpha = _columns(alpha, q.shape[1])
+    base = np.repeat(q[:, None, :], alpha.shape[0], axis=1)
+    for i in range(passes):
+        if i % 2:
+            base = _lyne_hollick_pass(base[::-1], alpha)[::-1]
+        else:
+            base = _lyne_hollick_pass(base, alpha)
+    return np.ascontiguousarray(base.transpose(1, 0, 2))
+
+
+def eckhardt(q, alpha=(0.98,), bfi_max=(0.8,)):
+    '''
+    Function to separate baseflow with the Eckhardt filter,
+    b[t] = ((1 - BFImax) alpha b[t-1] + (1 - alpha) BFImax Q[t]) / (1 - alpha BFImax).
+
+    Parameters:
+        - q: (day x gauge) array of daily discharge, NaN where missing.
+        - alpha, bfi_max: recession constant and maximum baseflow index,
+          one per parameter set (equal lengths).
+
+    Returns:
+        - baseflow: (set x day x gauge) array.
+    '''
+    if len(alpha) != len(bfi_max):
+        raise ValueError('alpha and bfi_max need one value per parameter set')
+    a = _columns(alpha, q.shape[1])
+    m = _columns(bfi_max, q.shape[1])
+    base = np.full((q.shape[0],) + a.shape, np.nan)
+    b = np.full(a.shape, np.nan)
+    for t in range(q.shape[0]):
+        qt = np.broadcast_to(q[t], a.shape)
+        valid = ~np.isnan(qt)
+        step = ((1 - m) * a * b + (1 - a) * m * qt) / (1 - a * m)
+        step = np.where(np.isnan(b), qt, step)
+        b = np.where(valid, np.minimum(step, qt), np.nan)
+        base[t] = b
+    return np.ascontiguousarray(base.transpose(1, 0, 2))
+
+
+def baseflow_index(dates, q, baseflow, water_years, months=None, min_valid=0.9):
+    '''
+    Function to compute the baseflow index of every water year.
+
+    Parameters:
+        - dates: DatetimeIndex of the days.
+        - q: (day x gauge) discharge.
+        - baseflow: (set x day x gauge) baseflow.
+        - water_years: water years to report.
+        - months: calendar months to include (default: the whole year).
+        - min_valid: fraction of the days a year needs.
+
+    Returns:
+        - bfi: (set x water year x gauge) array.
+    '''
+    wy = np.where(dates.month >= 10, dates.year + 1, dates.year)
+    keep = np.isin(dates.month, months) if months is not None else np.ones(len(dates), bool)
+    bfi = np.full((baseflow.shape[0], len(water_years), q.shape[1]), np.nan)
+    for i, year in enumerate(water_years):
+        days = keep & (wy == year)
+        if not days.any():
+            continue
+        b, total = baseflow[:, days], q[days][None]
+        valid = ~np.isnan(b) & ~np.isnan(total)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            value = np.where(valid, b, 0).sum(axis=1) / np.where(valid, total, 0).sum(axis=1)
+        value[valid.mean(axis=1) < min_valid] = np.nan
+        bfi[:, i] = value
+    return bfi
+
+
+def _parameter_sets(params):
+    names = sorted(params)
+    return names, [dict(zip(names, v)) for v in itertools.product(*(params[n] for n in names))]
+
+
+def _label(name, params):
+    return name + ' ' + ' '.join('%s=%g' % (k, params[k]) for k in sorted(params))
+
+
+def run(water_years=(2002, 2013), filters=FILTERS, months=None, min_valid=0.9, sites=None,
+        folder=FLOW_DIR, output=BFI_CSV):
+    '''
+    Function to separate baseflow of the local flow records and write the
+    baseflow index per water year.
+
+    Parameters:
+        - water_years: first and last water year (inclusive).
+        - filters: dict filter -> parameter -> list of values (see FILTERS).
+        - months: calendar months to include (default: the whole water year).
+        - min_valid: fraction of valid days a water year needs.
+        - sites: gauge ids (default: every flow file in ``folder``).
+        - folder: folder of the daily flow files.
+        - output: CSV to write, or None.
+
+    Returns:
+        - bfi: DataFrame indexed by (filter, water year), one column per gauge.
+    '''
+    if sites is None:
+        sites = sorted(os.path.splitext(os.path.basename(p))[0]
+                       for p in glob.glob(os.path.join(folder, '*.csv')))
+    years = list(range(water_years[0], water_years[1] + 1))
+    flows = dict((s, read_flow(s, folder)) for s in sites)
+    dates, gauges, q = discharge.stack_daily(flows, '%d-10-01' % (years[0] - 1),
+                                             '%d-09-30' % years[-1])
+    parts = []
+    for name in sorted(filters):
+        names, sets = _parameter_sets(filters[name])
+        if name == 'lyne_hollick':
+            base = lyne_hollick(q, [p['alpha'] for p in sets])
+        elif name == 'eckhardt':
+            base = eckhardt(q, [p['alpha'] for p in sets], [p['bfi_max'] for p in sets])
+        else:
+            raise ValueError('Unknown filter %r, expected lyne_hollick or eckhardt' % name)
+        bfi = baseflow_index(dates, q, base, years, months, min_valid)
+        for params, values in zip(sets, bfi):
+            index = pd.MultiIndex.from_product([[_label(name, params)], years],
+                                               names=['filter', 'water_year'])
+            parts.append(pd.DataFrame(values, index=index, columns=gauges))
+    table = pd.concat(parts)
+    if output is not None:
+        with cache.atomic_write(output) as tmp:
+            table.to_csv(tmp)
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Baseflow index per water year of all gauges.')
+    parser.add_argument('--water-years', nargs=2, type=int, default=[2002, 2013],
+                        metavar=('FIRST', 'LAST'), help='water year range (default 2002 2013)')
+    parser.add_argument('--months', nargs='+', type=int,
+                        help='calendar months to include (default: the whole water year)')
+    parser.add_argument('--lyne-hollick', nargs='+', type=float, metavar='ALPHA',
+                        default=FILTERS['lyne_hollick']['alpha'])
+    parser.add_argument('--eckhardt-alpha', nargs='+', type=float,
+                        default=FILTERS['eckhardt']['alpha'])
+    parser.add_argument('--bfi-max', nargs='+', type=float,
+                        default=FILTERS['eckhardt']['bfi_max'])
+    parser.add_argument('--min-valid', type=float, default=0.9,
+                        help='fraction of valid days a water year needs')
+    parser.add_argument('--output', default=BFI_CSV)
+    args = parser.parse_args(argv)
+    filters = {'lyne_hollick': {'alpha': args.lyne_hollick},
+               'eckhardt': {'alpha': args.eckhardt_alpha, 'bfi_max': args.bfi_max}}
+    run(args.water_years, filters, args.months, args.min_valid, output=args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+'''
+Basin summary of Table S2 (basin_selection_and_summary.ipynb): mean canopy
+cover, precipitation, temperature and elevation, dominant land cover and
+lithology, area and gauge location of every basin, in one pass over the
+covariate rasters.
+
+Basin summary functions
+=======================
+
+    - COVARIATES: Raster columns of the table: file, statistic and rounding.
+    - summarise:  Raster statistics, area and gauge location of many basins.
+    - lithology:  Dominant lithology of the basins (geology intersect table).
+    - table_s2:   The whole of Table S2 (data/Table S2.csv).
+    - main:       Command-line entry point.
+
+Rasters on the same grid form a group. Every basin is rasterized once per
+group (pixel centres inside the polygon, as the clip of the notebook), and
+the window of the basin is read from every raster of the group in the same
+visit. All statistics are taken from those pixels: the mean of the valid
+pixels, or the most frequent value (the lowest one on ties, like
+scipy.stats.mode). Nodata pixels are ignored. The land cover mode therefore
+counts only the basin's pixels, not the padding of the clipped window.
+
+Basins are cut into spatially compact chunks (shards.make_shards), so the
+windows of a chunk are close together. Chunks run in worker processes, and
+each worker opens every raster once per chunk. The cost grows with the
+number of basins, not with the size of the statewide rasters.
+
+Area and gauge latitude / longitude come from the site registry
+(registry.py). For basins outside the registry (e.g. GAGES-II boundaries
+passed as ``zones``, in a projected CRS), the area is that of the polygon
+and the gauge location is missing.
+
+Examples
+--------
+
+    >>> table = table_s2(pipeline.STUDY_SITES + ['0'], workers=4)
+    >>> stats = summarise(shards.read_boundaries(staids).index,
+    ...                   zones=shards.read_boundaries(staids), workers=16)
+
+    From the notebooks folder:
+
+        $ python basinsummary.py --output "../data/Table S2.csv"
+
+'''
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import cache
+import registry
+
+TABLE_S2 = os.path.join(cache.DATA_DIR, 'Table S2.csv')
+# column, raster (under data/), statistic ('mean' or 'mode'), decimals (0: truncated to int)
+COVARIATES = (
+    ('Basin Mean Canopy Cover (%)', 'CAL_canopy_utm.tif', 'mean', 0),
+    ('Basin Mean Annual Precipitation (mm)', 'PRISM_800m_30yr_PPT_UTM.tif', 'mean', 0),
+    ('Basin Mean Annual Temperature (deg. C)', 'PRISM_800m_30yr_TMEAN_UTM.tif', 'mean', 1),
+    ('Basin Mean Elevation (m)', 'Cal90mDEM_UTM.tif', 'mean', 0),
+    ('Dominant Land Cover', os.path.join('landcover', 'cal_landcover_utm10N.tif'), 'mode', None),
+)
+LANDCOVER_LEGEND = os.path.join(cache.DATA_DIR, 'USGS_LANDCOVER_LEGEND.csv')
+GEOLOGY = os.path.join(cache.DATA_DIR, 'StudyBasins_CalGeol_ArcGIS-Intersect.csv')
+GEOLOGY_UNITS = os.path.join(cache.DATA_DIR, 'CAunits.csv')
+# names of Table S2 that differ from the station names of the registry
+NAMES = {registry.DRY_CREEK: 'Dry Creek (ERCZO)'}
+
+
+def _statistic(values, statistic):
+    if not len(values):
+        return np.nan
+    if statistic == 'mean':
+        return values.mean()
+    classes, counts = np.unique(values, return_counts=True)
+    return classes[np.argmax(counts)]
+
+
+def _summarise(job):
+    '''
+    Worker: statistics of a chunk of basins. Each grid group is
+    (raster paths, statistics, basin polygons as WKB on that grid).
+    '''
+    import rasterio
+    from shapely import wkb
+    import zonal
+    ids, groups = job
+    out = []
+    for paths, statistics, shapes in groups:
+        values = np.full((len(ids), len(paths)), np.nan)
+        sources = [rasterio.open(p) for p in paths]
+        try:
+            grid = sources[0]
+            for i, (site, shape) in enumerate(zip(ids, shapes)):
+                weights = zonal.ZoneWeights.build([wkb.loads(shape)], grid.transform, grid.shape,
+                                                  [site], method='centers')
+                pixels = weights.matrix.indices
+                if not len(pixels):
+                    continue
+                for j, (src, statistic) in enumerate(zip(sources, statistics)):
+                    window, valid = weights.read(src.name, src=src)
+                    keep = pixels[valid[pixels]]
+                    values[i, j] = _statistic(window[keep], statistic)
+        finally:
+            for src in sources:
+                src.close()
+        out.append(values)
+    return out
+
+
+def _round(values, decimals):
+    if decimals is None:
+        return values
+    if decimals:
+        return values.round(decimals)
+    values = np.trunc(values)
+    return values.astype(int) if values.notnull().all() else values
+
+
+def summarise(sites, covariates=COVARIATES, data_dir=cache.DATA_DIR, zones=None, workers=None,
+              chunk=64, legend=LANDCOVER_LEGEND):
+    '''
+    Function to compute the raster statistics, area and gauge location of
+    basins.
+
+    Parameters:
+        - sites: basin ids.
+        - covariates: (column, raster, statistic, decimals) of every raster
+          column (see COVARIATES); rasters are relative to ``data_dir``.
+        - data_dir: folder of the rasters.
+        - zones: GeoDataFrame of basin polygons indexed by id (default: the
+          registry polygons of ``sites``).
+        - workers: number of worker processes (default: all cores).
+        - chunk: number of basins per worker task.
+        - legend: land cover legend CSV (Class, Short Description) used to
+          name 'mode' columns; None keeps the class codes.
+
+    Returns:
+        - table: DataFrame indexed by site id with Name, the covariate
+          columns, Basin area (km^2), Gage Latitude and Gage Longitude.
+    '''
+    import rasterio
+    import shards
+    known = registry.load()
+    sites = [str(s) for s in sites]
+    if zones is None:
+        zones = known.geodataframe(sites)
+        zones.index = sites
+    else:
+        zones = zones.loc[sites]
+    # rasters on the same grid share one rasterization of every basin
+    groups, crs = {}, {}
+    for k, (column, path, statistic, _) in enumerate(covariates):
+        with rasterio.open(os.path.join(data_dir, path)) as src:
+            t = src.transform
+            grid = ((t.a, t.b, t.c, t.d, t.e, t.f), src.shape, str(src.crs))
+            crs[grid] = src.crs.to_dict() if src.crs else None
+        groups.setdefault(grid, []).append(k)
+    projected = {}
+    for grid in groups:
+        projected[grid] = zones.geometry.to_crs(crs[grid]) if crs[grid] else zones.geometry
+    jobs, order = [], []
+    for part in shards.make_shards(zones, chunk):
+        ids = list(part.index)
+        parts = []
+        for grid, members in groups.items():
+            shapes = [g.wkb for g in projected[grid].loc[ids]]
+            parts.append(([os.path.join(data_dir, covariates[k][1]) for k in members],
+                          [covariates[k][2] for k in members], shapes))
+        jobs.append((ids, parts))
+        order.extend(ids)
+    values = np.full((len(order), len(covariates)), np.nan)
+    if groups:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            row = 0
+            for result in pool.map(_summarise, jobs):
+                n = len(result[0])
+                for members, part in zip(groups.values(), result):
+                    values[row:row + n, members] = part
+                row += n
+    stats = pd.DataFrame(values, index=order,
+                         columns=[c[0] for c in covariates]).reindex(sites)
+
+    table = pd.DataFrame(index=pd.Index(sites, name='id'))
+    table['Name'] = [NAMES.get(registry.canonical_id(s), known[s].name) if s in known else ''
+                     for s in sites]
+    names = None
+    if legend is not None:
+        legend = pd.read_csv(legend)
+        names = dict(zip(legend.Class, legend['Short Description']))
+    for column, _, statistic, decimals in covariates:
+        table[column] = _round(stats[column], decimals)
+        if statistic == 'mode' and names is not None:
+            table[column] = [names.get(int(v)) if v == v else None for v in stats[column]]
+    polygon_area = zones.geometry.area.values / 1e6
+    area = [known[s].reported_area_km2 if s in known else a for s, a in zip(sites, polygon_area)]
+    table['Basin area (km^2)'] = _round(pd.Series(area, index=table.index), 0)
+    table['Gage Latitude'] = [known[s].gauge_lat if s in known else np.nan for s in sites]
+    table['Gage Longitude'] = [known[s].gauge_lon if s in known else np.nan for s in sites]
+    return table
+
+
+def lithology(sites, geology=GEOLOGY, units=GEOLOGY_UNITS):
+    '''
+    Function to find the dominant (largest area) lithology of basins from
+    the basin / geologic map intersect table.
+
+    Returns:
+        - lithology: Series of unit descriptions indexed by site id.
+    '''
+    import overlay
+    table = pd.read_csv(geology)
+    table['SITE_NO'] = [registry.canonical_id(s) for s in table.SITE_NO]
+    dominant = overlay.dominant_class(table, 'SITE_NO', 'Shape_Area')
+    merged = pd.merge(dominant, pd.read_csv(units), how='inner', on='UNIT_LINK')
+    descriptions = merged.set_index('SITE_NO').UNITDESC
+    return pd.Series([descriptions.get(registry.canonical_id(s)) for s in sites],
+                     index=[str(s) for s in sites])
+
+
+def table_s2(sites, output=None, workers=None, data_dir=cache.DATA_DIR, previous=None,
+             covariates=COVARIATES):
+    '''
+    Function to build Table S2 in the layout of data/Table S2.csv: id,
+    Limiter, Name, the raster columns, area, gauge location, SITE_NO and
+    the dominant lithology (UNITDESC).
+
+    The Limiter of every basin is assigned from the sensitivity results, not
+    computed here; it is carried over from the previous table, as are the
+    Name (edited by hand in places) and the row order. New basins have an
+    empty Limiter and the registry name (see NAMES).
+
+    Parameters:
+        - sites: basin ids, e.g. 11475560 or '0' for Dry Creek.
+        - output: CSV file to write, or None.
+        - workers: number of worker processes.
+        - data_dir: folder of the rasters and tables.
+        - previous: earlier Table S2 file (default: ``output`` if it exists).
+        - covariates: raster columns (see COVARIATES); () leaves them out.
+
+    Returns:
+        - table: DataFrame.
+    '''
+    previous = output if previous is None else previous
+    limiter, names = {}, {}
+    sites = [str(s) for s in sites]
+    if previous is not None and os.path.exists(previous):
+        old = pd.read_csv(previous, index_col=0, dtype={'id': str})
+        if 'Limiter' in old.columns:
+            limiter = dict((registry.canonical_id(i), v) for i, v in zip(old.id, old.Limiter))
+        if 'Name' in old.columns:
+            names = dict((registry.canonical_id(i), v) for i, v in zip(old.id, old.Name))
+        rank = dict((registry.canonical_id(i), k) for k, i in enumerate(old.id))
+        sites = sorted(sites, key=lambda s: rank.get(registry.canonical_id(s), len(rank)))
+    table = summarise(sites, covariates, data_dir=data_dir, workers=workers)
+    table['Name'] = [names.get(registry.canonical_id(s), n) for s, n in zip(sites, table.Name)]
+    table.insert(0, 'Limiter', [limiter.get(registry.canonical_id(s)) for s in sites])
+    table.insert(0, 'id', sites)
+    table['SITE_NO'] = sites
+    table['UNITDESC'] = lithology(sites).values
+    table = table.reset_index(drop=True)
+    if output is not None:
+        with cache.atomic_write(output) as tmp:
+            table.to_csv(tmp)
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Basin summary table (Table S2).')
+    parser.add_argument('--sites', nargs='+', help='basin ids (default: the site registry)')
+    parser.add_argument('--workers', type=int, help='worker processes (default: all cores)')
+    parser.add_argument('--output', default=TABLE_S2)
+    args = parser.parse_args(argv)
+    table_s2(args.sites or registry.load().ids, args.output, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+'''
+Content-hash cache helpers shared by the data processing modules.
+
+Cache functions
+===============
+
+    - file_digest:  Digest of a file's contents (shapefile sidecars included).
+    - input_hash:   Combined digest of input files and parameters.
+    - cache_path:   Location of a cache entry under ../data/cache.
+    - atomic_write: Write to a temporary file and move it into place.
+
+Cached products live under ``data/cache`` and can be deleted at any time;
+they are rebuilt from the source files on the next read.
+
+'''
+
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+
+DATA_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         '..', 'data'))
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+
+# Files that travel with a shapefile and change its content
+_SHAPEFILE_SIDECARS = ('.shx', '.dbf', '.prj', '.cpg')
+
+# digests of files already hashed in this session, keyed by path and stat
+_digests = {}
+
+
+def _companions(path):
+    '''
+    Return the list of files whose contents define ``path``. For a shapefile
+    this is the .shp plus its sidecar files, otherwise just the file itself.
+    '''
+    root, ext = os.path.splitext(path)
+    if ext.lower() != '.shp':
+        return [path]
+    return [path] + [root + s for s in _SHAPEFILE_SIDECARS if os.path.exists(root + s)]
+
+
+def file_digest(path, blocksize=1 << 20):
+    '''
+    Function to compute a sha1 digest of a file's contents.
+
+    Parameters:
+        - path: file name. Shapefiles are hashed together with their sidecars.
+        - blocksize: number of bytes read per chunk.
+
+    Returns:
+        - digest: hexadecimal sha1 digest.
+    '''
+    files = _companions(path)
+    stamp = tuple((f, os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in files)
+    if stamp in _digests:
+        return _digests[stamp]
+    h = hashlib.sha1()
+    for f in files:
+        with open(f, 'rb') as fh:
+            for block in iter(lambda: fh.read(blocksize), b''):
+                h.update(block)
+    _digests[stamp] = h.hexdigest()
+    return _digests[stamp]
+
+
+def input_hash(paths=(), **params):
+    '''
+    Function to compute a single digest from a set of input files and
+    keyword parameters. Parameters must be JSON serialisable.
+
+    Parameters:
+        - paths: iterable of file names (order does not matter).
+        - params: keyword parameters that influence the cached product.
+
+    Returns:
+        - digest: hexadecimal sha1 digest.
+    '''
+    h = hashlib.sha1()
+    for path in sorted(paths):
+        h.update(os.path.basename(path).encode())
+        h.update(file_digest(path).encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def cache_path(namespace, key, ext=''):
+    '''
+    Return the path of cache entry ``key`` in ``namespace``, creating the
+    namespace directory if needed.
+    '''
+    folder = os.path.join(CACHE_DIR, namespace)
+    if not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, key + ext)
+
+
+@contextlib.contextmanager
+def atomic_write(path):
+    '''
+    Context manager yielding a temporary file name next to ``path``. The
+    temporary file replaces ``path`` only when the block exits cleanly, so
+    readers never observe a partially written file.
+
+    Examples
+    --------
+
+        >>> with atomic_write('../data/flow_data/11475560.csv') as tmp:
+        ...     df.to_csv(tmp)
+    '''
+    folder = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix='.' + os.path.basename(path), suffix='.tmp')
+    os.close(fd)
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+'''
+Batched, cached extraction of daily climate series (e.g. PRISM tmax/tmin)
+for all study sites, with interchangeable data backends.
+
+Climate functions
+=================
+
+    - extract:            Daily (day x site) tables of several variables.
+    - EarthEngineBackend: Google Earth Engine image collections.
+    - RasterBackend:      Daily rasters on local disk.
+    - OfflineBackend:     Stand-in serving existing site tables, no network.
+    - hargreaves_pet:     Daily Hargreaves PET of all sites from tmin/tmax tables.
+
+``extract`` splits the request into calendar years and looks up every
+(dataset, variable, year, site set) in the disk cache under
+data/cache/climate. The years that are missing are fetched from the backend
+in as few calls as possible: one call covers all variables, all sites and a
+contiguous run of missing years. The backend batches further as its service
+requires. Years that are not over yet are not cached.
+
+A backend is any object with a ``key`` string (identifying the source and
+how sites are sampled) and a method
+
+    fetch(dataset, variables, start, end, sites) -> {variable: DataFrame}
+
+returning (day x site) tables for the days from ``start`` to ``end``.
+
+Examples
+--------
+
+    >>> sites = gp.read_file('../data/sites.shp').set_index('gauge_id')
+    >>> temps = extract(sites, ['tmax', 'tmin'], '2000-01-01', '2017-12-31',
+    ...                 EarthEngineBackend())
+    >>> tmax = temps['tmax']
+
+'''
+
+import glob
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import cache
+import evaplib as evap
+import instrument
+import meteolib as meteo
+import zonal
+from tablecache import read_table
+
+PRISM_DAILY = 'OREGONSTATE/PRISM/AN81d'
+PRISM_DIR = os.path.join(cache.DATA_DIR, 'prism_daily')
+# variable and date of a daily PRISM file, e.g. PRISM_tmax_stable_4kmD2_20000101_bil.bil,
+# or of the zip archive it is distributed in (PRISM_tmax_stable_4kmD2_20000101_bil.zip)
+PRISM_PATTERN = r'PRISM_(?P<variable>[a-z]+)_.*_(?P<date>\d{8})_bil\.(bil|tif|zip)$'
+# latitude used for extraterrestrial radiation in the Hargreaves PET
+PET_LATITUDE = 39.666
+TABLES = {'tmax': os.path.join(cache.DATA_DIR, 'tmax_prism.csv'),
+          'tmin': os.path.join(cache.DATA_DIR, 'tmin_prism.csv')}
+
+
+def _days(start, end):
+    return pd.date_range(pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize(),
+                         freq='D')
+
+
+def _site_key(sites):
+    '''Digest of the site identifiers and geometries.'''
+    h = hashlib.sha1()
+    for i, geom in zip(sites.index, sites.geometry):
+        h.update(str(i).encode())
+        h.update(geom.wkb)
+    return h.hexdigest()
+
+
+class EarthEngineBackend(object):
+    '''
+    Extraction from an Earth Engine image collection with ``reduceRegions``.
+    All sites and variables of a date chunk go into a single request; chunks
+    are sized to stay below the service's feature limit and are requested
+    concurrently.
+
+    Parameters:
+        - reducer: name of an ``ee.Reducer`` (``first`` samples one pixel).
+        - centroid: sample at basin centroids (as the original extraction
+          did) instead of over the basin polygons.
+        - scale: nominal scale [m] of the reduction (default: native).
+        - max_features: maximum features returned by one request.
+        - workers: number of concurrent requests.
+    '''
+
+    def __init__(self, reducer='first', centroid=True, scale=None, max_features=5000,
+                 workers=4):
+        import ee
+        self.ee = ee
+        ee.Initialize()
+        self.reducer = reducer
+        self.centroid = centroid
+        self.scale = scale
+        self.max_features = max_features
+        self.workers = workers
+        self.key = 'earthengine:%s:%s:%s' % (reducer, 'centroid' if centroid else 'polygon', scale)
+
+    def _features(self, sites):
+        ee = self.ee
+        sites = sites.to_crs(epsg=4326) if sites.crs is not None else sites
+        features = []
+        for i, geom in zip(sites.index, sites.geometry):
+            if self.centroid:
+                g = ee.Geometry.Point([geom.centroid.x, geom.centroid.y])
+            else:
+                g = ee.Geometry(geom.__geo_interface__)
+            features.append(ee.Feature(g, {'gauge_id': str(i)}))
+        return ee.FeatureCollection(features)
+
+    def _request(self, dataset, variables, begin, end, features):
+        '''One getInfo call: all sites and variables from begin to end.'''
+        ee = self.ee
+        collection = ee.ImageCollection(dataset).select(variables).filterDate(
+            begin.strftime('%Y-%m-%d'), (end + pd.Timedelta(days=1)).strftime('%Y-%m-%d'))
+        reducer = getattr(ee.Reducer, self.reducer)()
+        output = reducer.getOutputs().getInfo()[0]
+
+        def reduce(image):
+            date = image.date().format('YYYY-MM-dd')
+            values = image.reduceRegions(features, reducer, self.scale)
+            return values.map(lambda f: f.set('date', date))
+
+        info = collection.map(reduce).flatten().getInfo()
+        rows = []
+        for feat in info['features']:
+            props = feat['properties']
+            row = {'date': props['date'], 'gauge_id': props['gauge_id']}
+            for v in variables:
+                # single-band images name the output after the reducer
+                row[v] = props.get(v, props.get(output) if len(variables) == 1 else None)
+            rows.append(row)
+        return rows
+
+    def fetch(self, dataset, variables, start, end, sites):
+        days = _days(start, end)
+        features = self._features(sites)
+        per_call = max(1, self.max_features // max(1, len(sites)))
+        chunks = [(days[i], days[min(i + per_call, len(days)) - 1])
+                  for i in range(0, len(days), per_call)]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            parts = pool.map(lambda c: self._request(dataset, variables, c[0], c[1], features),
+                             chunks)
+            rows = [row for part in parts for row in part]
+        df = pd.DataFrame(rows, columns=['date', 'gauge_id'] + list(variables))
+        df['date'] = pd.to_datetime(df['date'])
+        ids = [str(i) for i in sites.index]
+        out = {}
+        for v in variables:
+            table = df.pivot_table(index='date', columns='gauge_id', values=v, aggfunc='first')
+            out[v] = table.reindex(index=days, columns=ids).astype('float64')
+        return out
+
+
+class RasterBackend(object):
+    '''
+    Extraction from daily rasters on local disk (e.g. PRISM daily BIL files,
+    zipped or not), averaged over each site's geometry with zonal weights; a
+    point geometry samples the pixel containing it. The basin weights are
+    built once per grid and every day is then one sparse reduction of the
+    grid window covering the basins. Days are decoded in worker processes,
+    one raster at a time per worker.
+
+    Parameters:
+        - folder: directory searched recursively for daily rasters.
+        - pattern: regular expression with groups ``variable`` and ``date`` (YYYYMMDD).
+        - method: zonal weighting method (see zonal.py).
+        - workers: number of worker processes decoding rasters (default: all cores).
+    '''
+
+    def __init__(self, folder=PRISM_DIR, pattern=PRISM_PATTERN, method='fraction', workers=None):
+        self.folder = folder
+        self.pattern = re.compile(pattern)
+        self.method = method
+        self.workers = workers
+        self.key = 'raster:%s:%s' % (os.path.abspath(folder), method)
+
+    def files(self, variable):
+        '''Daily rasters of ``variable``, as a Series of paths indexed by date.'''
+        found = {}
+        for path in glob.glob(os.path.join(self.folder, '**', '*'), recursive=True):
+            match = self.pattern.search(os.path.basename(path))
+            if match and match.group('variable') == variable:
+                if path.endswith('.zip'):
+                    path = '/vsizip/%s/%s.bil' % (path, os.path.basename(path)[:-4])
+                found[pd.to_datetime(match.group('date'), format='%Y%m%d')] = path
+        return pd.Series(found, dtype=object).sort_index()
+
+    def fetch(self, dataset, variables, start, end, sites):
+        days = _days(start, end)
+        ids = [str(i) for i in sites.index]
+        out = {}
+        for v in variables:
+            files = self.files(v).reindex(days).dropna()
+            if not len(files):
+                out[v] = pd.DataFrame(np.nan, index=days, columns=ids)
+                continue
+            weights = zonal.ZoneWeights.from_raster(files.iloc[0], sites, ids, self.method)
+            means = zonal.stream_means(files.values, weights, workers=self.workers)
+            out[v] = pd.DataFrame(means, index=files.index, columns=ids).reindex(days)
+        return out
+
+
+class OfflineBackend(object):
+    '''
+    Stand-in backend serving existing (day x site) tables, so extraction and
+    everything downstream runs without network access. ``calls`` counts the
+    fetch calls made.
+
+    Parameters:
+        - tables: dict variable -> CSV table with a date index and one column per site.
+    '''
+
+    def __init__(self, tables=TABLES):
+        self.tables = dict(tables)
+        self.calls = 0
+        self.key = 'offline:' + cache.input_hash(self.tables.values())
+
+    def fetch(self, dataset, variables, start, end, sites):
+        self.calls += 1
+        days = _days(start, end)
+        ids = [str(i) for i in sites.index]
+        return dict((v, read_table(self.tables[v]).reindex(index=days, columns=ids))
+                    for v in variables)
+
+
+def _year_path(backend, dataset, variable, year, site_key):
+    key = cache.input_hash(backend=backend.key, dataset=dataset, variable=variable,
+                           year=year, sites=site_key)
+    return cache.cache_path('climate', key, '.pkl')
+
+
+def _runs(years):
+    '''Split sorted years into runs of consecutive years.'''
+    runs = []
+    for y in years:
+        if runs and y == runs[-1][-1] + 1:
+            runs[-1].append(y)
+        else:
+            runs.append([y])
+    return runs
+
+
+def extract(sites, variables, start, end, backend, dataset=PRISM_DAILY, use_cache=True):
+    '''
+    Function to extract daily series of several variables for all sites.
+
+    Parameters:
+        - sites: GeoDataFrame of sites (points or basins) indexed by site id.
+        - variables: variable (band) names, e.g. ['tmax', 'tmin'].
+        - start, end: first and last day.
+        - backend: extraction backend (see module doc).
+        - dataset: dataset identifier, e.g. an Earth Engine collection id.
+        - use_cache: reuse and store yearly results under data/cache/climate.
+
+    Returns:
+        - tables: dict variable -> DataFrame (day x site) of daily values.
+    '''
+    variables = list(variables)
+    days = _days(start, end)
+    site_key = _site_key(sites)
+    today = pd.Timestamp.today().normalize()
+    years = sorted(set(days.year))
+    parts = dict((v, {}) for v in variables)
+    missing = []
+    for year in years:
+        paths = [_year_path(backend, dataset, v, year, site_key) for v in variables]
+        if use_cache and all(os.path.exists(p) for p in paths):
+            for v, p in zip(variables, paths):
+                parts[v][year] = pd.read_pickle(p)
+        else:
+            missing.append(year)
+
+    for run in _runs(missing):
+        with instrument.span('climate.fetch', sites=len(sites), years=len(run),
+                             variables=len(variables)):
+            fetched = backend.fetch(dataset, variables, '%d-01-01' % run[0],
+                                    '%d-12-31' % run[-1], sites)
+        for v in variables:
+            for year in run:
+                part = fetched[v][fetched[v].index.year == year]
+                parts[v][year] = part
+                if use_cache and pd.Timestamp('%d-12-31' % year) < today:
+                    with cache.atomic_write(_year_path(backend, dataset, v, year, site_key)) as tmp:
+                        pd.to_pickle(part, tmp)
+
+    tables = {}
+    for v in variables:
+        table = pd.concat([parts[v][y] for y in years])
+        table.columns = [str(c) for c in table.columns]
+        tables[v] = table.reindex(days).astype(np.float64)
+    return tables
+
+
+def hargreaves_pet(tmax, tmin, latitude=PET_LATITUDE):
+    '''
+    Function to compute daily Hargreaves reference evapotranspiration
+    (Allen et al., 1998, eq. 52) for all sites at once.
+
+    Parameters:
+        - tmax, tmin: DataFrames (day x site) of daily temperature [deg C].
+        - latitude: latitude [deg] for extraterrestrial radiation, one value
+          for all sites or a Series indexed by site.
+
+    Returns:
+        - pet: DataFrame (day x site) of PET [mm/day].
+    '''
+    doy = np.asarray(tmax.index.dayofyear, dtype='float64')
+    if np.isscalar(latitude):
+        rext = np.repeat(meteo.sun_NR(doy, latitude)[1][:, None], tmax.shape[1], axis=1)
+    else:
+        rext = np.column_stack([meteo.sun_NR(doy, latitude[c])[1] for c in tmax.columns])
+    rext = pd.DataFrame(rext / 10.0**6, index=tmax.index, columns=tmax.columns)
+    tmean = (tmax + tmin) / 2.0
+    return evap.hargreaves(tmin, tmax, tmean, rext)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+'''
+Completeness index of the local daily flow records (data/flow_data).
+
+Completeness functions
+======================
+
+    - build:             Build the index in one pass over the flow files.
+    - load:              The index, rebuilt only when a flow file changed.
+    - CompletenessIndex: Per-gauge, per-day bitmap with range and season queries.
+    - add_to_screen:     Register the complete-season percentage as a screening column.
+
+The index holds one bit per gauge and day, set where the flow file has a
+discharge value, packed 8 days to a byte (numpy.packbits) on a common daily
+axis from the first to the last day of any file. Days before or after a
+gauge's record count as missing. Queries unpack only the bytes of the
+requested period and reduce them per month with array operations, so the
+completeness of every gauge and season is computed at once.
+
+A month is complete when it has a value on every day (or on at least
+``min_complete`` of its days). The fraction of complete winter months of a
+range of water years replaces the fixed water-year flags of the GAGES-II
+flow record table in screening, and ``season_complete`` gives the mask of
+seasons with complete discharge for the storage calculation (see
+``sensitivity.seasonal_totals``), so missing days no longer count as zero
+flow.
+
+The index is stored under data/cache/completeness, keyed by the contents of
+the flow files.
+
+Examples
+--------
+
+    >>> index = load()
+    >>> index.fraction(2003, 2009, gauges=['11475560', '11111500'])
+    >>> mask = index.season_complete(range(2002, 2014))
+    >>> screen = screening.Screen(screening.STUDY_CRITERIA)
+    >>> add_to_screen(screen, 2003, 2009)
+    >>> screen.set('complete_flow', column='winter_complete_pct', op='==', value=100, params={})
+
+'''
+
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+import cache
+from nwis import FLOW_DIR
+
+# months of the winter of a water year (Oct - Mar), as in sensitivity.py
+WINTER_MONTHS = (10, 11, 12, 1, 2, 3)
+
+
+def _day(value):
+    return np.datetime64(pd.Timestamp(value).date(), 'D')
+
+
+def _read_days(path):
+    '''Days with a discharge value in one flow file, as datetime64[D].'''
+    df = pd.read_csv(path, usecols=['datetime', 'q'])
+    days = pd.to_datetime(df.datetime.values).values.astype('datetime64[D]')
+    return days[df.q.notnull().values]
+
+
+def build(folder=FLOW_DIR):
+    '''
+    Function to build the completeness index of the flow files of a folder.
+
+    Parameters:
+        - folder: folder of <gauge>.csv daily flow files.
+
+    Returns:
+        - index: CompletenessIndex.
+    '''
+    paths = sorted(glob.glob(os.path.join(folder, '*.csv')))
+    gauges = [os.path.splitext(os.path.basename(p))[0] for p in paths]
+    days = [_read_days(p) for p in paths]
+    present = [d for d in days if len(d)]
+    if not present:
+        return CompletenessIndex(gauges, np.datetime64('2000-01-01', 'D'), 0,
+                                 np.zeros((len(gauges), 0), dtype='uint8'))
+    start = min(d.min() for d in present)
+    ndays = int((max(d.max() for d in present) - start).astype('i8')) + 1
+    valid = np.zeros((len(gauges), ndays), dtype=bool)
+    for i, d in enumerate(days):
+        valid[i, (d - start).astype('i8')] = True
+    return CompletenessIndex(gauges, start, ndays, np.packbits(valid, axis=1))
+
+
+def load(folder=FLOW_DIR):
+    '''
+    Function to load the completeness index, rebuilding it when a flow file
+    was added or changed.
+
+    Returns:
+        - index: CompletenessIndex.
+    '''
+    paths = glob.glob(os.path.join(folder, '*.csv'))
+    path = cache.cache_path('completeness', cache.input_hash(paths, folder=folder), '.npz')
+    if os.path.exists(path):
+        with np.load(path) as npz:
+            return CompletenessIndex(list(npz['gauges']), npz['start'][()], int(npz['ndays']),
+                                     npz['bits'])
+    index = build(folder)
+    with cache.atomic_write(path) as tmp:
+        with open(tmp, 'wb') as fh:
+            np.savez(fh, gauges=np.array(index.gauges), start=index.start, ndays=index.ndays,
+                     bits=index.bits)
+    return index
+
+
+class CompletenessIndex(object):
+    '''
+    Packed per-gauge, per-day record of which days have a discharge value.
+
+    Parameters:
+        - gauges: gauge ids (rows of ``bits``).
+        - start: first day of the axis (datetime64[D]).
+        - ndays: number of days of the axis.
+        - bits: uint8 array (gauge x ceil(ndays / 8)) from numpy.packbits.
+    '''
+
+    def __init__(self, gauges, start, ndays, bits):
+        self.gauges = [str(g) for g in gauges]
+        self.start = np.datetime64(start, 'D')
+        self.ndays = ndays
+        self.bits = bits
+        self._rows = dict((g, i) for i, g in enumerate(self.gauges))
+
+    def _select(self, gauges):
+        gauges = self.gauges if gauges is None else [str(g).zfill(8) for g in gauges]
+        return [g for g in gauges if g in self._rows]
+
+    def days(self, start, end, gauges=None):
+        '''
+        Function to unpack the bitmap of a period.
+
+        Parameters:
+            - start, end: first and last day.
+            - gauges: gauge ids (default: all); gauges not in the index are left out.
+
+        Returns:
+            - dates: DatetimeIndex of the days.
+            - gauges: gauge ids (columns).
+            - valid: bool array (day x gauge).
+        '''
+        gauges = self._select(gauges)
+        first = int((_day(start) - self.start).astype('i8'))
+        last = int((_day(end) - self.start).astype('i8')) + 1
+        dates = pd.date_range(start, end, freq='D')
+        valid = np.zeros((len(gauges), max(last - first, 0)), dtype=bool)
+        lo, hi = max(first, 0), min(last, self.ndays)
+        if hi > lo and gauges:
+            rows = [self._rows[g] for g in gauges]
+            packed = self.bits[rows, lo // 8:(hi + 7) // 8]
+            unpacked = np.unpackbits(packed, axis=1)
+            valid[:, lo - first:hi - first] = unpacked[:, lo - lo // 8 * 8:hi - lo // 8 * 8]
+        return dates, gauges, valid.T
+
+    def monthly(self, start, end, gauges=None):
+        '''
+        Function to compute the fraction of days with a value in every month.
+
+        Parameters:
+            - start, end: first and last month (whole months are used).
+            - gauges: gauge ids (default: all).
+
+        Returns:
+            - fraction: DataFrame (month start x gauge).
+        '''
+        start = pd.Timestamp(start).to_period('M').to_timestamp()
+        end = pd.Timestamp(end).to_period('M').to_timestamp('M')
+        dates, gauges, valid = self.days(start, end, gauges)
+        month = dates.year.values * 12 + dates.month.values - 1
+        starts = np.flatnonzero(np.r_[True, month[1:] != month[:-1]])
+        counts = np.add.reduceat(valid.astype('int32'), starts, axis=0)
+        ndays = np.diff(np.r_[starts, len(dates)])
+        return pd.DataFrame(counts / ndays[:, None].astype('float64'),
+                            index=pd.DatetimeIndex(dates[starts]), columns=gauges)
+
+    def complete_months(self, water_years, months=WINTER_MONTHS, gauges=None, min_complete=1.0):
+        '''
+        Function to compute the fraction of complete months of a season in
+        every water year.
+
+        Parameters:
+            - water_years: water years, e.g. range(2002, 2014).
+            - months: calendar months of the season (default: Oct - Mar).
+            - gauges: gauge ids (default: all).
+            - min_complete: fraction of days with a value a month needs.
+
+        Returns:
+            - fraction: DataFrame (water year x gauge).
+        '''
+        water_years = list(water_years)
+        monthly = self.monthly('%d-10-01' % (min(water_years) - 1),
+                               '%d-09-30' % max(water_years), gauges)
+        monthly = monthly.loc[monthly.index.month.isin(months)]
+        wy = np.where(monthly.index.month >= 10, monthly.index.year + 1, monthly.index.year)
+        complete = (monthly.values >= min_complete).astype('float64')
+        fraction = pd.DataFrame(complete, index=wy, columns=monthly.columns).groupby(level=0).mean()
+        return fraction.reindex(water_years)
+
+    def season_complete(self, water_years, months=WINTER_MONTHS, gauges=None, min_complete=1.0):
+        '''
+        Function to flag the seasons in which every month is complete.
+
+        Returns:
+            - complete: bool DataFrame (water year x gauge).
+        '''
+        return self.complete_months(water_years, months, gauges, min_complete) >= 1.0
+
+    def fraction(self, first, last, months=WINTER_MONTHS, gauges=None, min_complete=1.0):
+        '''
+        Function to compute the fraction of complete season months over a
+        range of water years, e.g. the complete winter months of 2003 - 2009.
+
+        Returns:
+            - fraction: Series indexed by gauge id.
+        '''
+        return self.complete_months(range(first, last + 1), months, gauges, min_complete).mean()
+
+
+def add_to_screen(screen, first, last, months=WINTER_MONTHS, name='winter_complete_pct',
+                  index=None, folder=FLOW_DIR):
+    '''
+    Function to add the percentage of complete season months of the local
+    flow records as a screening column. Basins without a flow file are NaN
+    and fail any comparison.
+
+    Parameters:
+        - screen: screening.Screen.
+        - first, last: water years.
+        - months: calendar months of the season (default: Oct - Mar).
+        - name: column name used in criteria.
+        - index: CompletenessIndex (default: ``load(folder)``).
+        - folder: folder of the flow files.
+
+    Returns:
+        - values: Series of the percentages indexed by STAID.
+    '''
+    index = load(folder) if index is None else index
+    values = 100 * index.fraction(first, last, months)
+    values.index = values.index.astype('int64')
+    screen.add_source(name, values, files=glob.glob(os.path.join(folder, '*.csv')))
+    return values
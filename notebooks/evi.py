@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+'''
+Streaming ingestion of the Earth Engine EVI and QA exports (GeoJSON feature
+collections with one feature per site and image date).
+
+EVI functions
+=============
+
+    - iter_properties: Stream the ``properties`` objects of a feature collection.
+    - read_columns:    Typed date / gauge / value columns of an export.
+    - monthly_array:   Pivot typed columns to a (month x site) array of means.
+    - read_monthly:    Monthly (month x site) DataFrame of one export.
+    - load:            Monthly EVI and QA mode of the study sites together.
+
+The exports carry no geometry that is used anywhere, so features are never
+turned into shapely objects: only the ``properties`` objects are located in
+the file, read block by block, and decoded. Dates, gauge ids and values go
+straight into typed numpy columns and are pivoted to months with array
+reductions, which gives the same table as ``gp.read_file`` followed by
+``pivot(...).resample('MS').mean()``.
+
+Examples
+--------
+
+    >>> evi, qa = load(sites=sites.index)
+
+'''
+
+import os
+import json
+import re
+
+import numpy as np
+import pandas as pd
+
+import cache
+
+EVI_GEOJSON = os.path.join(cache.DATA_DIR, 'modis_mean_evi.geojson')
+QA_GEOJSON = os.path.join(cache.DATA_DIR, 'mode_qa.geojson.json')
+
+# the Earth Engine multiplier of the MODIS EVI product
+EVI_SCALE = 0.0001
+
+# a flat properties object (no nested objects), or null
+_PROPERTIES = re.compile(r'"properties"\s*:\s*(\{[^{}]*\}|null)')
+_KEY = '"properties"'
+
+
+def iter_properties(path, blocksize=1 << 20):
+    '''
+    Function to stream the ``properties`` of every feature in a GeoJSON file
+    without decoding geometries.
+
+    Parameters:
+        - path: GeoJSON file name.
+        - blocksize: number of characters read per block.
+
+    Returns:
+        - properties: generator of dicts, one per feature.
+    '''
+    with open(path) as fh:
+        tail = ''
+        for block in iter(lambda: fh.read(blocksize), ''):
+            text = tail + block
+            end = 0
+            for match in _PROPERTIES.finditer(text):
+                end = match.end()
+                yield json.loads(match.group(1)) or {}
+            tail = text[end:]
+            # keep only what may still be the start of a properties object
+            start = tail.rfind(_KEY)
+            tail = tail[start:] if start >= 0 else tail[-len(_KEY):]
+
+
+def read_columns(path, value, date='date', gauge='gauge_id', date_format='%Y_%m_%d'):
+    '''
+    Function to read the date, gauge and value fields of an export into
+    typed columns.
+
+    Parameters:
+        - path: GeoJSON file name.
+        - value: name of the value property (``mean`` for EVI, ``mode`` for QA).
+        - date, gauge: names of the date and gauge id properties.
+        - date_format: format of the date strings.
+
+    Returns:
+        - dates: datetime64[D] array.
+        - gauges: str array of gauge ids.
+        - values: float64 array, NaN where the value is missing.
+    '''
+    dates, gauges, values = [], [], []
+    for props in iter_properties(path):
+        dates.append(props.get(date))
+        gauges.append(props.get(gauge))
+        v = props.get(value)
+        values.append(np.nan if v is None else v)
+    if date_format == '%Y_%m_%d':
+        dates = np.array([d.replace('_', '-') for d in dates], dtype='datetime64[D]')
+    else:
+        dates = pd.to_datetime(dates, format=date_format).values.astype('datetime64[D]')
+    return dates, np.array(gauges, dtype=str), np.array(values, dtype='float64')
+
+
+def monthly_array(dates, gauges, values):
+    '''
+    Function to pivot typed columns to monthly means per site.
+
+    Parameters:
+        - dates, gauges, values: equally long columns (see ``read_columns``).
+
+    Returns:
+        - months: DatetimeIndex of month starts, first to last month.
+        - sites: sorted array of gauge ids (column order).
+        - means: float array (month x site), NaN for months without values.
+    '''
+    sites, col = np.unique(gauges, return_inverse=True)
+    month = dates.astype('datetime64[M]')
+    first = month.min()
+    row = (month - first).astype('i8')
+    nmonths = int(row.max()) + 1 if len(row) else 0
+    valid = ~np.isnan(values)
+    flat = row[valid] * len(sites) + col[valid]
+    size = nmonths * len(sites)
+    sums = np.bincount(flat, weights=values[valid], minlength=size)
+    counts = np.bincount(flat, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (sums / counts).reshape(nmonths, len(sites))
+    months = pd.date_range(pd.Timestamp(first), periods=nmonths, freq='MS')
+    return months, sites, means
+
+
+def read_monthly(path, value, scale=1.0, sites=None):
+    '''
+    Function to read one export as a monthly table.
+
+    Parameters:
+        - path: GeoJSON file name.
+        - value: name of the value property.
+        - scale: multiplier applied to the monthly means.
+        - sites: gauge ids to keep, in this order (default: all, sorted).
+
+    Returns:
+        - df: DataFrame (month x site) indexed by ``datetime``.
+    '''
+    months, gauges, means = monthly_array(*read_columns(path, value))
+    df = pd.DataFrame(scale * means, index=months, columns=gauges)
+    df.index.name = 'datetime'
+    df.columns.name = 'gauge_id'
+    if sites is not None:
+        df = df[list(sites)]
+    return df
+
+
+def load(evi_path=EVI_GEOJSON, qa_path=QA_GEOJSON, sites=None):
+    '''
+    Function to load the monthly EVI and QA mode of the study sites.
+
+    Parameters:
+        - evi_path: Earth Engine export of the basin-mean EVI.
+        - qa_path: Earth Engine export of the basin QA mode.
+        - sites: gauge ids to keep (default: all).
+
+    Returns:
+        - evi: DataFrame (month x site) of EVI (scaled to [-1, 1]).
+        - qa: DataFrame (month x site) of the mean QA mode, on the EVI months.
+    '''
+    evi = read_monthly(evi_path, 'mean', scale=EVI_SCALE, sites=sites)
+    qa = read_monthly(qa_path, 'mode', sites=sites)
+    return evi, qa.reindex(index=evi.index, columns=evi.columns)
@@ -0,0 +1,547 @@
+# -*- coding: utf-8 -*-
+'''
+Cached, parallel rendering of the paper figures.
+
+Figure functions
+================
+
+    - FIGURES:    Registry of figures: inputs, outputs and style parameters.
+    - render:     Render the figures whose inputs or style changed, in parallel.
+    - figure2:    Storage and EVI of three example sites (Fig. 2).
+    - figure3:    Storage and EVI sensitivity of all sites with maps (Fig. 3).
+    - figure_s3:  Storage and EVI of every site (Fig. S3).
+    - site_tile:  One site of Fig. S3 as a PNG tile, cached on its own.
+
+Every figure is keyed on the contents of its input files, the code drawing
+it and its style parameters (formats, dpi, ...). ``render`` skips figures
+whose key did not change since they were last written, and renders the
+others concurrently in worker processes with the non-interactive Agg
+backend. Figures drawn by a notebook (Fig. S2, S4 - S7) are rendered by
+executing the notebook headless.
+
+Fig. S3 has two panels per site for all 26 sites. The PDF is drawn in full,
+so it stays vector. A PNG version is assembled from per-site tiles cached
+under data/cache/figures/tiles, keyed by the site's data, so only sites
+whose data changed are drawn again.
+
+The pipeline runs ``render`` as its 'figures' stage (pipeline.py).
+
+Examples
+--------
+
+    >>> render()
+    >>> render(['fig2'], force=True)
+
+    From the notebooks folder:
+
+        $ python figures.py fig2 fig3 --workers 4
+
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import textwrap
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import cache
+import registry
+import sensitivity
+
+NOTEBOOK_DIR = os.path.dirname(os.path.abspath(__file__))
+PLOT_DIR = os.path.normpath(os.path.join(NOTEBOOK_DIR, '..', 'plots'))
+TILE_DIR = os.path.join(cache.CACHE_DIR, 'figures', 'tiles')
+VECTOR_FORMATS = ('pdf', 'svg', 'eps', 'ps')
+
+EXAMPLE_SITES = ['11475560', '11180825', '11224500']
+EXAMPLE_NAMES = ['Elder Creek (ID: 11475560)\nStorage-capacity-limited',
+                 'San Lorenzo (ID: 11180825)\nIntermediate',
+                 'Los Gatos Creek (ID: 11224500)\nPrecipitation-limited']
+WINTER = 'Oct 1 - Apr 1'
+SUMMER = 'Apr 1 - Sep 30'
+
+
+def _data(*parts):
+    return os.path.join(cache.DATA_DIR, *parts)
+
+
+def _plot(name):
+    return os.path.join(PLOT_DIR, name)
+
+
+_TABLES = [_data(sensitivity.TABLES[n]) for n in ('precip', 'et', 'evi', 'discharge')]
+_SHAPES = sorted(registry.SOURCES.values())
+
+# name -> func (keyword arguments: params) or notebook, inputs, outputs, params
+FIGURES = {
+    'fig2': {'func': 'figure2', 'inputs': _TABLES,
+             'outputs': [_plot('evi_example_sites_plot.png'), _plot('evi_example_sites_plot.pdf')],
+             'params': {'water_years': [2002, 2013], 'formats': ['png', 'pdf'], 'dpi': 300}},
+    'fig3': {'func': 'figure3', 'inputs': _TABLES + _SHAPES + [_data('CA.shp')],
+             'outputs': [_plot('storage_evi_sensitivity.png'),
+                         _plot('storage_evi_sensitivity.pdf')],
+             'params': {'water_years': [2002, 2013], 'formats': ['png', 'pdf'], 'dpi': 300}},
+    'figS3': {'func': 'figure_s3', 'inputs': _TABLES + _SHAPES,
+              'outputs': [_plot('FigS3.pdf'), _plot('FigS3.png')],
+              'params': {'water_years': [2002, 2013], 'formats': ['pdf', 'png'], 'dpi': 150}},
+    'figS2': {'notebook': 'theoretical_analysis.ipynb', 'inputs': [],
+              'outputs': [_plot('FigS2.pdf')]},
+    'figS4_S5': {'notebook': 'Fig. S4-S5-rainfall-canopy-distribution.ipynb',
+                 'inputs': [_data('Table S2.csv')],
+                 'outputs': [_plot('FigS4.png'), _plot('FigS4.pdf'),
+                             _plot('FigS5.png'), _plot('FigS5.pdf')]},
+    'figS6': {'notebook': 'REVISION1_FigS6_empirical_analysis_evi_pet.ipynb',
+              'inputs': _TABLES + _SHAPES + [_data('CA.shp'), _data('pet_prism_hargreaves.csv')],
+              'outputs': [_plot('FigS6.png'), _plot('FigS6.pdf')]},
+    'figS7': {'notebook': 'REVISION1_FigS7_empirical_analysis_evi_drought_years_sensitivity.ipynb',
+              'inputs': _TABLES + _SHAPES + [_data('pet_prism_hargreaves.csv')],
+              'outputs': [_plot('FigS7.png'), _plot('FigS7.pdf')]},
+}
+
+
+def _palette(n):
+    '''First ``n`` colours of tab20 (as seaborn's color_palette("tab20", n)).'''
+    import matplotlib.pyplot as plt
+    return list(plt.get_cmap('tab20').colors[:n])
+
+
+def _despine(ax):
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+
+
+def _save(fig, output, formats, dpi):
+    for fmt in formats:
+        fig.savefig('%s.%s' % (output, fmt), bbox_inches='tight', dpi=dpi)
+
+
+def _analysis(water_years):
+    '''Tables, seasonal totals and results of the main analysis.'''
+    tables = sensitivity.load_tables()
+    years = range(water_years[0], water_years[1] + 1)
+    seasons = sensitivity.seasonal_totals(tables, years)
+    results, order = sensitivity.sensitivity(seasons)
+    return tables, list(years), seasons, results, order
+
+
+def site_labels(order, sites=None):
+    '''
+    Function to build the short site names of the figures, e.g.
+    'Elder (11475560)'.
+
+    Parameters:
+        - order: gauge ids.
+        - sites: site registry (default: ``registry.load()``).
+
+    Returns:
+        - labels: dict gauge id -> label.
+    '''
+    sites = registry.load() if sites is None else sites
+    names = [textwrap.fill(sites[site].name + ' (' + str(site) + ')', 20) for site in order]
+    names = [n.replace(' C ', ' Creek ').replace(' CA ', '') for n in names]
+    names = [n.split(' ')[0] + ' ' + n.split(' ')[1] + ' (%s)' % str(site)
+             for n, site in zip(names, order)]
+    names = [n.title().replace('Creek', '') for n in names]
+    return dict(zip(order, names))
+
+
+def _rho_text(x, y):
+    '''Spearman rho as shown in the titles, starred when p < 0.05.'''
+    rho, p = sensitivity.stats.spearmanr(x, y, nan_policy='omit')
+    return r'$\rho$ = %.2f*' % rho if p < .05 else r'$\rho$ = %.2f' % rho
+
+
+def _year_legend(fig, years, rect):
+    pal = _palette(len(years))
+    ax = fig.add_axes(rect)
+    for j, wy in enumerate(years):
+        ax.scatter([2], [2], c=[pal[j]], edgecolors='k', s=75, zorder=100, label=str(wy))
+    ax.set_xlim([0, 1])
+    ax.set_ylim([0, 1])
+    ax.legend(title='Water year')
+    _despine(ax)
+    ax.get_xaxis().set_visible(False)
+    ax.get_yaxis().set_visible(False)
+
+
+def figure2(output=_plot('evi_example_sites_plot'), water_years=(2002, 2013), sites=EXAMPLE_SITES,
+            names=EXAMPLE_NAMES, formats=('png', 'pdf'), dpi=300):
+    '''
+    Function to draw Fig. 2: winter storage traces (top) and normalized
+    summer EVI (bottom) against winter precipitation of three example sites.
+
+    Parameters:
+        - output: file name without extension.
+        - water_years: first and last water year.
+        - sites, names: sites to show and their panel titles.
+        - formats, dpi: output formats and resolution.
+
+    Returns:
+        - fig: the matplotlib figure.
+    '''
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker
+    tables, years, seasons, _, _ = _analysis(water_years)
+    p_winter, s_end, evi_summer = seasons['p_winter'], seasons['s_end'], seasons['evi_summer']
+    pal = _palette(len(years))
+    fig, axs = plt.subplots(2, len(sites), figsize=(10, 6), sharex='col', sharey=False)
+    seasonal = [sensitivity.water_year(tables, wy) for wy in years]
+    for i, site in enumerate(sites):
+        x, y = [], []
+        for j, season in enumerate(seasonal):
+            s = (season['wyrain'].cumsum() - season['wyq'].cumsum() -
+                 season['winteret'].cumsum())
+            p = season['wyrain'].cumsum()
+            x.append(p[site].values[-1])
+            y.append(season['summerevi'].mean()[site])
+            # storage traces in grey, end of season storage coloured by year
+            axs[0][i].plot(np.insert(p[site].values, 0, 0), np.insert(s[site].values, 0, 0),
+                           c='grey', alpha=0.5)
+            axs[0][i].scatter(p[site].values[-1], s[site].values[-1], c=[pal[j]],
+                              edgecolors='k', s=75, zorder=100)
+        axs[1][i].scatter(x, y / np.mean(y), c=pal, edgecolors='k', s=75)
+        axs[1][i].set_ylim([0.7, 1.4])
+        top = p_winter[site].max() + 200
+        axs[0, i].set_ylim([0, top])
+        axs[0, i].set_xlim([0, top])
+        axs[0, i].plot([0, top], [0, top], '--k', alpha=0.5)
+
+    axs[0][0].set_ylabel(r'S = P - Q - ET [mm]' + '\n' + WINTER)
+    axs[1][0].set_ylabel(r'Normalized summer EVI' + '\n' + SUMMER)
+    for i in range(len(sites)):
+        axs[1][i].set_xlabel(r'P [mm]' + ' ' + WINTER)
+    axs[1][0].yaxis.set_major_formatter(matplotlib.ticker.FormatStrFormatter('%.1f'))
+    for i, site in enumerate(sites):
+        axs[0][i].set_title('\n\n' + names[i] + '\n(%s)' %
+                            _rho_text(p_winter[site].values, s_end[site].values))
+        axs[1][i].set_title(_rho_text(p_winter[site].values, evi_summer[site].values))
+    letters = ['(a)', '(b)', '(c)', '(d)', '(e)', '(f)', '(g)']
+    for i in range(len(sites)):
+        for j in range(2):
+            axs[j][i].annotate(letters[3 * j + i], (.05, .9), xycoords='axes fraction',
+                               fontsize=12)
+    _year_legend(fig, years, [-0.015, 0.2, 0.01, 0.5])
+    plt.tight_layout()
+    _save(fig, output, formats, dpi)
+    return fig
+
+
+def figure3(output=_plot('storage_evi_sensitivity'), water_years=(2002, 2013),
+            formats=('png', 'pdf'), dpi=300):
+    '''
+    Function to draw Fig. 3: Spearman rho of storage (top) and summer EVI
+    (bottom) with winter precipitation for all sites, ordered by storage
+    sensitivity, with maps of the significant sites.
+
+    Parameters:
+        - output: file name without extension.
+        - water_years: first and last water year.
+        - formats, dpi: output formats and resolution.
+
+    Returns:
+        - fig: the matplotlib figure.
+    '''
+    import geopandas as gp
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    _, _, _, results, order = _analysis(water_years)
+    sites = registry.load()
+    labels = site_labels(order.values, sites)
+    sitenames = [labels[s] for s in order.values]
+
+    g = sns.factorplot(y='value', x='id', hue='Significant', row='variable', data=results,
+                       kind='point', join=False, order=order, sharey=False, size=2.7,
+                       aspect=2.5, row_order=['Storage', 'EVI'], hue_order=['False', 'True'],
+                       color='grey', legend=False)
+    g.fig.subplots_adjust(hspace=-15)
+    unlimited = len(results.loc[(results.variable == 'Storage') &
+                                (results.Significant == 'False')])
+    ax = g.axes.flatten()[0]
+    plt.setp(ax.collections, edgecolors=['k'], linewidths=[1])
+    ax.set_xticklabels(['' for _ in sitenames])
+    for tick in ax.get_xticklabels():
+        tick.set(color='w')
+    ax.set_ylabel(r'Spearman $\rho$')
+    ax.set_title('Storage sensitivity to winter precipitation', fontsize=10)
+    leg_handles = ax.get_legend_handles_labels()[0]
+    ax.legend(leg_handles, [r'$p>0.05$ ($\rho$ not significant)', r'$p<0.05$'])
+    ax.plot([0, 100], [1, 1], '--k', alpha=0.5, zorder=1)
+    ax.plot([0, 100], [0, 0], '--k', alpha=0.5, zorder=1)
+    ax.set_ylim([-0.5, 1.2])
+    ax.set_xlim([-0.4, len(sitenames) - 1 + 0.4])
+    ax.grid(axis='x', alpha=0.2)
+    for i in range(unlimited):
+        ax.plot([i, i], [-0.5, .95], clip_on=False, zorder=-100, c='grey', alpha=0.1, lw=6)
+    ax.annotate('Precipitation-\nlimited', (1.01, .8), xycoords='axes fraction')
+    ax.annotate('Storage-capacity-\nlimited', (1.01, .2), xycoords='axes fraction')
+
+    ax = g.axes.flatten()[1]
+    plt.setp(ax.collections, edgecolors=['k'], linewidths=[1])
+    ax.set_ylabel(r'Spearman $\rho$')
+    ax.set_title('Summer EVI sensitivity to winter precipitation', fontsize=10)
+    ax.set_xticklabels(sitenames)
+    for tick in ax.get_xticklabels():
+        tick.set(rotation=90, fontsize=8)
+    ax.plot([0, 100], [1, 1], '--k', alpha=0.5, zorder=0)
+    ax.plot([0, 100], [0, 0], '--k', alpha=0.5, zorder=0)
+    ax.set_ylim([-0.5, 1.2])
+    ax.grid(axis='x', alpha=0.2)
+    for i in range(unlimited):
+        ax.plot([i, i], [-0.5, 2.62], clip_on=False, zorder=-10, c='grey', alpha=0.1, lw=6)
+    ax.set_xlabel('Watershed (gage ID)')
+
+    from shapely.geometry import Point
+    centroids = [Point(x, y) for x, y in sites.centroids(order.values)]
+    basin_gdf = gp.GeoDataFrame(sitenames, geometry=centroids, columns=['name'])
+    basin_gdf['id'] = order.values
+    ca_shp = gp.read_file(_data('CA.shp'))
+    for variable, rect, letter in (('EVI', [-0.3, 0.25, 0.25, 0.25], '(b)'),
+                                   ('Storage', [-0.3, 0.65, 0.25, 0.25], '(a)')):
+        ax = g.fig.add_axes(rect)
+        ca_shp.plot(ax=ax, edgecolor='k', color='w')
+        for _, row in basin_gdf.iterrows():
+            sig = results.loc[(results.variable == variable) &
+                              (results.id == row.id)].Significant.values[0]
+            if sig == 'False':
+                ax.scatter(row.geometry.x, row.geometry.y, edgecolors='k', s=40,
+                           c='whitesmoke', linewidth=1., zorder=100)
+            else:
+                ax.scatter(row.geometry.x, row.geometry.y, edgecolors='k', s=40, c='grey',
+                           linewidth=1.)
+        sns.despine(ax=ax, left=True, bottom=True)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        ax.annotate(letter, (-.3, .9), xycoords='axes fraction', fontsize=12)
+    plt.tight_layout()
+    _save(g.fig, output, formats, dpi)
+    return g.fig
+
+
+def _tile_key(site, seasonal, title, top_title, first, dpi):
+    h = hashlib.sha1()
+    for season in seasonal:
+        for name in ('wyrain', 'wyq', 'winteret', 'summerevi'):
+            h.update(np.ascontiguousarray(season[name][site].values, dtype='float64').tobytes())
+    h.update(json.dumps([site, len(seasonal), title, top_title, first, dpi]).encode())
+    return h.hexdigest()
+
+
+def _draw_site(axs, site, seasonal, title, bottom_title, first):
+    '''Draw one site of Fig. S3 into a column of two axes.'''
+    import matplotlib.ticker
+    pal = _palette(len(seasonal))
+    x, y = [], []
+    for j, season in enumerate(seasonal):
+        p = season['wyrain'].cumsum()
+        q = season['wyq'].cumsum()
+        s = p - q - season['winteret'].cumsum()
+        x.append(p[site].values[-1])
+        y.append(season['summerevi'].mean()[site])
+        axs[0].plot(np.insert(p[site].values, 0, 0), np.insert(s[site].values, 0, 0),
+                    c='grey', alpha=0.5, linewidth=2)
+        axs[0].scatter(p[site].values[-1], s[site].values[-1], c=[pal[j]], edgecolors='k',
+                       s=75, zorder=100)
+        axs[0].scatter(p[site].values[-1], q[site].values[-1], c='blue', edgecolors='k', s=10,
+                       zorder=1, alpha=0.3)
+        axs[0].plot(p[site], q[site], c='blue', alpha=0.3, zorder=1, label='Q [mm]',
+                    linewidth=2)
+    axs[1].scatter(x, y, c=pal, edgecolors='k', s=75)
+    top = np.nanmax(x) + 200
+    axs[0].set_ylim([0, top])
+    axs[0].set_xlim([0, top])
+    axs[0].plot([0, top], [0, top], '--k', alpha=0.5)
+    axs[1].set_xlabel(r'P [mm]' + ' ' + WINTER)
+    if first:
+        axs[0].set_ylabel(r'S = P - Q - ET [mm; grey lines]' + '\n' +
+                          r'and Q [mm; blue lines]' + '\n' + WINTER)
+        axs[1].set_ylabel(r'Mean summer EVI [ ]' + '\n' + SUMMER)
+        axs[1].yaxis.set_major_formatter(matplotlib.ticker.FormatStrFormatter('%.2f'))
+    axs[0].set_title(title)
+    axs[1].set_title(bottom_title)
+
+
+def site_tile(site, seasonal, title, bottom_title, first=False, dpi=150,
+              width=100 / 26.0, height=6):
+    '''
+    Function to draw one site of Fig. S3 (storage and discharge traces on
+    top, summer EVI below) as a PNG tile, or reuse the cached tile.
+
+    Parameters:
+        - site: gauge id.
+        - seasonal: ``sensitivity.water_year`` tables of every water year.
+        - title, bottom_title: panel titles.
+        - first: draw the y axis labels (leftmost tile).
+        - dpi, width, height: tile resolution and size [in].
+
+    Returns:
+        - path: the PNG tile.
+    '''
+    key = _tile_key(site, seasonal, title, bottom_title, first, dpi)
+    path = os.path.join(TILE_DIR, '%s-%s.png' % (site, key[:16]))
+    if os.path.exists(path):
+        return path
+    import matplotlib.pyplot as plt
+    fig, axs = plt.subplots(2, 1, figsize=(width, height), sharex='col', sharey=False)
+    _draw_site(axs, site, seasonal, title, bottom_title, first)
+    plt.tight_layout()
+    if not os.path.isdir(TILE_DIR):
+        os.makedirs(TILE_DIR, exist_ok=True)
+    with cache.atomic_write(path) as tmp:
+        fig.savefig(tmp, dpi=dpi, format='png')
+    plt.close(fig)
+    return path
+
+
+def _compose(tiles, dpi):
+    '''Figure of PNG tiles side by side, at their own resolution.'''
+    import matplotlib.image
+    import matplotlib.pyplot as plt
+    images = [matplotlib.image.imread(t) for t in tiles]
+    widths = np.array([im.shape[1] for im in images], dtype=float)
+    height = max(im.shape[0] for im in images)
+    fig = plt.figure(figsize=(widths.sum() / dpi, height / float(dpi)))
+    left = 0.0
+    for im, w in zip(images, widths):
+        ax = fig.add_axes([left / widths.sum(), 0, w / widths.sum(), im.shape[0] / height])
+        ax.imshow(im, interpolation='none')
+        ax.set_axis_off()
+        left += w
+    return fig
+
+
+def figure_s3(output=_plot('FigS3'), water_years=(2002, 2013), formats=('pdf',), dpi=150):
+    '''
+    Function to draw Fig. S3: storage, discharge and EVI of every site,
+    ordered by storage sensitivity.
+
+    Vector formats (pdf, svg, eps) are drawn in full, as one figure with a
+    column of axes per site. Raster formats are assembled from the cached
+    site tiles, so only sites whose data changed are drawn again.
+
+    Parameters:
+        - output: file name without extension.
+        - water_years: first and last water year.
+        - formats, dpi: output formats and resolution of the raster output.
+
+    Returns:
+        - fig: the matplotlib figure of the last format written.
+    '''
+    import matplotlib.pyplot as plt
+    tables, years, seasons, _, order = _analysis(water_years)
+    p_winter, s_end, evi_summer = seasons['p_winter'], seasons['s_end'], seasons['evi_summer']
+    seasonal = [sensitivity.water_year(tables, wy) for wy in years]
+    labels = site_labels(order.values)
+    titles = []
+    for site in order.values:
+        bottom = _rho_text(p_winter[site].values, evi_summer[site].values)
+        if site == sensitivity.DRY_CREEK:
+            title = 'Dry Creek, no data'
+        else:
+            title = '%s, (%s)' % (labels[site], _rho_text(p_winter[site].values,
+                                                          s_end[site].values))
+        titles.append((site, title, bottom))
+    vector = [f for f in formats if f in VECTOR_FORMATS]
+    raster = [f for f in formats if f not in VECTOR_FORMATS]
+    fig = None
+    if vector:
+        fig, axs = plt.subplots(2, len(titles), figsize=(100, 6), sharex='col', sharey=False)
+        for i, (site, title, bottom) in enumerate(titles):
+            _draw_site(axs[:, i], site, seasonal, title, bottom, first=(i == 0))
+        _year_legend(fig, years, [-0.015, 0.28, 0.01, 0.5])
+        plt.tight_layout()
+        _save(fig, output, vector, dpi)
+    if raster:
+        if fig is not None:
+            plt.close(fig)
+        tiles = [site_tile(site, seasonal, title, bottom, first=(i == 0), dpi=dpi)
+                 for i, (site, title, bottom) in enumerate(titles)]
+        fig = _compose(tiles, dpi)
+        _year_legend(fig, years, [-0.015, 0.28, 0.01, 0.5])
+        _save(fig, output, raster, dpi)
+    return fig
+
+
+def _key(name, spec):
+    code = [os.path.abspath(__file__), sensitivity.__file__, registry.__file__]
+    if 'notebook' in spec:
+        code.append(os.path.join(NOTEBOOK_DIR, spec['notebook']))
+    inputs = [p for p in spec['inputs'] if os.path.exists(p)]
+    return cache.input_hash(list(inputs) + code, name=name, params=spec.get('params', {}))
+
+
+def _state_path(name):
+    return cache.cache_path('figures', name, '.json')
+
+
+def is_current(name):
+    '''True when the outputs of a figure exist and its key did not change.'''
+    spec = FIGURES[name]
+    try:
+        with open(_state_path(name)) as fh:
+            recorded = json.load(fh)['key']
+    except (IOError, ValueError, KeyError):
+        return False
+    return recorded == _key(name, spec) and all(os.path.exists(p) for p in spec['outputs'])
+
+
+def _render(name):
+    '''Worker: render one figure with the Agg backend and record its key.'''
+    import matplotlib
+    matplotlib.use('Agg')
+    spec = FIGURES[name]
+    key = _key(name, spec)
+    if 'notebook' in spec:
+        from pipeline import run_notebook
+        os.environ['MPLBACKEND'] = 'Agg'
+        run_notebook(os.path.join(NOTEBOOK_DIR, spec['notebook']))
+    else:
+        import matplotlib.pyplot as plt
+        fig = globals()[spec['func']](**spec.get('params', {}))
+        plt.close(fig)
+    with cache.atomic_write(_state_path(name)) as tmp:
+        with open(tmp, 'w') as fh:
+            json.dump({'key': key}, fh)
+    return name
+
+
+def render(names=None, force=False, workers=None):
+    '''
+    Function to render the figures whose inputs, code or style changed.
+
+    Parameters:
+        - names: figures of FIGURES (default: all).
+        - force: render even if up to date.
+        - workers: number of worker processes (default: all cores).
+
+    Returns:
+        - rendered: names of the figures rendered.
+    '''
+    names = sorted(FIGURES) if names is None else list(names)
+    for name in names:
+        if name not in FIGURES:
+            raise KeyError('Unknown figure %r' % name)
+    todo = [n for n in names if force or not is_current(n)]
+    if not todo:
+        return []
+    if not os.path.isdir(PLOT_DIR):
+        os.makedirs(PLOT_DIR, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_render, todo))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render the figures that are out of date.')
+    parser.add_argument('names', nargs='*', help='figures (default: all): %s' %
+                        ', '.join(sorted(FIGURES)))
+    parser.add_argument('--force', action='store_true', help='render even if up to date')
+    parser.add_argument('--workers', type=int, help='worker processes (default: all cores)')
+    args = parser.parse_args(argv)
+    for name in render(args.names or None, args.force, args.workers):
+        print('rendered %s' % name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+'''
+Indexed, column-projected access to the GAGES-II basin characteristic tables
+in ../data/basinchar_and_report_sept_2011/spreadsheets-in-csv-format.
+
+GAGES-II functions
+==================
+
+    - Gages2Store: Consolidated store of all tables of a region keyed by STAID.
+    - load:        Read selected columns for a set of STAIDs.
+    - describe:    Variable description rows from variable_descriptions.txt.
+
+On first use every table of the region is parsed once, columns are typed
+from the STORAGE TYPE given in variable_descriptions.txt, rows are aligned
+on a sorted STAID index and each column is written to its own .npy file
+under data/cache/gages2, one store per folder and region. Later queries
+memory-map only the requested columns and locate rows by binary search on
+the STAID index, so no table is scanned.
+
+Examples
+--------
+
+    >>> dams = load(['NDAMS_2009'])
+    >>> climate = load(['SNOW_PCT_PRECIP', 'PPTAVG_BASIN'], staids=[11475560, 11180825])
+
+'''
+
+import glob
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+import cache
+
+GAGES_DIR = os.path.join(cache.DATA_DIR, 'basinchar_and_report_sept_2011',
+                         'spreadsheets-in-csv-format')
+DESCRIPTIONS = 'variable_descriptions.txt'
+ENCODING = 'latin-1'
+
+# numpy types used for the STORAGE TYPE values of variable_descriptions.txt
+_STORAGE_TYPES = {'Floating point': 'float64', 'Integer': 'int64', 'Character': 'str'}
+_RANGE = re.compile(r'^([A-Za-z_]*?)(\d+)(\w*)\s+(?:through|thru)\s+[A-Za-z_]*?(\d+)', re.I)
+
+
+def _expand_names(name):
+    '''
+    Expand range entries such as "wy1900 through wy2009 (110 values)" into the
+    individual column names they describe.
+    '''
+    match = _RANGE.match(name)
+    if match is None:
+        return [name.strip()]
+    prefix, start, suffix, end = match.groups()
+    return ['%s%d%s' % (prefix, i, suffix) for i in range(int(start), int(end) + 1)]
+
+
+def describe(folder=GAGES_DIR):
+    '''
+    Function to read variable_descriptions.txt with range entries expanded,
+    one row per column name.
+
+    Returns:
+        - desc: DataFrame indexed by column name (VARIABLE_NAME).
+    '''
+    desc = pd.read_csv(os.path.join(folder, DESCRIPTIONS), encoding=ENCODING)
+    rows = []
+    for _, row in desc.iterrows():
+        for name in _expand_names(row.VARIABLE_NAME):
+            rows.append(row.copy())
+            rows[-1]['VARIABLE_NAME'] = name
+    desc = pd.DataFrame(rows)
+    return desc.drop_duplicates('VARIABLE_NAME').set_index('VARIABLE_NAME')
+
+
+def _signature(files):
+    '''Cheap signature of the source tables: names, sizes and mtimes.'''
+    return [[os.path.basename(f), os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in files]
+
+
+def _typed(values, kind):
+    '''Convert a parsed column to the storage type from the descriptions.'''
+    if kind == 'str':
+        return np.asarray(values.fillna('').astype(str).values, dtype='U')
+    numeric = pd.to_numeric(values, errors='coerce')
+    if kind == 'int64' and not numeric.isnull().any():
+        return numeric.values.astype('int64')
+    return numeric.values.astype('float64')
+
+
+class Gages2Store(object):
+    '''
+    Consolidated, memory-mapped store of the GAGES-II tables of one region
+    ('conterm' or 'AKHIPR').
+
+    Parameters:
+        - folder: directory holding the GAGES-II csv text tables.
+        - region: table prefix.
+
+    Columns are named as in the source tables. A column name that appears in
+    more than one table (e.g. DRAIN_SQKM) keeps its bare name for the first
+    table, alphabetically, and is stored as "table:NAME" for the others.
+    '''
+
+    def __init__(self, folder=GAGES_DIR, region='conterm'):
+        self.folder = folder
+        self.region = region
+        self.files = sorted(f for f in glob.glob(os.path.join(folder, region + '_*.txt'))
+                            if not f.endswith('x_region_names.txt'))
+        # keyed by folder too, so stores of same-named regions in other folders stay apart
+        where = hashlib.sha1(os.path.abspath(folder).encode()).hexdigest()[:12]
+        self.path = cache.cache_path('gages2', region + '.' + where)
+        self._maps = {}
+        self.meta = self._load_meta()
+        if self.meta is None or self.meta['signature'] != _signature(self.files):
+            self.build()
+        self.staid = np.load(os.path.join(self.path, 'STAID.npy'))
+
+    def _load_meta(self):
+        try:
+            with open(os.path.join(self.path, 'meta.json')) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return None
+
+    def build(self):
+        '''
+        Parse every table once and write the consolidated column store.
+        '''
+        desc = describe(self.folder)
+        kinds = desc['STORAGE TYPE'].map(_STORAGE_TYPES).to_dict()
+        tables = []
+        for f in self.files:
+            table = pd.read_csv(f, dtype=str, encoding=ENCODING)
+            table = table.loc[:, ~table.columns.str.startswith('Unnamed:')]
+            table['STAID'] = table.STAID.astype('int64')
+            tables.append((os.path.basename(f)[len(self.region) + 1:-4], table.set_index('STAID')))
+        staid = np.unique(np.concatenate([t.index.values for _, t in tables]))
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        columns = {}
+        for name, table in tables:
+            table = table.reindex(staid)
+            for col in table.columns:
+                key = col if col not in columns else '%s:%s' % (name, col)
+                values = _typed(table[col], kinds.get(col, 'float64'))
+                columns[key] = {'table': name, 'file': '%d.npy' % len(columns),
+                                'dtype': str(values.dtype)}
+                self._save(columns[key]['file'], values)
+        self._save('STAID.npy', staid)
+        self.meta = {'signature': _signature(self.files), 'columns': columns}
+        # meta is written last: its presence marks a complete store
+        with cache.atomic_write(os.path.join(self.path, 'meta.json')) as tmp:
+            with open(tmp, 'w') as fh:
+                json.dump(self.meta, fh)
+        self._maps = {}
+
+    def _save(self, name, values):
+        with cache.atomic_write(os.path.join(self.path, name)) as tmp:
+            with open(tmp, 'wb') as fh:
+                np.save(fh, values)
+
+    @property
+    def columns(self):
+        '''Names of all stored columns.'''
+        return list(self.meta['columns'])
+
+    def tables(self):
+        '''Mapping of table name to the list of its stored columns.'''
+        out = {}
+        for col, info in self.meta['columns'].items():
+            out.setdefault(info['table'], []).append(col)
+        return out
+
+    def _column(self, name):
+        if name not in self._maps:
+            try:
+                info = self.meta['columns'][name]
+            except KeyError:
+                raise KeyError('%s is not a GAGES-II %s column' % (name, self.region))
+            self._maps[name] = np.load(os.path.join(self.path, info['file']), mmap_mode='r')
+        return self._maps[name]
+
+    def rows(self, staids):
+        '''
+        Positions of ``staids`` in the store, found by binary search. STAIDs
+        may be given as integers or (zero-padded) strings; unknown STAIDs are
+        dropped.
+        '''
+        staids = np.asarray([int(s) for s in staids], dtype='int64')
+        pos = np.searchsorted(self.staid, staids)
+        pos = np.clip(pos, 0, len(self.staid) - 1)
+        return pos[self.staid[pos] == staids]
+
+    def query(self, columns, staids=None):
+        '''
+        Function to read selected columns for a set of basins.
+
+        Parameters:
+            - columns: column name or list of column names.
+            - staids: iterable of STAIDs, or None for all basins.
+
+        Returns:
+            - df: DataFrame indexed by integer STAID, one typed column per
+              requested column.
+        '''
+        if isinstance(columns, str):
+            columns = [columns]
+        if staids is None:
+            pos = slice(None)
+        else:
+            pos = self.rows(staids)
+        data = {}
+        for col in columns:
+            data[col] = np.array(self._column(col)[pos])
+        index = pd.Index(self.staid[pos], name='STAID')
+        return pd.DataFrame(data, index=index, columns=columns)
+
+
+_stores = {}
+
+
+def load(columns, staids=None, region='conterm'):
+    '''
+    Function to read GAGES-II columns through a shared, process-wide store.
+
+    Parameters:
+        - columns: column name or list of column names.
+        - staids: iterable of STAIDs, or None for all basins.
+        - region: 'conterm' (default) or 'AKHIPR'.
+
+    Returns:
+        - df: DataFrame indexed by integer STAID.
+    '''
+    if region not in _stores:
+        _stores[region] = Gages2Store(region=region)
+    return _stores[region].query(columns, staids)
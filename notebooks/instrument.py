@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+'''
+Switchable timing and memory instrumentation of the processing code.
+
+Instrument functions
+====================
+
+    - enable:  Start tracing into a run folder (also in child processes).
+    - disable: Stop tracing and restore meteolib/evaplib.
+    - span:    Context manager timing one block, with item counts.
+    - load:    Read the records of a run.
+    - summary: Totals per span name.
+    - report:  Write trace.json and summary.csv of a run.
+
+Every span records its wall time, CPU time of the process, peak resident
+memory of the process so far, bytes read by the process during the span
+(Linux only) and item counts such as sites, months or pixels. Spans nest
+per thread; each record names its parent.
+
+Pipeline stages, zonal extraction, table reads and the water-year
+aggregation open spans themselves. While tracing is enabled, every public
+function of meteolib and evaplib is wrapped as well and restored on
+``disable``, so those libraries are untouched otherwise. When tracing is
+off, ``span`` returns a shared no-op object, so instrumented code only pays
+one function call.
+
+A run is a folder under data/cache/trace. Each process appends its records
+to its own JSON-lines file there as spans close. ``enable`` exports the run
+folder in the STORAGE_TRACE environment variable, so worker processes and
+notebook kernels started by the pipeline trace into the same run. Setting
+STORAGE_TRACE before starting Python enables tracing at import.
+
+Examples
+--------
+
+    >>> run = enable()
+    >>> Pipeline(STAGES).run(['precip'], force=True)
+    >>> disable()
+    >>> report(run)
+
+    From the shell, for a whole pipeline run including its notebooks:
+
+        $ STORAGE_TRACE=../data/cache/trace/rerun python -c "import pipeline; pipeline.Pipeline(pipeline.STAGES).run()"
+
+'''
+
+import functools
+import glob
+import inspect
+import json
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+
+import cache
+
+ENV = 'STORAGE_TRACE'
+TRACE_DIR = os.path.join(cache.CACHE_DIR, 'trace')
+# third party libraries whose public functions are wrapped while tracing
+LIBRARIES = ('meteolib', 'evaplib')
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_state = {'enabled': False, 'run': None, 'pid': None, 'file': None, 'patched': {}}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def _peak_rss():
+    '''Peak resident set size of the process [bytes], None where unknown.'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def _bytes_read():
+    '''Bytes read by the process so far (Linux /proc/self/io), None elsewhere.'''
+    try:
+        with open('/proc/self/io') as fh:
+            for line in fh:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        return None
+
+
+class _NullSpan(object):
+    '''Span used while tracing is off.'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def count(self, **items):
+        pass
+
+
+_NULL = _NullSpan()
+
+
+class _Span(object):
+
+    def __init__(self, name, items):
+        self.name = name
+        self.items = items
+
+    def count(self, **items):
+        '''Add item counts known only once the work is done.'''
+        self.items.update(items)
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.read = _bytes_read()
+        self.cpu = time.process_time()
+        self.start = time.time()
+        self.clock = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.clock
+        cpu = time.process_time() - self.cpu
+        read = _bytes_read()
+        _local.stack.pop()
+        record = {'name': self.name, 'parent': self.parent, 'start': self.start,
+                  'wall': wall, 'cpu': cpu, 'peak_rss': _peak_rss(),
+                  'bytes_read': None if read is None or self.read is None else read - self.read,
+                  'items': self.items, 'pid': os.getpid(),
+                  'thread': threading.current_thread().name,
+                  'error': None if exc_type is None else exc_type.__name__}
+        _write(record)
+        return False
+
+
+def _write(record):
+    with _lock:
+        if not _state['enabled']:
+            return
+        if _state['pid'] != os.getpid():
+            # first record of this process (e.g. a forked worker)
+            name = '%s-%d.jsonl' % (socket.gethostname(), os.getpid())
+            _state['file'] = open(os.path.join(_state['run'], name), 'a')
+            _state['pid'] = os.getpid()
+        _state['file'].write(json.dumps(record, default=str) + '\n')
+        _state['file'].flush()
+
+
+def span(name, **items):
+    '''
+    Function to open a span around a block of work.
+
+    Parameters:
+        - name: span name, e.g. 'zonal.zonal_means' or 'stage:precip'.
+        - items: item counts, e.g. sites=25, months=216.
+
+    Returns:
+        - span: context manager; ``span.count(**items)`` adds counts.
+
+    Examples
+    --------
+
+        >>> with span('csv', files=len(paths)) as sp:
+        ...     rows = parse(paths)
+        ...     sp.count(rows=len(rows))
+    '''
+    if not _state['enabled']:
+        return _NULL
+    return _Span(name, items)
+
+
+def _wrap(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _state['enabled']:
+            return func(*args, **kwargs)
+        size = int(np.size(args[0])) if args else None
+        with _Span(name, {'values': size}):
+            return func(*args, **kwargs)
+    wrapper.__wrapped_by_instrument__ = func
+    return wrapper
+
+
+def _patch():
+    for lib in LIBRARIES:
+        module = __import__(lib)
+        for attr, func in inspect.getmembers(module, inspect.isfunction):
+            if attr.startswith('_') or func.__module__ != lib or attr == lib:
+                continue
+            if hasattr(func, '__wrapped_by_instrument__'):
+                continue
+            _state['patched'][(lib, attr)] = func
+            setattr(module, attr, _wrap('%s.%s' % (lib, attr), func))
+
+
+def _unpatch():
+    for (lib, attr), func in _state['patched'].items():
+        setattr(__import__(lib), attr, func)
+    _state['patched'] = {}
+
+
+def enable(run=None):
+    '''
+    Function to start tracing.
+
+    Parameters:
+        - run: run folder (default: a new folder named by the start time
+          under data/cache/trace).
+
+    Returns:
+        - run: the run folder.
+    '''
+    if run is None:
+        run = os.path.join(TRACE_DIR, time.strftime('%Y%m%d-%H%M%S'))
+    if not os.path.isdir(run):
+        os.makedirs(run, exist_ok=True)
+    with _lock:
+        _state.update(enabled=True, run=os.path.abspath(run), pid=None, file=None)
+    os.environ[ENV] = _state['run']
+    _patch()
+    return _state['run']
+
+
+def disable():
+    '''
+    Function to stop tracing and restore the wrapped library functions.
+    '''
+    with _lock:
+        _state['enabled'] = False
+        if _state['file'] is not None:
+            _state['file'].close()
+        _state.update(file=None, pid=None)
+    os.environ.pop(ENV, None)
+    _unpatch()
+
+
+def load(run):
+    '''
+    Function to read the records of all processes of a run.
+
+    Returns:
+        - records: list of span records, ordered by start time.
+    '''
+    records = []
+    for path in glob.glob(os.path.join(run, '*.jsonl')):
+        with open(path) as fh:
+            records.extend(json.loads(line) for line in fh if line.strip())
+    return sorted(records, key=lambda r: r['start'])
+
+
+def summary(records):
+    '''
+    Function to total the records per span name.
+
+    Returns:
+        - table: DataFrame indexed by span name with calls, wall and CPU
+          time [s], the largest peak RSS [MB], bytes read [MB] and the
+          summed item counts, sorted by wall time.
+    '''
+    import pandas as pd
+    rows = []
+    for r in records:
+        row = {'name': r['name'], 'calls': 1, 'wall_s': r['wall'], 'cpu_s': r['cpu'],
+               'peak_rss_mb': (r['peak_rss'] or 0) / 2.0 ** 20,
+               'read_mb': (r['bytes_read'] or 0) / 2.0 ** 20,
+               'errors': int(r['error'] is not None)}
+        for key, value in (r['items'] or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                row[key] = value
+        rows.append(row)
+    if not rows:
+        return pd.DataFrame(columns=['calls', 'wall_s', 'cpu_s', 'peak_rss_mb', 'read_mb'])
+    df = pd.DataFrame(rows)
+    # item counts stay empty for spans that do not count them
+    agg = dict((c, lambda v: v.sum(min_count=1)) for c in df.columns if c != 'name')
+    agg['peak_rss_mb'] = 'max'
+    return df.groupby('name').agg(agg).sort_values('wall_s', ascending=False)
+
+
+def report(run):
+    '''
+    Function to write the trace of a run as one JSON file (trace.json) and
+    its summary table (summary.csv) into the run folder.
+
+    Returns:
+        - table: the summary table.
+    '''
+    records = load(run)
+    with cache.atomic_write(os.path.join(run, 'trace.json')) as tmp:
+        with open(tmp, 'w') as fh:
+            json.dump({'run': os.path.basename(os.path.normpath(run)), 'spans': records},
+                      fh, indent=1)
+    table = summary(records)
+    table.to_csv(os.path.join(run, 'summary.csv'))
+    return table
+
+
+if os.environ.get(ENV):
+    enable(os.environ[ENV])
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+'''
+In-season monitoring of winter storage: running per-site accumulators of
+precipitation, discharge and ET, updated one month at a time, with storage
+percentiles and an expected summer EVI band.
+
+Monitor functions
+=================
+
+    - winter_months:  The winter months of a water year (as in sensitivity.py).
+    - History:        Historical winter accumulations and summer EVI of every site.
+    - build_history:  Summarise past water years from the monthly tables.
+    - load_history:   The history of a range of water years, built once and cached.
+    - sensitivities:  Per-site EVI sensitivity (Spearman rho) of a recorded run.
+    - evi_band:       Expected summer EVI band from a driver percentile and rho.
+    - Monitor:        Accumulators of one water year; ``update`` per month, ``report``.
+    - main:           Command-line entry point.
+
+The monitor keeps cumulative winter P, Q and ET per site. ``update`` adds
+one month, which takes O(sites) work. Storage after month t is
+S = P - Q - ET accumulated from Oct 1, as in ``sensitivity.seasonal_totals``.
+Missing values count as zero in the totals. Storage is NaN in a month where
+one of its terms is missing, so after March the monitor gives the s_end
+of the batch analysis.
+
+Past years are summarised once by ``load_history`` (data/cache/monitor, keyed by
+the monthly tables): the accumulations at the end of every winter month and
+the mean summer EVI of every historical year. The report compares the
+current values with the historical ones at the same month of the winter,
+never with end-of-winter values.
+
+The expected summer EVI band uses the per-site rho of summer EVI against
+winter precipitation recorded in the results store (resultstore.py). The
+rank association is taken as a Gaussian copula, with Pearson r =
+2 sin(pi rho / 6). Given the current precipitation percentile u, the normal
+score of summer EVI is N(r z(u), 1 - r^2). Its quantiles are mapped back
+through the historical summer EVI of the site. With rho = 0 the band is the
+historical range. Sites that are strongly limited by storage get a band
+that follows their winter.
+
+The state of a water year (accumulators and months seen) is saved under
+data/cache/monitor, so a new month can be added in a later session.
+
+Examples
+--------
+
+    >>> mon = Monitor.load(2014)
+    >>> mon.update('2014-02', precip=p_feb, discharge=q_feb, et=et_feb)
+    >>> mon.save()
+    >>> mon.report().sort_values('storage_pct')
+
+    From the notebooks folder, feeding every winter month of water year
+    2014 found in the monthly tables that was not fed before:
+
+        $ python monitor.py 2014 --band 0.1 0.9
+
+'''
+
+import argparse
+import json
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import cache
+import sensitivity
+
+STATE_DIR = os.path.join(cache.CACHE_DIR, 'monitor')
+# variables accumulated over the winter and their monthly tables
+VARIABLES = (('p', 'precip'), ('q', 'discharge'), ('et', 'et'))
+
+
+def winter_months(wy):
+    '''
+    Function to list the winter months of a water year, from the season
+    limits of sensitivity.py (Oct - Mar).
+
+    Returns:
+        - months: DatetimeIndex of month starts.
+    '''
+    start = pd.to_datetime(sensitivity.WINTER_START + str(wy - 1))
+    end = pd.to_datetime(sensitivity.WINTER_END + str(wy))
+    return pd.date_range(start, end, freq='MS')
+
+
+def _percentile(ensemble, values):
+    '''Percentile [0, 100] of ``values`` (site) in ``ensemble`` (year x site), ties counted half.'''
+    valid = ~np.isnan(ensemble)
+    with np.errstate(invalid='ignore'):
+        below = (valid & (ensemble < values)).sum(axis=0)
+        equal = (valid & (ensemble == values)).sum(axis=0)
+    n = valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pct = 100.0 * (below + 0.5 * equal) / n
+    return np.where((n > 0) & ~np.isnan(values), pct, np.nan)
+
+
+class History(object):
+    '''
+    Historical winter accumulations and summer EVI.
+
+    Parameters:
+        - water_years: historical water years.
+        - sites: site ids.
+        - totals: dict 'p', 'q', 'et', 's' -> array (year x winter month x
+          site) of the values accumulated through every winter month.
+        - evi: array (year x site) of mean summer EVI.
+    '''
+
+    def __init__(self, water_years, sites, totals, evi):
+        self.water_years = [int(y) for y in water_years]
+        self.sites = [str(s) for s in sites]
+        self.totals = totals
+        self.evi = evi
+
+
+def _accumulate(monthly):
+    '''Running totals over axis 1 with missing months as zero, NaN where the month is missing.'''
+    totals = np.nancumsum(monthly, axis=1)
+    totals[np.isnan(monthly)] = np.nan
+    return totals
+
+
+def build_history(tables, water_years):
+    '''
+    Function to summarise past water years from the monthly tables.
+
+    Parameters:
+        - tables: dict from ``sensitivity.load_tables``.
+        - water_years: historical water years.
+
+    Returns:
+        - history: History.
+    '''
+    sites = list(tables['precip'].columns)
+    monthly = dict((name, []) for name, _ in VARIABLES)
+    evi = []
+    for wy in water_years:
+        months = winter_months(wy)
+        for name, table in VARIABLES:
+            monthly[name].append(tables[table].reindex(index=months, columns=sites).values)
+        evi.append(sensitivity.water_year(tables, wy)['summerevi'].mean()
+                   .reindex(sites).values)
+    totals = dict((name, _accumulate(np.array(values, dtype='float64')))
+                  for name, values in monthly.items())
+    totals['s'] = totals['p'] - totals['q'] - totals['et']
+    return History(water_years, sites, totals, np.array(evi, dtype='float64'))
+
+
+def load_history(water_years=(2002, 2013), data_dir=cache.DATA_DIR):
+    '''
+    Function to load the history of a range of water years, building it
+    only when the monthly tables changed.
+
+    Parameters:
+        - water_years: first and last water year (inclusive).
+        - data_dir: folder of the monthly site tables.
+
+    Returns:
+        - history: History.
+    '''
+    names = [table for _, table in VARIABLES] + ['evi']
+    paths = [os.path.join(data_dir, sensitivity.TABLES[n]) for n in names]
+    years = list(range(int(water_years[0]), int(water_years[1]) + 1))
+    path = cache.cache_path('monitor', 'history-' + cache.input_hash(
+        paths, water_years=years, winter=[sensitivity.WINTER_START, sensitivity.WINTER_END],
+        summer=sensitivity.SUMMER_END), '.npz')
+    if os.path.exists(path):
+        with np.load(path) as npz:
+            totals = dict((name, npz[name]) for name in ('p', 'q', 'et', 's'))
+            return History(npz['water_years'], list(npz['sites']), totals, npz['evi'])
+    result = build_history(sensitivity.load_tables(data_dir, names), years)
+    with cache.atomic_write(path) as tmp:
+        with open(tmp, 'wb') as fh:
+            np.savez(fh, water_years=np.array(result.water_years), sites=np.array(result.sites),
+                     evi=result.evi, **result.totals)
+    return result
+
+
+def sensitivities(run=None, path=None):
+    '''
+    Function to read the per-site sensitivity of summer EVI to winter
+    precipitation from the results store.
+
+    Parameters:
+        - run: run number (default: the latest run of p_winter vs evi_summer).
+        - path: store file (default: data/results.h5).
+
+    Returns:
+        - rho: Series of Spearman rho indexed by site id.
+        - run: the run's row of ``resultstore.runs`` (water years, label, ...).
+    '''
+    import resultstore
+    path = resultstore.STORE if path is None else path
+    recorded = resultstore.runs(path, driver='p_winter', response='evi_summer')
+    if not len(recorded):
+        raise ValueError('No p_winter / evi_summer run in %s; record one with sensitivity.py'
+                         % path)
+    run = recorded.index.max() if run is None else run
+    results = resultstore.run_results(run, path, variable='EVI')
+    return pd.Series(results.rho.values, index=results.site.values), recorded.loc[run]
+
+
+def evi_band(u, rho, evi, band=(0.1, 0.9)):
+    '''
+    Function to compute the expected summer EVI band of every site.
+
+    Parameters:
+        - u: array (site) of driver percentiles as fractions (0, 1).
+        - rho: array (site) of Spearman rho of summer EVI against the driver.
+        - evi: array (year x site) of historical summer EVI.
+        - band: lower and upper probability of the band.
+
+    Returns:
+        - low, median, high: arrays (site) of summer EVI.
+    '''
+    n = np.maximum((~np.isnan(evi)).sum(axis=0), 1)
+    u = np.clip(u, 0.5 / n, 1 - 0.5 / n)
+    r = 2 * np.sin(np.pi * np.asarray(rho, dtype='float64') / 6)
+    z = stats.norm.ppf(u)
+    out = []
+    for q in (band[0], 0.5, band[1]):
+        conditional = stats.norm.cdf(r * z + np.sqrt(1 - r ** 2) * stats.norm.ppf(q))
+        values = np.full(evi.shape[1], np.nan)
+        for j in np.flatnonzero(~np.isnan(conditional) & ~np.all(np.isnan(evi), axis=0)):
+            values[j] = np.nanpercentile(evi[:, j], 100 * conditional[j])
+        out.append(values)
+    return tuple(out)
+
+
+class Monitor(object):
+    '''
+    Running winter accumulators of one water year.
+
+    Parameters:
+        - water_year: water year monitored, e.g. 2014 for Oct 2013 - Sep 2014.
+        - sites: site ids.
+    '''
+
+    def __init__(self, water_year, sites):
+        self.water_year = int(water_year)
+        self.sites = [str(s) for s in sites]
+        self.months = []
+        n = len(self.sites)
+        # running totals (missing months as zero) and whether the last month had a value
+        self.totals = dict((name, np.zeros(n)) for name, _ in VARIABLES)
+        self.current = dict((name, np.zeros(n, dtype=bool)) for name, _ in VARIABLES)
+
+    @staticmethod
+    def path(water_year, folder=STATE_DIR):
+        return os.path.join(folder, 'wy%d.json' % water_year)
+
+    @classmethod
+    def load(cls, water_year, sites=None, folder=STATE_DIR):
+        '''
+        Function to load the saved state of a water year, or start a new one.
+
+        Parameters:
+            - water_year: water year.
+            - sites: site ids of a new state (default: the precip table columns).
+            - folder: folder of the saved states.
+
+        Returns:
+            - monitor: Monitor.
+        '''
+        path = cls.path(water_year, folder)
+        if not os.path.exists(path):
+            if sites is None:
+                sites = sensitivity.load_tables(names=('precip',))['precip'].columns
+            return cls(water_year, sites)
+        with open(path) as fh:
+            state = json.load(fh)
+        monitor = cls(state['water_year'], state['sites'])
+        monitor.months = [pd.Timestamp(m) for m in state['months']]
+        for name, _ in VARIABLES:
+            monitor.totals[name] = np.array(state['totals'][name], dtype='float64')
+            monitor.current[name] = np.array(state['current'][name], dtype=bool)
+        return monitor
+
+    def save(self, folder=STATE_DIR):
+        '''Function to save the state under ``folder`` (one JSON file per water year).'''
+        state = {'water_year': self.water_year, 'sites': self.sites,
+                 'months': [m.strftime('%Y-%m-%d') for m in self.months],
+                 'totals': dict((k, v.tolist()) for k, v in self.totals.items()),
+                 'current': dict((k, v.tolist()) for k, v in self.current.items())}
+        path = self.path(self.water_year, folder)
+        with cache.atomic_write(path) as tmp:
+            with open(tmp, 'w') as fh:
+                json.dump(state, fh)
+
+    def next_month(self):
+        '''The next winter month to add, or None after March.'''
+        months = winter_months(self.water_year)
+        return months[len(self.months)] if len(self.months) < len(months) else None
+
+    def update(self, month, precip, discharge, et):
+        '''
+        Function to add one month of data.
+
+        Parameters:
+            - month: the month (any date in it); must be ``next_month()``.
+            - precip, discharge, et: monthly values [mm], Series indexed by
+              site id (missing sites count as missing values) or arrays in
+              the order of ``sites``.
+        '''
+        expected = self.next_month()
+        month = pd.Timestamp(month).to_period('M').to_timestamp()
+        if expected is None:
+            raise ValueError('The winter of water year %d is complete' % self.water_year)
+        if month != expected:
+            raise ValueError('Expected data for %s, got %s' % (expected.strftime('%Y-%m'),
+                                                               month.strftime('%Y-%m')))
+        for (name, _), values in zip(VARIABLES, (precip, discharge, et)):
+            if isinstance(values, pd.Series):
+                values = values.reindex(self.sites).values
+            values = np.asarray(values, dtype='float64')
+            valid = ~np.isnan(values)
+            self.totals[name] += np.where(valid, values, 0.0)
+            self.current[name] = valid
+        self.months.append(month)
+
+    def storage(self):
+        '''Current storage P - Q - ET [mm] per site (NaN where this month has a missing term).'''
+        s = self.totals['p'] - self.totals['q'] - self.totals['et']
+        valid = self.current['p'] & self.current['q'] & self.current['et']
+        return np.where(valid, s, np.nan)
+
+    def report(self, history=None, rho=None, band=(0.1, 0.9)):
+        '''
+        Function to report the current state against the history.
+
+        Parameters:
+            - history: History (default: that of the water years of the
+              sensitivity run).
+            - rho: Series of EVI sensitivity by site (default: ``sensitivities()``).
+            - band: lower and upper probability of the summer EVI band.
+
+        Returns:
+            - report: DataFrame indexed by site with the months fed, winter
+              totals p, q, et, storage, percentiles of storage and
+              precipitation, the historical median storage at this month,
+              rho and the summer EVI band (evi_low, evi_median, evi_high).
+        '''
+        if not self.months:
+            raise ValueError('No month of water year %d was added yet' % self.water_year)
+        if rho is None or history is None:
+            found, config = sensitivities()
+            rho = found if rho is None else rho
+            if history is None:
+                history = load_history((config.first_year, config.last_year))
+        step = len(self.months) - 1
+        position = dict((s, i) for i, s in enumerate(history.sites))
+        columns = [position.get(s, -1) for s in self.sites]
+        known = np.array(columns) >= 0
+
+        def aligned(values):
+            # history arrays (... x history site) -> (... x monitored site)
+            out = np.take(values, np.maximum(columns, 0), axis=-1)
+            out[..., ~known] = np.nan
+            return out
+
+        storage = self.storage()
+        s_hist = aligned(history.totals['s'][:, step])
+        p_hist = aligned(history.totals['p'][:, step])
+        p_pct = _percentile(p_hist, self.totals['p'])
+        sens = pd.Series(rho).reindex(self.sites).values.astype('float64')
+        low, median, high = evi_band(p_pct / 100.0, sens, aligned(history.evi), band)
+        with warnings.catch_warnings():
+            # sites without history (all NaN) get a NaN median
+            warnings.simplefilter('ignore', RuntimeWarning)
+            s_median = np.nanmedian(s_hist, axis=0)
+        return pd.DataFrame({'months': len(self.months), 'p': self.totals['p'],
+                             'q': self.totals['q'], 'et': self.totals['et'], 'storage': storage,
+                             'storage_pct': _percentile(s_hist, storage), 'p_pct': p_pct,
+                             'storage_median': s_median, 'rho': sens, 'evi_low': low,
+                             'evi_median': median, 'evi_high': high},
+                            index=pd.Index(self.sites, name='id'),
+                            columns=['months', 'p', 'q', 'et', 'storage', 'storage_pct', 'p_pct',
+                                     'storage_median', 'rho', 'evi_low', 'evi_median',
+                                     'evi_high'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Feed the new winter months of a water year and report storage and summer EVI.')
+    parser.add_argument('water_year', type=int, help='water year, e.g. 2014 for Oct 2013 - Sep 2014')
+    parser.add_argument('--data-dir', default=cache.DATA_DIR,
+                        help='folder with the monthly site tables')
+    parser.add_argument('--run', type=int, help='results store run of the EVI sensitivity')
+    parser.add_argument('--band', nargs=2, type=float, default=[0.1, 0.9], metavar=('LOW', 'HIGH'),
+                        help='probabilities of the summer EVI band (default 0.1 0.9)')
+    parser.add_argument('--reset', action='store_true', help='start the water year from October')
+    args = parser.parse_args(argv)
+    tables = sensitivity.load_tables(args.data_dir, ('precip', 'et', 'discharge'))
+    monitor = (Monitor(args.water_year, tables['precip'].columns) if args.reset else
+               Monitor.load(args.water_year, tables['precip'].columns))
+    month = monitor.next_month()
+    while month is not None and all(month in tables[t].index for _, t in VARIABLES):
+        monitor.update(month, *(tables[t].loc[month] for _, t in VARIABLES))
+        month = monitor.next_month()
+    monitor.save()
+    rho, config = sensitivities(args.run)
+    past = load_history((config.first_year, config.last_year), args.data_dir)
+    print(monitor.report(past, rho, args.band).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+'''
+Concurrent, incremental download of USGS NWIS daily discharge into the local
+../data/flow_data/<site>.csv cache.
+
+NWIS functions
+==============
+
+    - fetch_flows:    Bring the local flow files of many gauges up to date.
+    - read_flow:      Read one local flow file.
+    - missing_ranges: Date ranges of a request not yet covered locally.
+    - serve_fixtures: Local stand-in for the NWIS service serving RDB files.
+
+Gauges are fetched concurrently through a bounded connection pool. Only the
+date ranges not already requested for a gauge are downloaded; the requested
+coverage is recorded under data/cache/nwis so periods for which NWIS has no
+data are not requested again. Gauges without a record (e.g. on a fresh
+checkout) start from the first and last dates of their flow file. Failed
+requests are retried with exponential backoff and flow files are replaced
+atomically. Gauges that still fail are reported instead of being dropped
+silently.
+
+Examples
+--------
+
+    >>> flows, failed = fetch_flows(['11475560', '11180825'], '1980-01-01', '2018-12-31')
+
+'''
+
+import hashlib
+import io
+import json
+import os
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlencode, urlparse, parse_qs
+
+import pandas as pd
+import urllib3
+
+import cache
+import rdb
+
+FLOW_DIR = os.path.join(cache.DATA_DIR, 'flow_data')
+NWIS_DV_URL = 'https://waterdata.usgs.gov/nwis/dv'
+DISCHARGE = rdb.DISCHARGE
+
+_coverage_lock = threading.Lock()
+
+
+def _day(value):
+    return pd.Timestamp(value).normalize()
+
+
+def _query(site, begin, end):
+    return {'cb_%s' % DISCHARGE: 'on', 'format': 'rdb', 'site_no': site,
+            'referred_module': 'sw', 'period': '',
+            'begin_date': begin.strftime('%Y-%m-%d'), 'end_date': end.strftime('%Y-%m-%d')}
+
+
+def parse_rdb(lines, site):
+    '''
+    Function to parse an NWIS daily-values RDB response for one site.
+
+    Parameters:
+        - lines: iterable of RDB text lines (e.g. a text-wrapped response).
+        - site: USGS site number.
+
+    Returns:
+        - df: DataFrame indexed by date with float column ``q`` [cfs]; values
+          flagged with qualifier codes such as "Ice" or "Eqp" are NaN.
+    '''
+    daily = rdb.read_daily(lines, parameter=DISCHARGE)
+    if site not in daily:
+        return pd.DataFrame({'q': []}, index=pd.DatetimeIndex([], name='datetime'))
+    return rdb.to_frame(daily[site])
+
+
+def read_flow(site, folder=FLOW_DIR):
+    '''
+    Read the local flow file of ``site``; an empty frame if there is none.
+    '''
+    path = os.path.join(folder, site + '.csv')
+    if not os.path.exists(path):
+        return pd.DataFrame({'q': []}, index=pd.DatetimeIndex([], name='datetime'))
+    return pd.read_csv(path, parse_dates=True, index_col='datetime')
+
+
+def _coverage_path(folder):
+    '''Coverage record of a flow folder, one per folder.'''
+    key = hashlib.sha1(os.path.abspath(folder).encode()).hexdigest()[:16]
+    return cache.cache_path('nwis', 'coverage-' + key, '.json')
+
+
+def _load_coverage(folder):
+    try:
+        with open(_coverage_path(folder)) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+
+def _file_coverage(site, folder):
+    '''
+    First and last date of an existing flow file, or None: the coverage of
+    files that came with the repository, which have no coverage record.
+    '''
+    path = os.path.join(folder, site + '.csv')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as fh:
+        fh.readline()
+        first = fh.readline().split(b',')[0].strip()
+        if not first:
+            return None
+        fh.seek(max(os.path.getsize(path) - 1024, 0))
+        last = [l for l in fh.read().splitlines() if l.strip()][-1].split(b',')[0].strip()
+    return [first.decode(), last.decode()]
+
+
+def _save_coverage(folder, site, begin, end):
+    with _coverage_lock:
+        coverage = _load_coverage(folder)
+        coverage[site] = [begin.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')]
+        with cache.atomic_write(_coverage_path(folder)) as tmp:
+            with open(tmp, 'w') as fh:
+                json.dump(coverage, fh, indent=1, sort_keys=True)
+
+
+def missing_ranges(start, end, covered=None):
+    '''
+    Function to find the parts of the request [start, end] outside an
+    already covered period.
+
+    Parameters:
+        - start, end: requested period (inclusive).
+        - covered: (first, last) period already requested, or None.
+
+    Returns:
+        - ranges: list of (begin, end) Timestamps, at most two.
+    '''
+    start, end = _day(start), _day(end)
+    if covered is None:
+        return [(start, end)]
+    first, last = _day(covered[0]), _day(covered[1])
+    ranges = []
+    if start < first:
+        ranges.append((start, min(end, first - pd.Timedelta(days=1))))
+    if end > last:
+        ranges.append((max(start, last + pd.Timedelta(days=1)), end))
+    return ranges
+
+
+def _fetch_site(http, site, start, end, covered, folder, base_url):
+    '''
+    Worker: download the missing ranges of one site and merge them into
+    its flow file.
+    '''
+    start, end = _day(start), _day(end)
+    ranges = missing_ranges(start, end, covered)
+    if not ranges:
+        return read_flow(site, folder)
+    parts = [read_flow(site, folder)]
+    for begin, stop in ranges:
+        response = http.request('GET', base_url + '?' + urlencode(_query(site, begin, stop)),
+                                preload_content=False)
+        # keep the stream open until the text wrapper has read it to the end
+        response.auto_close = False
+        try:
+            if response.status != 200:
+                raise IOError('NWIS returned HTTP %d for site %s' % (response.status, site))
+            parts.append(parse_rdb(io.TextIOWrapper(response, encoding='utf-8'), site))
+        finally:
+            response.release_conn()
+    df = pd.concat(parts)
+    df = df[~df.index.duplicated(keep='last')].sort_index()
+    df.index.name = 'datetime'
+    with cache.atomic_write(os.path.join(folder, site + '.csv')) as tmp:
+        df.to_csv(tmp)
+    first = min([start] + ([_day(covered[0])] if covered else []))
+    last = max([end] + ([_day(covered[1])] if covered else []))
+    _save_coverage(folder, site, first, last)
+    return df
+
+
+def fetch_flows(sites, start, end, folder=FLOW_DIR, workers=8, retries=5,
+                backoff=0.5, timeout=60.0, base_url=NWIS_DV_URL):
+    '''
+    Function to bring the local daily flow files of many gauges up to date.
+
+    Parameters:
+        - sites: iterable of USGS site numbers (strings).
+        - start, end: period of interest (inclusive), anything pd.Timestamp accepts.
+        - folder: directory holding the <site>.csv flow files.
+        - workers: number of concurrent requests (size of the connection pool).
+        - retries: number of retries of a failed request.
+        - backoff: backoff factor [s]; retry i waits backoff * 2**(i-1).
+        - timeout: read timeout per request [s].
+        - base_url: NWIS daily values endpoint (or a local stand-in).
+
+    Returns:
+        - flows: dict site -> DataFrame with float column ``q`` [cfs].
+        - failed: dict site -> exception for gauges that could not be updated.
+    '''
+    retry = urllib3.util.Retry(total=retries, backoff_factor=backoff,
+                               status_forcelist=(429, 500, 502, 503, 504))
+    http = urllib3.PoolManager(maxsize=workers, block=True, retries=retry,
+                               timeout=urllib3.Timeout(connect=10.0, read=timeout))
+    coverage = _load_coverage(folder)
+    flows, failed = {}, {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for site in sites:
+            covered = coverage.get(site) or _file_coverage(site, folder)
+            futures[site] = pool.submit(_fetch_site, http, site, start, end, covered,
+                                        folder, base_url)
+        for site, future in futures.items():
+            try:
+                flows[site] = future.result()
+            except Exception as err:
+                failed[site] = err
+                warnings.warn('Could not update flow for site %s: %s' % (site, err))
+    return flows, failed
+
+
+class _FixtureHandler(BaseHTTPRequestHandler):
+    '''Serve <site>.rdb from the fixture folder, clipped to the requested dates.'''
+
+    folder = None
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        site = query.get('site_no', [''])[0]
+        path = os.path.join(self.folder, site + '.rdb')
+        if not os.path.exists(path):
+            self.send_error(404, 'No fixture for site %s' % site)
+            return
+        begin = query.get('begin_date', ['0000-00-00'])[0]
+        end = query.get('end_date', ['9999-99-99'])[0]
+        out = []
+        header = 0
+        with open(path) as fh:
+            for line in fh:
+                fields = line.split('\t')
+                if line.startswith('#') or header < 2:
+                    # comments, column names and column formats
+                    header += not line.startswith('#')
+                    out.append(line)
+                elif len(fields) > 2 and begin <= fields[2] <= end:
+                    out.append(line)
+        body = ''.join(out).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_fixtures(folder, port=0):
+    '''
+    Function to start a local stand-in for the NWIS daily values service, so
+    the fetcher can be exercised offline.
+
+    Parameters:
+        - folder: directory with one RDB file per site, named <site>.rdb.
+        - port: TCP port (0 picks a free one).
+
+    Returns:
+        - server: running HTTPServer; call ``server.shutdown()`` when done.
+        - url: base url to pass to ``fetch_flows``.
+    '''
+    handler = type('FixtureHandler', (_FixtureHandler,), {'folder': folder})
+    server = HTTPServer(('127.0.0.1', port), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/nwis/dv' % server.server_address[1]
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+'''
+Polygon overlay of basins with attribute layers, replacing the ArcGIS
+"Tabulate Intersection" tables used in basin screening.
+
+Overlay functions
+=================
+
+    - tabulate_intersection: Per-basin area and percentage by class attribute.
+    - logging_table:         Equivalent of the THP clearcut/commercial thin table.
+    - geology_table:         Equivalent of the basin/geology intersect table.
+    - dominant_class:        Largest-area class for every basin.
+
+Candidate class polygons are found with the layer's spatial index, basins are
+intersected in parallel worker processes and per-basin results are cached by
+a hash of the class layer and the basin geometry, so extending the table to
+new basins only computes the new ones.
+
+'''
+
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import geopandas as gp
+
+import cache
+
+# Output columns written by ArcGIS Tabulate Intersection
+AREA = 'AREA'
+PERCENTAGE = 'PERCENTAGE'
+
+
+def _geometry_digest(geom):
+    '''Digest of a basin geometry, used to key per-basin cache entries.'''
+    return hashlib.sha1(geom.wkb).hexdigest()
+
+
+def _intersect_basin(job):
+    '''
+    Worker: intersect one basin with its candidate class polygons.
+
+    Returns a list of (candidate position, intersection area) for the
+    candidates that actually overlap the basin.
+    '''
+    basin, candidates = job
+    out = []
+    for pos, geom in candidates:
+        if not geom.intersects(basin):
+            continue
+        area = geom.intersection(basin).area
+        if area > 0:
+            out.append((pos, area))
+    return out
+
+
+def tabulate_intersection(zones, zone_field, class_path, class_fields,
+                          zone_fields=(), workers=None, use_cache=True):
+    '''
+    Function to compute, for every zone polygon, the area and percentage of
+    the zone covered by each combination of class attributes. This mirrors
+    the ArcGIS Tabulate Intersection tool: overlapping class polygons are
+    each counted.
+
+    Parameters:
+        - zones: GeoDataFrame of basin polygons in a projected CRS.
+        - zone_field: column identifying a basin (e.g. SITE_NO).
+        - class_path: path of the class polygon layer (any OGR format).
+        - class_fields: list of class attribute columns to tabulate by.
+        - zone_fields: extra zone columns copied to the output (e.g. SQMI).
+        - workers: number of worker processes (default: all cores).
+        - use_cache: reuse per-basin results computed for the same layer.
+
+    Returns:
+        - table: DataFrame with zone_field, zone_fields, class_fields, AREA
+          (in squared units of the zone CRS) and PERCENTAGE of zone area.
+    '''
+    class_fields = list(class_fields)
+    zone_fields = list(zone_fields)
+    layer_key = cache.input_hash([class_path], fields=class_fields)
+    store = cache.cache_path('overlay', layer_key, '.pkl')
+    done = pd.read_pickle(store) if (use_cache and os.path.exists(store)) else {}
+
+    digests = [_geometry_digest(g) for g in zones.geometry]
+    todo = [i for i, d in enumerate(digests) if d not in done]
+
+    if todo:
+        classes = gp.read_file(class_path)[class_fields + ['geometry']]
+        if zones.crs is not None and classes.crs != zones.crs:
+            classes = classes.to_crs(zones.crs)
+        classes = classes[classes.geometry.notnull()].reset_index(drop=True)
+        geoms = classes.geometry.values
+        sindex = classes.sindex
+        jobs = []
+        for i in todo:
+            basin = zones.geometry.values[i]
+            cand = sorted(sindex.intersection(basin.bounds))
+            jobs.append((basin, [(pos, geoms[pos]) for pos in cand]))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            overlaps = list(pool.map(_intersect_basin, jobs, chunksize=max(1, len(jobs) // 64)))
+        attrs = classes[class_fields]
+        for i, hits in zip(todo, overlaps):
+            if hits:
+                pos, area = zip(*hits)
+                part = attrs.iloc[list(pos)].reset_index(drop=True)
+                part[AREA] = np.asarray(area)
+                part = part.groupby(class_fields, as_index=False, sort=False)[AREA].sum()
+            else:
+                part = pd.DataFrame(columns=class_fields + [AREA])
+            done[digests[i]] = part
+        if use_cache:
+            with cache.atomic_write(store) as tmp:
+                pd.to_pickle(done, tmp)
+
+    tables = []
+    for (_, row), digest in zip(zones.iterrows(), digests):
+        part = done[digest].copy()
+        if not len(part):
+            continue
+        part[PERCENTAGE] = 100.0 * part[AREA] / row.geometry.area
+        for col in reversed([zone_field] + zone_fields):
+            part.insert(0, col, row[col])
+        tables.append(part)
+    columns = [zone_field] + zone_fields + class_fields + [AREA, PERCENTAGE]
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(tables, ignore_index=True)[columns]
+
+
+def logging_table(zones, thp_path, workers=None):
+    '''
+    Function to build the equivalent of
+    ``Cal_USGS_Basins_TabulatedIntersection_THP_Clearcut_or_CommercialThin_Completed.csv``
+    from the statewide timber harvest plan layer
+    (ftp://ftp.fire.ca.gov/forest/Statewide_Timber_Harvest/), already
+    filtered to clearcut or commercial thin, completed plans.
+
+    Parameters:
+        - zones: GeoDataFrame of basins with SITE_NO and SQMI columns.
+        - thp_path: path of the timber harvest polygon layer.
+        - workers: number of worker processes.
+
+    Returns:
+        - table: DataFrame with SITE_NO, SQMI, COMP_DATE, AREA, PERCENTAGE.
+    '''
+    return tabulate_intersection(zones, 'SITE_NO', thp_path, ['COMP_DATE'],
+                                 zone_fields=['SQMI'], workers=workers)
+
+
+def geology_table(zones, geology_path, workers=None):
+    '''
+    Function to build the equivalent of ``StudyBasins_CalGeol_ArcGIS-Intersect.csv``
+    from the state geologic map polygons (Ludington et al., 2007).
+
+    Parameters:
+        - zones: GeoDataFrame of basins with SITE_NO and SQMI columns.
+        - geology_path: path of the geologic unit polygon layer.
+        - workers: number of worker processes.
+
+    Returns:
+        - table: DataFrame with SITE_NO, SQMI, UNIT_LINK, ROCKTYPE1, ROCKTYPE2,
+          Shape_Area (intersection area) and PERCENTAGE.
+    '''
+    table = tabulate_intersection(zones, 'SITE_NO', geology_path,
+                                  ['UNIT_LINK', 'ROCKTYPE1', 'ROCKTYPE2'],
+                                  zone_fields=['SQMI'], workers=workers)
+    return table.rename(columns={AREA: 'Shape_Area'})
+
+
+def dominant_class(table, zone_field, area_field=AREA):
+    '''
+    Return the largest-area row of ``table`` for every zone, e.g. the
+    dominant lithology of each basin.
+    '''
+    return table.sort_values(area_field, ascending=False).drop_duplicates([zone_field])
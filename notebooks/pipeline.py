@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+'''
+The study workflow as a pipeline of stages with declared inputs and outputs,
+rerun only where inputs changed.
+
+Pipeline functions
+==================
+
+    - Stage:    One step: a function or a notebook, its inputs, outputs and parameters.
+    - Pipeline: Dependency graph of stages; status, run and adopt.
+    - STAGES:   The stages of the study, from site polygons to figures.
+
+A stage is up to date when its outputs exist and the digest of its inputs
+(file contents, the stage's code or notebook, and its parameters) equals
+the digest recorded after its last successful run. Inputs may be glob
+patterns, so a new file (e.g. one more month of PRISM data) changes the
+digest. Stages depend on the stages producing their inputs and compare the
+contents of those outputs, so a rerun whose outputs did not change does not
+propagate further downstream. Independent stages run concurrently.
+
+The recorded digests live in data/cache/pipeline/state.json, together with
+file digests keyed by size and modification time, so unchanged large inputs
+are not hashed again. A stage whose inputs are not available locally keeps
+its existing outputs. ``adopt`` records the outputs that are already in the
+repository as current, so a fresh checkout does not recompute them.
+
+Examples
+--------
+
+    >>> pipe = Pipeline(STAGES)
+    >>> pipe.adopt()
+    >>> pipe.status()
+    >>> pipe.run()
+
+'''
+
+import fnmatch
+import glob
+import inspect
+import json
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import pandas as pd
+
+import cache
+import figures
+import instrument
+
+NOTEBOOK_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE = os.path.join(cache.CACHE_DIR, 'pipeline', 'state.json')
+
+# gauges of the study basins (download_and_extract_data.ipynb); Dry Creek is added
+STUDY_SITES = ['11154700', '11200800', '11299600', '11046360', '11180825', '11046300',
+               '11180960', '11182500', '11449500', '11379500', '11284400', '11224500',
+               '11253310', '11141280', '11151300', '11469000', '11111500', '11176400',
+               '11172945', '11132500', '11475800', '11134800', '11180900', '11475560',
+               '11476600']
+DRY_CREEK = '00000000'
+
+
+def _data(*parts):
+    return os.path.join(cache.DATA_DIR, *parts)
+
+
+class Stage(object):
+    '''
+    One pipeline step.
+
+    Parameters:
+        - name: stage name.
+        - inputs: input files or glob patterns.
+        - outputs: files the stage writes.
+        - func: function called as ``func(**params)``; its module's source is an input.
+        - notebook: notebook executed instead of ``func`` (it is an input itself).
+        - params: JSON serialisable parameters, part of the stage digest.
+        - code: further source files the stage depends on.
+    '''
+
+    def __init__(self, name, inputs=(), outputs=(), func=None, notebook=None, params=None,
+                 code=()):
+        if (func is None) == (notebook is None):
+            raise ValueError('Stage %s needs either a function or a notebook' % name)
+        self.name = name
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.func = func
+        self.notebook = notebook
+        self.params = dict(params or {})
+        self.code = [os.path.join(NOTEBOOK_DIR, c) for c in code]
+        if func is not None:
+            self.code.append(inspect.getsourcefile(func))
+        else:
+            self.code.append(os.path.join(NOTEBOOK_DIR, notebook))
+
+    def files(self):
+        '''Input files the stage reads (globs expanded) plus its code.'''
+        found = []
+        for pattern in self.inputs:
+            if glob.has_magic(pattern):
+                found.extend(sorted(glob.glob(pattern)))
+            else:
+                found.append(pattern)
+        return found + self.code
+
+    def run(self):
+        with instrument.span('stage:' + self.name, inputs=len(self.inputs)):
+            if self.func is not None:
+                return self.func(**self.params)
+            return run_notebook(os.path.join(NOTEBOOK_DIR, self.notebook))
+
+    def __repr__(self):
+        return 'Stage(%r)' % self.name
+
+
+def run_notebook(path, timeout=None):
+    '''
+    Function to execute a notebook headless in its own folder. The notebook
+    file itself is not modified; its effects are the files it writes.
+    '''
+    import nbformat
+    from nbconvert.preprocessors import ExecutePreprocessor
+    with open(path) as fh:
+        nb = nbformat.read(fh, as_version=4)
+    ExecutePreprocessor(timeout=timeout, kernel_name='python3').preprocess(
+        nb, {'metadata': {'path': os.path.dirname(path)}})
+
+
+class Pipeline(object):
+    '''
+    Dependency graph of stages with incremental, concurrent execution.
+
+    Parameters:
+        - stages: list of Stage.
+        - state: JSON file recording stage and file digests.
+    '''
+
+    def __init__(self, stages, state=STATE):
+        self.stages = dict((s.name, s) for s in stages)
+        self.order = [s.name for s in stages]
+        self.state_path = state
+        self._lock = threading.Lock()
+        self._load()
+        producers = {}
+        for s in stages:
+            for out in s.outputs:
+                producers[os.path.abspath(out)] = s.name
+        self.upstream = {}
+        for s in stages:
+            deps = set()
+            for pattern in s.inputs:
+                for out, name in producers.items():
+                    if name != s.name and (out == os.path.abspath(pattern) or
+                                           fnmatch.fnmatch(out, os.path.abspath(pattern))):
+                        deps.add(name)
+            self.upstream[s.name] = deps
+
+    def _load(self):
+        try:
+            with open(self.state_path) as fh:
+                self.state = json.load(fh)
+        except (IOError, ValueError):
+            self.state = {'stages': {}, 'files': {}}
+
+    def _save(self):
+        with cache.atomic_write(self.state_path) as tmp:
+            with open(tmp, 'w') as fh:
+                json.dump(self.state, fh, indent=1, sort_keys=True)
+
+    def _digest(self, path):
+        '''File digest, reused while the file's size and mtime are unchanged.'''
+        files = cache._companions(path)
+        stamp = [[os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in files]
+        key = os.path.abspath(path)
+        with self._lock:
+            known = self.state['files'].get(key)
+        if known is not None and known[0] == stamp:
+            return known[1]
+        digest = cache.file_digest(path)
+        with self._lock:
+            self.state['files'][key] = [stamp, digest]
+        return digest
+
+    def digest(self, name):
+        '''
+        Digest of everything a stage reads, or None when an input is missing.
+        '''
+        stage = self.stages[name]
+        files = stage.files()
+        if not all(os.path.exists(f) for f in files):
+            return None
+        names = [os.path.relpath(f, cache.DATA_DIR) for f in files]
+        digests = [self._digest(f) for f in files]
+        return cache.input_hash(files=list(zip(names, digests)), params=stage.params)
+
+    def _check(self, name):
+        '''State of a stage: (status, digest).'''
+        stage = self.stages[name]
+        digest = self.digest(name)
+        has_outputs = all(os.path.exists(o) for o in stage.outputs)
+        if digest is None:
+            return ('inputs missing' if has_outputs else 'blocked'), None
+        if not has_outputs:
+            return 'outputs missing', digest
+        if self.state['stages'].get(name) != digest:
+            return 'stale', digest
+        return 'up to date', digest
+
+    def _closure(self, targets):
+        '''Stages needed for ``targets`` (all stages by default), in order.'''
+        if targets is None:
+            return list(self.order)
+        needed, todo = set(), list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in needed:
+                needed.add(name)
+                todo.extend(self.upstream[name])
+        return [n for n in self.order if n in needed]
+
+    def status(self, targets=None):
+        '''
+        Function to report the state of every stage, without running anything.
+        Downstream stages are judged on the current upstream outputs.
+
+        Returns:
+            - report: DataFrame indexed by stage with status and upstream stages.
+        '''
+        rows = []
+        for name in self._closure(targets):
+            status, _ = self._check(name)
+            rows.append({'stage': name, 'status': status,
+                         'upstream': ', '.join(sorted(self.upstream[name]))})
+        self._save()
+        return pd.DataFrame(rows, columns=['stage', 'status', 'upstream']).set_index('stage')
+
+    def adopt(self, targets=None):
+        '''
+        Record stages whose outputs exist as up to date, without running them.
+        '''
+        for name in self._closure(targets):
+            status, digest = self._check(name)
+            if digest is not None and status != 'outputs missing':
+                self.state['stages'][name] = digest
+        self._save()
+
+    def _execute(self, name, force):
+        status, digest = self._check(name)
+        if status in ('inputs missing', 'blocked'):
+            if status == 'blocked':
+                raise IOError('Stage %s: inputs missing and no outputs to use' % name)
+            return False
+        if status == 'up to date' and not force:
+            return False
+        self.stages[name].run()
+        with self._lock:
+            self.state['stages'][name] = digest
+            self._save()
+        return True
+
+    def run(self, targets=None, force=False, workers=4):
+        '''
+        Function to bring stages up to date. A stage starts once all stages
+        it depends on have finished; independent stages run concurrently.
+
+        Parameters:
+            - targets: stage names to update, with what they depend on (default: all).
+            - force: run the selected stages even if up to date.
+            - workers: number of stages running at the same time.
+
+        Returns:
+            - ran: names of the stages that were executed.
+        '''
+        pending = self._closure(targets)
+        selected = set(pending)
+        done, ran, failed = set(), [], {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while pending or running:
+                for name in list(pending):
+                    deps = self.upstream[name] & selected
+                    if deps & set(failed):
+                        failed[name] = IOError('upstream stage failed')
+                        pending.remove(name)
+                    elif deps <= done:
+                        running[pool.submit(self._execute, name, force)] = name
+                        pending.remove(name)
+                if not running:
+                    break
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        if future.result():
+                            ran.append(name)
+                        done.add(name)
+                    except Exception as err:
+                        failed[name] = err
+        self._save()
+        if failed:
+            raise RuntimeError('Pipeline stages failed: %s' % ', '.join(
+                '%s (%s)' % (n, e) for n, e in sorted(failed.items())))
+        return ran
+
+
+def build_sites(sites=STUDY_SITES):
+    '''
+    Stage: study basin polygons with station names, plus Dry Creek (sites.shp).
+    '''
+    import geopandas as gp
+    basins = gp.read_file(_data('basins', 'basins18_utm.shp'))[['SITE_NO', 'geometry']]
+    gauges = gp.read_file(_data('USGS_gages', 'USGS_Streamgages-NHD_Locations.shp'))
+    df = basins.merge(gauges[['SITE_NO', 'STATION_NM']], on='SITE_NO')
+    df = df.set_index('SITE_NO').loc[list(sites)].reset_index(drop=True)
+    df['gauge_id'] = list(sites)
+    dry = gp.read_file(_data('dry_creek_polygon', 'dry.shp'))
+    dry = gp.GeoDataFrame({'gauge_id': [DRY_CREEK], 'STATION_NM': ['Dry Creek']},
+                          geometry=[dry.geometry.values[0]], crs=df.crs)
+    df = gp.GeoDataFrame(pd.concat([df, dry], ignore_index=True), crs=df.crs)
+    df.index = df.gauge_id
+    df = df.dropna(axis=0)
+    df[['STATION_NM', 'gauge_id', 'geometry']].to_file(_data('sites.shp'))
+
+
+def _read_sites():
+    import geopandas as gp
+    return gp.read_file(_data('sites.shp')).set_index('gauge_id', drop=False)
+
+
+def fetch_discharge(start='1980-01-01', end='2018-12-31', fetch=False):
+    '''
+    Stage: the monthly runoff table from the local daily flow files; with
+    ``fetch`` the flow files are first brought up to date from NWIS.
+    '''
+    import discharge
+    import nwis
+    sites = _read_sites()
+    gauges = [g for g in sites.gauge_id if g != DRY_CREEK]
+    if fetch:
+        flows, failed = nwis.fetch_flows(gauges, start, end)
+        sites = sites[~sites.gauge_id.isin(list(failed))]
+    else:
+        flows = dict((g, nwis.read_flow(g)) for g in gauges)
+    table, _ = discharge.discharge_table(sites, flows, start, end)
+    table.to_csv(_data('discharge_df.csv'))
+
+
+def monthly_site_means(pattern, date_slice, date_format, output):
+    '''
+    Stage: monthly raster means of every site (precip_sites.csv, et_sites.csv).
+    Means are taken over the pixels of each basin's bounding box, ignoring
+    negative (nodata) values, as the clip-based extraction of
+    download_and_extract_data.ipynb does.
+    '''
+    import zonal
+    sites = _read_sites()
+    boxes = sites.copy()
+    boxes['geometry'] = sites.envelope
+    means = zonal.monthly_means(pattern, date_slice, date_format, boxes, list(sites.gauge_id),
+                                method='all_touched', minimum=0)
+    means.to_csv(output)
+
+
+def monthly_evi():
+    '''Stage: monthly basin EVI from the Earth Engine export (evi_sites.csv).'''
+    import evi
+    table, _ = evi.load(sites=_read_sites().gauge_id)
+    table.to_csv(_data('evi_sites.csv'))
+
+
+def extract_temperature(start='2000-01-01', end='2017-12-31'):
+    '''Stage: daily tmax and tmin of every site (tmax_prism.csv, tmin_prism.csv).'''
+    import climate
+    sites = _read_sites().to_crs(epsg=4326)
+    if os.path.isdir(climate.PRISM_DIR):
+        backend = climate.RasterBackend(climate.PRISM_DIR)
+    else:
+        backend = climate.EarthEngineBackend()
+    temps = climate.extract(sites, ['tmax', 'tmin'], start, end, backend)
+    temps['tmax'].to_csv(_data('tmax_prism.csv'))
+    temps['tmin'].to_csv(_data('tmin_prism.csv'))
+
+
+def hargreaves_pet():
+    '''Stage: daily Hargreaves PET of every site (pet_prism_hargreaves.csv).'''
+    import climate
+    from tablecache import read_table
+    pet = climate.hargreaves_pet(read_table(_data('tmax_prism.csv')),
+                                 read_table(_data('tmin_prism.csv')))
+    pet.to_csv(_data('pet_prism_hargreaves.csv'))
+
+
+def basin_summary(sites=STUDY_SITES):
+    '''Stage: Table S2 (basinsummary.py), one pass over the covariate rasters.'''
+    import basinsummary
+    basinsummary.table_s2(sites, _data('Table S2.csv'))
+
+
+def storage_sensitivity(water_years=(2002, 2013)):
+    '''Stage: headless sensitivity results (results.csv, winter_q.csv); no results.h5 record.'''
+    import sensitivity
+    sensitivity.run(water_years, output=_data('results.csv'), winter_q=_data('winter_q.csv'),
+                    store=False)
+
+
+def baseflow_index(water_years=(2002, 2013)):
+    '''Stage: baseflow index per water year of every gauge (baseflow_index.csv).'''
+    import baseflow
+    baseflow.run(water_years)
+
+
+def recession_parameters():
+    '''Stage: recession parameters of every gauge and season (recession.csv).'''
+    import recession
+    recession.run()
+
+
+def render_figures():
+    '''Stage: the figures whose inputs or style changed (figures.py), in parallel.'''
+    figures.render()
+
+
+_FIGURE_INPUTS = sorted(set(p for spec in figures.FIGURES.values() for p in spec['inputs']))
+_FIGURE_OUTPUTS = [p for spec in figures.FIGURES.values() for p in spec['outputs']]
+_FIGURE_NOTEBOOKS = [spec['notebook'] for spec in figures.FIGURES.values() if 'notebook' in spec]
+_SITE_SHAPES = [_data('sites.shp'), _data('basins', 'basins18_utm.shp'),
+                _data('dry_creek_polygon', 'dry.shp')]
+_TABLES = [_data(n) for n in ('discharge_df.csv', 'et_sites.csv', 'evi_sites.csv',
+                              'precip_sites.csv')]
+
+STAGES = [
+    Stage('sites', func=build_sites,
+          inputs=[_data('basins', 'basins18_utm.shp'),
+                  _data('USGS_gages', 'USGS_Streamgages-NHD_Locations.shp'),
+                  _data('dry_creek_polygon', 'dry.shp')],
+          outputs=[_data('sites.shp')], params={'sites': STUDY_SITES}),
+    # set params['fetch'] to download new flow data from NWIS before the table is built
+    Stage('discharge', func=fetch_discharge,
+          inputs=[_data('sites.shp'), _data('dry_creek_discharge.csv'),
+                  _data('flow_data', '*.csv')],
+          outputs=[_data('discharge_df.csv')],
+          params={'start': '1980-01-01', 'end': '2018-12-31', 'fetch': False},
+          code=['nwis.py', 'rdb.py', 'discharge.py']),
+    Stage('precip', func=monthly_site_means,
+          inputs=[_data('sites.shp'), _data('monthly_ppt', '2*', '*.tif')],
+          outputs=[_data('precip_sites.csv')],
+          params={'pattern': _data('monthly_ppt', '2*', '*.tif'), 'date_slice': [-10, -4],
+                  'date_format': '%Y%m', 'output': _data('precip_sites.csv')},
+          code=['zonal.py']),
+    Stage('et', func=monthly_site_means,
+          inputs=[_data('sites.shp'), _data('monthly_ET', '*.tif')],
+          outputs=[_data('et_sites.csv')],
+          params={'pattern': _data('monthly_ET', '*.tif'), 'date_slice': [-11, -4],
+                  'date_format': '%m-%Y', 'output': _data('et_sites.csv')},
+          code=['zonal.py']),
+    Stage('evi', func=monthly_evi,
+          inputs=[_data('sites.shp'), _data('modis_mean_evi.geojson'),
+                  _data('mode_qa.geojson.json')],
+          outputs=[_data('evi_sites.csv')], code=['evi.py']),
+    Stage('temperature', func=extract_temperature,
+          inputs=[_data('sites.shp')],
+          outputs=[_data('tmax_prism.csv'), _data('tmin_prism.csv')],
+          params={'start': '2000-01-01', 'end': '2017-12-31'},
+          code=['climate.py', 'zonal.py']),
+    Stage('pet', func=hargreaves_pet,
+          inputs=[_data('tmax_prism.csv'), _data('tmin_prism.csv')],
+          outputs=[_data('pet_prism_hargreaves.csv')],
+          code=['climate.py', 'meteolib.py', 'evaplib.py']),
+    Stage('site_fires', notebook='get_site_fires.ipynb',
+          inputs=[_data('basins', 'basins18_utm.shp'), _data('fire_history_utm.shp'),
+                  _data('USGS_gages', 'USGS_Streamgages-NHD_Locations.shp'),
+                  _data('dry_creek_polygon', 'dry.shp')],
+          outputs=[_data('site_fires.csv')]),
+    Stage('basin_summary', func=basin_summary,
+          inputs=[_data('CAL_canopy_utm.tif'), _data('Cal90mDEM_UTM.tif'),
+                  _data('PRISM_800m_30yr_PPT_UTM.tif'), _data('PRISM_800m_30yr_TMEAN_UTM.tif'),
+                  _data('landcover', 'cal_landcover_utm10N.tif'), _data('CAunits.csv'),
+                  _data('StudyBasins_CalGeol_ArcGIS-Intersect.csv'),
+                  _data('USGS_LANDCOVER_LEGEND.csv')] + _SITE_SHAPES[1:],
+          outputs=[_data('Table S2.csv')], params={'sites': STUDY_SITES + ['0']},
+          code=['basinsummary.py', 'registry.py', 'zonal.py', 'overlay.py', 'shards.py']),
+    Stage('sensitivity', func=storage_sensitivity, inputs=_TABLES,
+          outputs=[_data('results.csv'), _data('winter_q.csv')],
+          params={'water_years': [2002, 2013]},
+          code=['sensitivity.py', 'tablecache.py', 'completeness.py']),
+    Stage('baseflow', func=baseflow_index, inputs=[_data('flow_data', '*.csv')],
+          outputs=[_data('baseflow_index.csv')], params={'water_years': [2002, 2013]},
+          code=['baseflow.py', 'discharge.py', 'nwis.py']),
+    Stage('recession', func=recession_parameters,
+          inputs=[_data('flow_data', '*.csv')] + _SITE_SHAPES[1:],
+          outputs=[_data('recession.csv')],
+          code=['recession.py', 'discharge.py', 'nwis.py', 'registry.py']),
+    Stage('figures', func=render_figures, inputs=_FIGURE_INPUTS, outputs=_FIGURE_OUTPUTS,
+          code=['figures.py', 'registry.py', 'sensitivity.py'] + _FIGURE_NOTEBOOKS),
+]
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+'''
+Wall-to-wall, pixel-level sensitivity maps from the monthly precipitation
+and ET grids, where no discharge is needed.
+
+Pixel map functions
+===================
+
+    - water_year_stack: Per-pixel water-year aggregates of one raster window.
+    - spearman_pixels:  Spearman rho and p-value of every pixel at once.
+    - sensitivity_map:  Tiled rho / p-value GeoTIFF over the whole grid.
+    - main:             Command-line entry point.
+
+For every pixel and water year, as in the basin analysis (sensitivity.py):
+
+    - p_winter:  precipitation Oct - Mar [mm]
+    - s_end:     winter P - ET, a storage proxy without runoff [mm]
+    - et_summer: mean monthly ET Apr - Sep [mm]
+
+and the map is Spearman's rho (band 1) and its p-value (band 2) between a
+driver and a response over the water years (default: summer ET against
+winter precipitation).
+
+The map is computed tile by tile over the precipitation grid. Worker
+processes read only their tile window of every monthly grid, one month at a
+time, so peak memory depends on the tile size and the number of water years,
+not on the size of the grid. ET grids on another grid are resampled onto the
+precipitation grid on the fly (average). Tiles are written to the output as
+they complete.
+
+Examples
+--------
+
+    >>> sensitivity_map('../data/pixel_rho_et_summer.tif', water_years=(2002, 2013))
+
+    From the notebooks folder:
+
+        $ python pixelmap.py --response s_end --output ../data/pixel_rho_storage.tif
+
+'''
+
+import argparse
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+from scipy import stats
+
+import cache
+import instrument
+import zonal
+from shards import RASTERS
+
+TILE = 256
+VARIABLES = ('p_winter', 's_end', 'et_summer')
+# months of the winter (Oct - Mar) and summer (Apr - Sep) of a water year
+WINTER_MONTHS = (10, 11, 12, 1, 2, 3)
+SUMMER_MONTHS = (4, 5, 6, 7, 8, 9)
+
+
+def _water_year(dates):
+    '''Water year of monthly dates (Oct - Sep, named by the year it ends).'''
+    return np.where(dates.month >= 10, dates.year + 1, dates.year)
+
+
+def _same_grid(src, profile):
+    return (src.crs == profile['crs'] and src.shape == (profile['height'], profile['width'])
+            and np.allclose(zonal._coefficients(src.transform), profile['transform']))
+
+
+def _read_window(path, window, profile, minimum=0):
+    '''One month of a tile, resampled to the target grid if needed; NaN below ``minimum``.'''
+    with rasterio.open(path) as src:
+        if _same_grid(src, profile):
+            values = src.read(1, window=window).astype('float64')
+            nodata = src.nodata
+        else:
+            with WarpedVRT(src, crs=profile['crs'], transform=Affine(*profile['transform']),
+                           width=profile['width'], height=profile['height'],
+                           resampling=Resampling.average) as vrt:
+                values = vrt.read(1, window=window).astype('float64')
+                nodata = vrt.nodata
+    if nodata is not None:
+        values[values == nodata] = np.nan
+    with np.errstate(invalid='ignore'):
+        values[values < minimum] = np.nan
+    return values
+
+
+def water_year_stack(series, water_years, window, profile):
+    '''
+    Function to aggregate the monthly grids of a window into water-year
+    values, reading one month at a time.
+
+    Parameters:
+        - series: dict 'precip' / 'et' -> (dates, files) from ``zonal.dated_files``.
+        - water_years: water years to aggregate.
+        - window: rasterio Window of the target grid.
+        - profile: crs, transform (6 coefficients), width and height of the
+          target grid.
+
+    Returns:
+        - stack: dict variable -> array (water year x rows x cols). Winter
+          sums are NaN where a month is missing or nodata.
+    '''
+    shape = (len(water_years), int(window.height), int(window.width))
+    index = dict((wy, i) for i, wy in enumerate(water_years))
+    sums = {'precip': np.zeros(shape), 'et_winter': np.zeros(shape), 'et_summer': np.zeros(shape)}
+    counts = {'et_summer': np.zeros(shape)}
+    # number of winter months found per water year
+    months = {'precip': np.zeros(len(water_years)), 'et_winter': np.zeros(len(water_years))}
+    for name in ('precip', 'et'):
+        dates, files = series[name]
+        wys = _water_year(dates)
+        for date, wy, path in zip(dates, wys, files):
+            if wy not in index:
+                continue
+            i = index[wy]
+            if date.month in WINTER_MONTHS:
+                key = 'precip' if name == 'precip' else 'et_winter'
+                sums[key][i] += _read_window(path, window, profile)
+                months[key][i] += 1
+            elif name == 'et':
+                values = _read_window(path, window, profile)
+                ok = ~np.isnan(values)
+                sums['et_summer'][i][ok] += values[ok]
+                counts['et_summer'][i] += ok
+    for key in months:
+        sums[key][months[key] < len(WINTER_MONTHS)] = np.nan
+    with np.errstate(invalid='ignore', divide='ignore'):
+        et_summer = np.where(counts['et_summer'] > 0,
+                             sums['et_summer'] / counts['et_summer'], np.nan)
+    return {'p_winter': sums['precip'], 's_end': sums['precip'] - sums['et_winter'],
+            'et_summer': et_summer}
+
+
+def _ranks(a):
+    '''Ranks along the first axis, ties get their average rank (as scipy).'''
+    order = np.argsort(a, axis=0, kind='mergesort')
+    s = np.take_along_axis(a, order, axis=0)
+    n = a.shape[0]
+    pos = np.arange(n).reshape((n,) + (1,) * (a.ndim - 1)) * np.ones_like(a, dtype='int64')
+    new = np.ones(a.shape, dtype=bool)
+    new[1:] = s[1:] != s[:-1]
+    first = np.maximum.accumulate(np.where(new, pos, 0), axis=0)
+    last_new = np.ones(a.shape, dtype=bool)
+    last_new[:-1] = new[1:]
+    last = np.flip(np.minimum.accumulate(np.flip(np.where(last_new, pos, n), axis=0), axis=0),
+                   axis=0)
+    ranks = np.empty(a.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2.0 + 1, axis=0)
+    return ranks
+
+
+def spearman_pixels(x, y):
+    '''
+    Function to compute Spearman's rho of every pixel over the water years.
+
+    Parameters:
+        - x, y: arrays (water year x rows x cols).
+
+    Returns:
+        - rho, p: arrays (rows x cols). Pixels with missing years are
+          computed on the complete years (as nan_policy='omit'); pixels with
+          fewer than 3 complete years are NaN.
+    '''
+    complete = ~(np.isnan(x) | np.isnan(y))
+    n = complete.sum(axis=0)
+    rho = np.full(x.shape[1:], np.nan)
+    full = n == x.shape[0]
+    if full.any():
+        rx, ry = _ranks(x[:, full]), _ranks(y[:, full])
+        rx -= rx.mean(axis=0)
+        ry -= ry.mean(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rho[full] = (rx * ry).sum(axis=0) / np.sqrt((rx ** 2).sum(axis=0) *
+                                                        (ry ** 2).sum(axis=0))
+    for r, c in zip(*np.nonzero(~full & (n >= 3))):
+        ok = complete[:, r, c]
+        rho[r, c] = stats.spearmanr(x[ok, r, c], y[ok, r, c])[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dof = n - 2.0
+        t = rho * np.sqrt(dof / ((rho + 1.0) * (1.0 - rho)))
+        p = 2 * stats.t.sf(np.abs(t), dof)
+    p[np.abs(rho) == 1] = 0.0
+    rho[n < 3] = np.nan
+    p[n < 3] = np.nan
+    return rho, p
+
+
+def _tile(job):
+    '''Worker: rho and p-value of one tile.'''
+    series, water_years, window, profile, driver, response = job
+    with instrument.span('pixelmap.tile', pixels=int(window.width) * int(window.height),
+                         water_years=len(water_years)):
+        stack = water_year_stack(series, water_years, window, profile)
+        rho, p = spearman_pixels(stack[driver], stack[response])
+    return window, rho.astype('float32'), p.astype('float32')
+
+
+def sensitivity_map(output, water_years=(2002, 2013), driver='p_winter', response='et_summer',
+                    precip=RASTERS['precip'], et=RASTERS['et'], tile=TILE, workers=None):
+    '''
+    Function to map the pixel-level sensitivity over the precipitation grid.
+
+    Parameters:
+        - output: GeoTIFF to write (band 1 rho, band 2 p-value, NaN nodata).
+        - water_years: first and last water year (inclusive).
+        - driver, response: variables of VARIABLES.
+        - precip, et: (glob pattern, date slice, date format) of the monthly
+          grids, as in shards.RASTERS.
+        - tile: processing tile size [pixels]; the GeoTIFF blocks are this size
+          rounded up to a multiple of 16, at most TILE.
+        - workers: number of worker processes (default: all cores).
+
+    Returns:
+        - output: the GeoTIFF written.
+    '''
+    for v in (driver, response):
+        if v not in VARIABLES:
+            raise ValueError('Unknown variable %r, expected one of %s' % (v, VARIABLES))
+    series = {'precip': zonal.dated_files(*precip), 'et': zonal.dated_files(*et)}
+    if not len(series['precip'][1]):
+        raise IOError('No precipitation grids match %s' % precip[0])
+    with rasterio.open(series['precip'][1][0]) as src:
+        profile = {'crs': src.crs, 'transform': zonal._coefficients(src.transform),
+                   'width': src.width, 'height': src.height}
+    years = list(range(water_years[0], water_years[1] + 1))
+    windows = [Window(c, r, min(tile, profile['width'] - c), min(tile, profile['height'] - r))
+               for r in range(0, profile['height'], tile)
+               for c in range(0, profile['width'], tile)]
+    # GeoTIFF blocks must be multiples of 16 pixels; any processing tile size is allowed
+    block = min(TILE, -(-tile // 16) * 16)
+    meta = dict(profile, transform=Affine(*profile['transform']), driver='GTiff', count=2,
+                dtype='float32', nodata=np.nan, tiled=True, blockxsize=block, blockysize=block,
+                compress='deflate')
+    limit = 2 * (workers or os.cpu_count() or 1)
+    with cache.atomic_write(output) as tmp:
+        with rasterio.open(tmp, 'w', **meta) as dst:
+            dst.set_band_description(1, 'spearman_rho')
+            dst.set_band_description(2, 'p_value')
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                running = set()
+                for window in windows:
+                    while len(running) >= limit:
+                        finished, running = wait(running, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            _write(dst, *future.result())
+                    running.add(pool.submit(_tile, (series, years, window, profile,
+                                                    driver, response)))
+                for future in wait(running)[0]:
+                    _write(dst, *future.result())
+    return output
+
+
+def _write(dst, window, rho, p):
+    dst.write(rho, 1, window=window)
+    dst.write(p, 2, window=window)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pixel-level sensitivity map (rho, p-value).')
+    parser.add_argument('--water-years', nargs=2, type=int, default=[2002, 2013],
+                        metavar=('FIRST', 'LAST'), help='water year range (default 2002 2013)')
+    parser.add_argument('--driver', choices=VARIABLES, default='p_winter')
+    parser.add_argument('--response', choices=VARIABLES, default='et_summer')
+    parser.add_argument('--tile', type=int, default=TILE, help='tile size [pixels]')
+    parser.add_argument('--workers', type=int, help='worker processes (default: all cores)')
+    parser.add_argument('--output', required=True, help='GeoTIFF to write')
+    args = parser.parse_args(argv)
+    sensitivity_map(args.output, args.water_years, args.driver, args.response,
+                    tile=args.tile, workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+'''
+Streaming reader for USGS NWIS RDB (tab-delimited) daily-values files.
+
+RDB functions
+=============
+
+    - read_daily: Parse an RDB stream into a compact daily array per site.
+    - to_frame:   Convert one site's daily array to a DataFrame.
+
+The reader walks the stream line by line: ``#`` comment lines are skipped
+wherever they occur, the first remaining line gives the column names and
+the one after it the column formats, whatever the number of comment lines.
+Multi-site responses repeat the comments, column names and formats for
+every site; each repeated header (a line starting with ``agency_cd``) sets
+the columns of the rows that follow it.
+Values of the requested parameter/statistic are parsed together with their
+qualifier column in the same pass. Entries that are not numbers ("Ice",
+"Eqp", "Bkw", ...) or that carry a masked qualifier code become NaN, so the
+output is always numeric.
+
+Examples
+--------
+
+    >>> with open('11475560.rdb') as fh:
+    ...     daily = read_daily(fh)
+    >>> q = to_frame(daily['11475560'])
+
+'''
+
+import array
+import collections
+
+import numpy as np
+import pandas as pd
+
+DISCHARGE = '00060'   # discharge [cfs]
+DAILY_MEAN = '00003'
+
+# Qualifier codes whose values are masked by default: NWIS remarks that mean
+# the daily value is not a valid discharge measurement.
+MASKED_CODES = frozenset(['Ice', 'Eqp', 'Bkw', 'Dis', 'Ssn', 'Mnt', 'Fld',
+                          'Pr', 'Rat', 'Tst', 'Dry', '***'])
+
+# Daily values of one site: first day, float array with NaN for missing days,
+# and an array of qualifier strings ('' where none was given)
+Daily = collections.namedtuple('Daily', ['start', 'values', 'qualifiers'])
+
+
+def _columns(header, parameter, statistic):
+    '''
+    Locate the site, date, value and qualifier columns for the requested
+    parameter. Multi-parameter files have one value/qualifier pair per time
+    series ("<ts>_<parameter>_<stat>" and "<ts>_<parameter>_<stat>_cd"); the
+    first matching series is used.
+    '''
+    names = header.rstrip('\r\n').split('\t')
+    suffix = '_%s_%s' % (parameter, statistic)
+    values = [i for i, n in enumerate(names) if n.endswith(suffix)]
+    if not values:
+        return None
+    value = values[0]
+    code = names.index(names[value] + '_cd') if names[value] + '_cd' in names else None
+    return names.index('site_no'), names.index('datetime'), value, code
+
+
+def _float(text):
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+
+def read_daily(lines, parameter=DISCHARGE, statistic=DAILY_MEAN,
+               masked=MASKED_CODES, dtype='float64'):
+    '''
+    Function to parse an RDB daily-values stream in one pass.
+
+    Parameters:
+        - lines: iterable of text lines (open file, response stream, list).
+        - parameter: NWIS parameter code (default discharge, 00060).
+        - statistic: NWIS statistic code (default daily mean, 00003).
+        - masked: qualifier codes whose values are set to NaN.
+        - dtype: value type of the output arrays.
+
+    Returns:
+        - daily: dict site -> Daily(start, values, qualifiers). ``values``
+          covers every day from ``start`` to the last record, with NaN on
+          days without a (valid) value.
+    '''
+    sites = collections.OrderedDict()
+    cols = None
+    header, formats = True, False
+    for line in lines:
+        if not line or line[0] == '#' or line in ('\n', '\r\n'):
+            continue
+        if header or line.startswith('agency_cd'):
+            # columns of the rows up to the next header (the series of one site)
+            cols = _columns(line, parameter, statistic)
+            header, formats = False, True
+            continue
+        if formats:
+            # column format row (e.g. 5s 15s 20d 14n 10s)
+            formats = False
+            continue
+        if cols is None:
+            continue
+        isite, idate, ivalue, icode = cols
+        fields = line.rstrip('\r\n').split('\t')
+        if len(fields) <= ivalue:
+            continue
+        site = fields[isite]
+        if site not in sites:
+            sites[site] = (array.array('i'), array.array('d'), [])
+        days, vals, codes = sites[site]
+        code = fields[icode] if icode is not None and icode < len(fields) else ''
+        value = _float(fields[ivalue])
+        if value == value and masked and any(c in masked for c in code.split(':')):
+            value = np.nan
+        if value != value and fields[ivalue] and not fields[ivalue][0].isdigit():
+            # qualifier given in place of the value (e.g. "Ice")
+            code = fields[ivalue] if not code else code + ':' + fields[ivalue]
+        days.append(_day_number(fields[idate]))
+        vals.append(value)
+        codes.append(code)
+
+    daily = collections.OrderedDict()
+    for site, (days, vals, codes) in sites.items():
+        days = np.frombuffer(days, dtype='i4') if len(days) else np.zeros(0, 'i4')
+        vals = np.frombuffer(vals, dtype='f8') if len(vals) else np.zeros(0)
+        if not len(days):
+            continue
+        first = days.min()
+        out = np.full(days.max() - first + 1, np.nan, dtype=dtype)
+        out[days - first] = vals
+        quals = np.zeros(len(out), dtype='U%d' % max(1, max(len(c) for c in codes)))
+        quals[days - first] = codes
+        daily[site] = Daily(np.datetime64(int(first), 'D'), out, quals)
+    return daily
+
+
+_EPOCH = np.datetime64('1970-01-01', 'D')
+
+
+def _day_number(text):
+    '''Days since 1970-01-01 of an ISO date (YYYY-MM-DD).'''
+    return int((np.datetime64(text[:10], 'D') - _EPOCH).astype('i8'))
+
+
+def to_frame(daily, column='q'):
+    '''
+    Function to convert one site's Daily record to a DataFrame.
+
+    Parameters:
+        - daily: Daily namedtuple from ``read_daily``.
+        - column: name of the value column.
+
+    Returns:
+        - df: DataFrame indexed by date (``datetime``), one float column.
+    '''
+    index = pd.date_range(pd.Timestamp(daily.start), periods=len(daily.values),
+                          freq='D', name='datetime')
+    return pd.DataFrame({column: daily.values}, index=index)
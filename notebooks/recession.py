@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+'''
+Recession analysis of the daily flow records: storage-discharge relations
+from -dQ/dt against Q (Kirchner, 2009), for every gauge and season.
+
+Recession functions
+===================
+
+    - recession_days: Mask of recession days of all gauges at once.
+    - bin_recession:  Binned mean -dQ/dt against Q with standard errors.
+    - fit_power_law:  Weighted fit of -dQ/dt = a Q^b to the bins.
+    - run:            Recession parameters of every local flow record, in parallel.
+    - join_results:   Add recession parameters to the sensitivity results.
+    - main:           Command-line entry point.
+
+Daily discharge is converted to runoff depth [mm/day] over the basin area
+(registry.py). A day pair (t-1, t) is a recession step when runoff falls,
+the step lies in a run of at least ``min_length`` falling steps, and it is
+not one of the first ``skip`` steps after a peak, where quickflow still
+dominates. The masks are built for the whole (day x gauge) array with
+cumulative sums, without per-day Python logic. Each step gives
+-dQ/dt = Q[t-1] - Q[t] and Q = (Q[t-1] + Q[t]) / 2.
+
+Steps are grouped into ``bins`` equal bins of log Q. Bins with fewer than
+``min_points`` steps are dropped. Log(-dQ/dt) of the bin means is fitted
+against log(Q) by weighted least squares with weights from the standard
+error of each bin mean. The parameters of -dQ/dt = a Q^b come with their
+standard errors. The fit is done per gauge for the whole year, winter
+(Oct - Mar) and summer (Apr - Sep).
+
+Gauges are processed in chunks by worker processes. The results are written
+to data/recession.csv and join the sensitivity results on the gauge id.
+
+Examples
+--------
+
+    >>> params = run(workers=4)
+    >>> results = join_results(pd.read_csv('../data/results.csv', index_col=0), params)
+
+    From the notebooks folder:
+
+        $ python recession.py --min-length 5 --skip 2
+
+'''
+
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import cache
+import discharge
+from nwis import FLOW_DIR, read_flow
+
+RECESSION_CSV = os.path.join(cache.DATA_DIR, 'recession.csv')
+SEASONS = {'all': tuple(range(1, 13)), 'winter': (10, 11, 12, 1, 2, 3),
+           'summer': (4, 5, 6, 7, 8, 9)}
+COLUMNS = ['a', 'b', 'log_a_se', 'b_se', 'r2', 'steps', 'bins']
+# relative standard error of a bin's mean rate below which the bin counts as having no spread
+SPREAD_TOLERANCE = 1e-6
+
+
+def _run_position(mask):
+    '''Position of every True element in its run of Trues (1, 2, ...) along axis 0.'''
+    count = np.cumsum(mask, axis=0)
+    reset = np.maximum.accumulate(np.where(mask, 0, count), axis=0)
+    return np.where(mask, count - reset, 0)
+
+
+def recession_days(q, min_length=5, skip=2):
+    '''
+    Function to find the recession steps of daily runoff.
+
+    Parameters:
+        - q: (day x gauge) array, NaN where missing.
+        - min_length: minimum number of consecutive falling steps.
+        - skip: number of steps dropped at the start of every recession.
+
+    Returns:
+        - mask: bool array (day - 1 x gauge); True where the step from day t
+          to t + 1 is used.
+        - dqdt: -dQ/dt of every step [units of q per day].
+        - qmean: mean runoff of every step.
+    '''
+    with np.errstate(invalid='ignore'):
+        dqdt = q[:-1] - q[1:]
+        falling = dqdt > 0
+    position = _run_position(falling)
+    length = position + _run_position(falling[::-1])[::-1] - 1
+    mask = falling & (position > skip) & (length >= min_length)
+    return mask, dqdt, (q[:-1] + q[1:]) / 2.0
+
+
+def bin_recession(qmean, dqdt, bins=20, min_points=5):
+    '''
+    Function to bin recession steps by log Q.
+
+    Parameters:
+        - qmean, dqdt: Q and -dQ/dt of the recession steps of one gauge.
+        - bins: number of equal bins of log Q.
+        - min_points: minimum number of steps of a bin.
+
+    Returns:
+        - q, rate, se: bin means of Q and -dQ/dt and the standard error of
+          the mean rate, for the bins kept.
+    '''
+    ok = (qmean > 0) & (dqdt > 0)
+    logq = np.log(qmean[ok])
+    dqdt = dqdt[ok]
+    if len(logq) < min_points:
+        return np.array([]), np.array([]), np.array([])
+    edges = np.linspace(logq.min(), logq.max(), bins + 1)
+    which = np.clip(np.searchsorted(edges, logq, side='right') - 1, 0, bins - 1)
+    n = np.bincount(which, minlength=bins)
+    rate = np.bincount(which, weights=dqdt, minlength=bins) / np.maximum(n, 1)
+    # centred second pass: bins of identical steps get exactly zero variance
+    squares = np.bincount(which, weights=(dqdt - rate[which]) ** 2, minlength=bins)
+    q_total = np.bincount(which, weights=qmean[ok], minlength=bins)
+    keep = n >= min_points
+    n, rate, squares, q_total = n[keep], rate[keep], squares[keep], q_total[keep]
+    variance = squares / (n - 1)
+    return q_total / n, rate, np.sqrt(variance / n)
+
+
+def fit_power_law(q, rate, se):
+    '''
+    Function to fit log(-dQ/dt) = log(a) + b log(Q) to binned recession data,
+    weighting each bin by the inverse variance of its log rate.
+
+    Returns:
+        - params: dict with a, b, the standard errors of log(a) and b, r2
+          and the number of bins (NaN with fewer than 3 bins).
+    '''
+    nan = {'a': np.nan, 'b': np.nan, 'log_a_se': np.nan, 'b_se': np.nan, 'r2': np.nan,
+           'bins': len(q)}
+    if len(q) < 3:
+        return nan
+    x, y = np.log(q), np.log(rate)
+    # standard error of log(rate) by the delta method; bins without spread (relative
+    # error below SPREAD_TOLERANCE) get the median weight of the others
+    sigma = se / rate
+    spread = sigma > SPREAD_TOLERANCE
+    sigma = np.where(spread, sigma, np.median(sigma[spread]) if spread.any() else 1)
+    w = 1 / sigma ** 2
+    design = np.column_stack([np.ones_like(x), x])
+    cov = np.linalg.inv(design.T.dot(design * w[:, None]))
+    coef = cov.dot(design.T.dot(w * y))
+    residual = y - design.dot(coef)
+    dof = len(x) - 2
+    scale = (w * residual ** 2).sum() / dof
+    se_coef = np.sqrt(np.diag(cov) * scale)
+    ybar = (w * y).sum() / w.sum()
+    r2 = 1 - (w * residual ** 2).sum() / (w * (y - ybar) ** 2).sum()
+    return {'a': np.exp(coef[0]), 'b': coef[1], 'log_a_se': se_coef[0], 'b_se': se_coef[1],
+            'r2': r2, 'bins': len(q)}
+
+
+def _chunk(job):
+    '''Worker: recession parameters of a chunk of gauges.'''
+    gauges, areas, folder, start, end, options = job
+    flows = dict((g, read_flow(g, folder)) for g in gauges)
+    dates, gauges, q = discharge.stack_daily(flows, start, end)
+    runoff = discharge.cfs_to_mm(q, areas) if areas is not None else q
+    mask, dqdt, qmean = recession_days(runoff, options['min_length'], options['skip'])
+    month = dates.month.values[1:]
+    rows = []
+    for season, months in sorted(SEASONS.items()):
+        in_season = mask & np.isin(month, months)[:, None]
+        for j, gauge in enumerate(gauges):
+            used = in_season[:, j]
+            binned = bin_recession(qmean[used, j], dqdt[used, j], options['bins'],
+                                   options['min_points'])
+            row = fit_power_law(*binned)
+            row.update(id=gauge, season=season, steps=int(used.sum()))
+            rows.append(row)
+    return rows
+
+
+def run(sites=None, start='1980-01-01', end='2018-12-31', min_length=5, skip=2, bins=20,
+        min_points=5, workers=None, chunk=16, folder=FLOW_DIR, output=RECESSION_CSV):
+    '''
+    Function to compute the recession parameters of every gauge and season.
+
+    Parameters:
+        - sites: gauge ids (default: every flow file in ``folder``).
+        - start, end: period of the flow records used.
+        - min_length, skip: recession step selection (see ``recession_days``).
+        - bins, min_points: binning (see ``bin_recession``).
+        - workers: number of worker processes (default: all cores).
+        - chunk: number of gauges per worker task.
+        - folder: folder of the daily flow files.
+        - output: CSV to write, or None.
+
+    Returns:
+        - params: DataFrame with id, season, a, b, log_a_se, b_se, r2, steps
+          and bins; runoff in mm/day where the basin area is known (registry),
+          discharge in cfs otherwise.
+    '''
+    import registry
+    if sites is None:
+        sites = sorted(os.path.splitext(os.path.basename(p))[0]
+                       for p in glob.glob(os.path.join(folder, '*.csv')))
+    sites = [registry.canonical_id(s) for s in sites]
+    known = registry.load()
+    options = {'min_length': min_length, 'skip': skip, 'bins': bins, 'min_points': min_points}
+    jobs = []
+    for group in (True, False):
+        # gauges with and without a basin area run in separate chunks
+        gauges = [s for s in sites if (s in known) == group]
+        for i in range(0, len(gauges), chunk):
+            part = gauges[i:i + chunk]
+            areas = [known[g].area_km2 * 1e6 for g in part] if group else None
+            jobs.append((part, areas, folder, start, end, options))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        rows = [row for part in pool.map(_chunk, jobs) for row in part]
+    params = pd.DataFrame(rows, columns=['id', 'season'] + COLUMNS)
+    params['units'] = np.where(params.id.isin([s for s in sites if s in known]), 'mm/day', 'cfs')
+    params = params.sort_values(['id', 'season']).reset_index(drop=True)
+    if output is not None:
+        with cache.atomic_write(output) as tmp:
+            params.to_csv(tmp, index=False)
+    return params
+
+
+def join_results(results, params, season='winter'):
+    '''
+    Function to add the recession parameters of a season to the long-form
+    sensitivity results (results.csv layout), by gauge id.
+
+    Returns:
+        - results: the results with the COLUMNS of ``params`` added
+          (NaN for sites without a flow record, e.g. Dry Creek).
+    '''
+    params = params.loc[params.season == season, ['id'] + COLUMNS]
+    params = params.assign(id=params.id.astype(str))
+    merged = results.assign(id=results.id.astype(str)).merge(params, on='id', how='left')
+    merged.index = results.index
+    return merged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recession analysis (-dQ/dt vs Q) of all gauges.')
+    parser.add_argument('--sites', nargs='+', help='gauge ids (default: all flow files)')
+    parser.add_argument('--period', nargs=2, default=['1980-01-01', '2018-12-31'],
+                        metavar=('START', 'END'))
+    parser.add_argument('--min-length', type=int, default=5,
+                        help='minimum number of consecutive falling days')
+    parser.add_argument('--skip', type=int, default=2,
+                        help='falling days dropped after each peak')
+    parser.add_argument('--bins', type=int, default=20, help='number of log Q bins')
+    parser.add_argument('--min-points', type=int, default=5, help='minimum steps per bin')
+    parser.add_argument('--workers', type=int, help='worker processes (default: all cores)')
+    parser.add_argument('--output', default=RECESSION_CSV)
+    args = parser.parse_args(argv)
+    run(args.sites, args.period[0], args.period[1], args.min_length, args.skip, args.bins,
+        args.min_points, args.workers, output=args.output)
+
+
+if __name__ == '__main__':
+    main()
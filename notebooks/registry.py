@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+'''
+Keyed registry of the study sites with precomputed geometry attributes.
+
+Registry functions
+==================
+
+    - canonical_id: Canonical string id of a gauge (int, str, Dry Creek aliases).
+    - build:        Build the registry table from the site and basin shapefiles.
+    - load:         The registry, rebuilt only when a source shapefile changed.
+    - Registry:     Keyed lookup of names, areas, centroids, bounds and polygons.
+
+The registry has one row per basin of basins18_utm.shp and sites.shp, plus
+Dry Creek, keyed by the canonical id: the USGS site number as an 8 character
+string, and '00000000' for Dry Creek (also written '0000' or 0 in the
+notebooks). Every row holds the station name, basin area (from the polygon
+and as reported by the NHD), centroid and bounding box in UTM zone 10N
+(EPSG:26910) and in lat/lon (EPSG:4326), the gauge location and the basin
+polygon (WKB, UTM).
+
+The table is built once from sites.shp, basins18_utm.shp, the NHD gauge
+locations and dry.shp and stored under data/cache/registry, keyed by the
+contents of those files, so later loads read one pickle.
+
+Examples
+--------
+
+    >>> sites = load()
+    >>> sites['11475560'].name
+    >>> sites[11475560].centroid_lon, sites['0000'].area_km2
+    >>> sites.polygon('11180825')
+
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import cache
+
+DRY_CREEK = '00000000'
+# ids used for Dry Creek in the notebooks and site tables
+DRY_CREEK_ALIASES = ('0', '0000', DRY_CREEK)
+# Dry Creek is not in the NHD: area (sq mi) and gauge location from basin_selection_and_summary
+DRY_CREEK_SQMI = 1.37
+DRY_CREEK_GAUGE = (39.5754, -123.4642)
+# geopandas 0.4 / pyproj 1.9 take crs as proj4 dicts, not 'EPSG:xxxx' strings
+UTM = {'init': 'epsg:26910'}
+LATLON = {'init': 'epsg:4326'}
+SQMI_TO_KM2 = 2.58999
+
+SOURCES = {'sites': os.path.join(cache.DATA_DIR, 'sites.shp'),
+           'basins': os.path.join(cache.DATA_DIR, 'basins', 'basins18_utm.shp'),
+           'gauges': os.path.join(cache.DATA_DIR, 'USGS_gages',
+                                  'USGS_Streamgages-NHD_Locations.shp'),
+           'dry_creek': os.path.join(cache.DATA_DIR, 'dry_creek_polygon', 'dry.shp')}
+
+
+def canonical_id(site):
+    '''
+    Function to convert a gauge id to its canonical form.
+
+    Parameters:
+        - site: id as int, float or str, e.g. 11475560, '11475560', '0000'.
+
+    Returns:
+        - id: 8 (or more) character string; '00000000' for Dry Creek.
+    '''
+    if isinstance(site, (float, np.floating)):
+        site = int(site)
+    site = str(site).strip()
+    if site in DRY_CREEK_ALIASES:
+        return DRY_CREEK
+    return site.zfill(8)
+
+
+def _attributes(geometry):
+    '''Centroid, bounds and area columns of a GeoSeries in UTM and lat/lon.'''
+    utm = geometry.to_crs(epsg=26910)
+    latlon = utm.to_crs(epsg=4326)
+    bounds, ll_bounds = utm.bounds, latlon.bounds
+    centroid = utm.centroid
+    ll_centroid = centroid.to_crs(epsg=4326)
+    return pd.DataFrame({
+        'area_km2': utm.area.values / 1e6,
+        'centroid_x': centroid.x.values, 'centroid_y': centroid.y.values,
+        'centroid_lon': ll_centroid.x.values, 'centroid_lat': ll_centroid.y.values,
+        'minx': bounds.minx.values, 'miny': bounds.miny.values,
+        'maxx': bounds.maxx.values, 'maxy': bounds.maxy.values,
+        'min_lon': ll_bounds.minx.values, 'min_lat': ll_bounds.miny.values,
+        'max_lon': ll_bounds.maxx.values, 'max_lat': ll_bounds.maxy.values,
+        'wkb': [g.wkb for g in utm.values]}, index=geometry.index)
+
+
+def build(sources=SOURCES):
+    '''
+    Function to build the registry table.
+
+    Parameters:
+        - sources: dict with the shapefiles 'sites', 'basins', 'gauges' and
+          'dry_creek'. The NHD gauge attributes (SITE_NO, STATION_NM,
+          LAT_SITE, LON_SITE) are used where the layer has them.
+
+    Returns:
+        - table: DataFrame indexed by canonical id.
+    '''
+    import geopandas as gp
+    basins = gp.read_file(sources['basins'])
+    basins.index = [canonical_id(s) for s in basins.SITE_NO]
+    dry = gp.read_file(sources['dry_creek']).to_crs(basins.crs)
+    geometry = gp.GeoSeries(list(basins.geometry.values) + [dry.geometry.values[0]],
+                            index=list(basins.index) + [DRY_CREEK], crs=basins.crs)
+    table = _attributes(geometry)
+    table['reported_area_km2'] = np.append(basins.SQMI.values, DRY_CREEK_SQMI) * SQMI_TO_KM2
+
+    names = pd.Series(np.nan, index=table.index, dtype=object)
+    table['gauge_lat'] = np.nan
+    table['gauge_lon'] = np.nan
+    gauges = gp.read_file(sources['gauges'])
+    if {'SITE_NO', 'STATION_NM'}.issubset(gauges.columns):
+        gauges.index = [canonical_id(s) for s in gauges.SITE_NO]
+        gauges = gauges.loc[gauges.index.isin(table.index)]
+        gauges = gauges.loc[~gauges.index.duplicated()]
+        names.update(gauges.STATION_NM)
+        if {'LAT_SITE', 'LON_SITE'}.issubset(gauges.columns):
+            table.loc[gauges.index, 'gauge_lat'] = gauges.LAT_SITE.astype(float)
+            table.loc[gauges.index, 'gauge_lon'] = gauges.LON_SITE.astype(float)
+    if os.path.exists(sources['sites']):
+        sites = gp.read_file(sources['sites'])
+        sites.index = [canonical_id(s) for s in sites.gauge_id]
+        names.update(sites.STATION_NM.loc[sites.index.isin(table.index)])
+    table.loc[DRY_CREEK, ['gauge_lat', 'gauge_lon']] = DRY_CREEK_GAUGE
+    table.insert(0, 'name', names.fillna('').values)
+    table.index.name = 'site'
+    return table.sort_index()
+
+
+def load(sources=SOURCES):
+    '''
+    Function to load the registry, building it when a source changed.
+
+    Returns:
+        - registry: Registry.
+    '''
+    paths = [p for p in sources.values() if os.path.exists(p)]
+    path = cache.cache_path('registry', cache.input_hash(paths), '.pkl')
+    if os.path.exists(path):
+        return Registry(pd.read_pickle(path))
+    table = build(sources)
+    with cache.atomic_write(path) as tmp:
+        table.to_pickle(tmp)
+    return Registry(table)
+
+
+class Registry(object):
+    '''
+    Keyed lookup of the site table. Ids are canonicalized, so 11475560,
+    '11475560', '0000' and '00000000' all work.
+
+    Parameters:
+        - table: DataFrame from ``build``.
+    '''
+
+    def __init__(self, table):
+        self.table = table
+        self._rows = dict((site, row) for site, row in
+                          zip(table.index, table.itertuples(index=False, name='Site')))
+
+    def __getitem__(self, site):
+        return self._rows[canonical_id(site)]
+
+    def __contains__(self, site):
+        return canonical_id(site) in self._rows
+
+    def __iter__(self):
+        return iter(self.table.index)
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def ids(self):
+        return list(self.table.index)
+
+    def names(self, sites=None):
+        '''Station names of sites (default: all), as a dict id -> name.'''
+        sites = self.ids if sites is None else sites
+        return dict((canonical_id(s), self[s].name) for s in sites)
+
+    def polygon(self, site, crs=UTM):
+        '''Basin polygon of a site, in UTM (default) or another CRS.'''
+        from shapely import wkb
+        geometry = wkb.loads(self[site].wkb)
+        if crs == UTM:
+            return geometry
+        import geopandas as gp
+        return gp.GeoSeries([geometry], crs=UTM).to_crs(crs).values[0]
+
+    def centroids(self, sites=None, crs=UTM):
+        '''Centroids of sites (default: all) as an array of (x, y) rows.'''
+        sites = self.ids if sites is None else [canonical_id(s) for s in sites]
+        columns = ['centroid_x', 'centroid_y'] if crs == UTM else ['centroid_lon', 'centroid_lat']
+        return self.table.loc[sites, columns].values
+
+    def geodataframe(self, sites=None):
+        '''GeoDataFrame of sites (default: all) with the basin polygons (UTM).'''
+        import geopandas as gp
+        from shapely import wkb
+        table = self.table if sites is None else self.table.loc[[canonical_id(s) for s in sites]]
+        return gp.GeoDataFrame(table.drop('wkb', axis=1),
+                               geometry=[wkb.loads(w) for w in table.wkb], crs=UTM)
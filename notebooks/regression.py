@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+'''
+Golden-output and timing regression checks of the analysis pipeline.
+
+Regression functions
+====================
+
+    - GOLDEN:         Checked outputs of each stage and how to compare them.
+    - golden_bytes:   Golden content of an output file.
+    - update_golden:  Pin the current outputs as the golden values.
+    - compare_tables: Cell-by-cell comparison of a table with its golden version.
+    - check:          Rerun stages on the checked-in data, compare and time them.
+    - main:           Command-line entry point; exit status 1 on a regression.
+
+The golden values are the outputs as committed (``git show HEAD:data/...``
+of results.csv, winter_q.csv, Table S2.csv, ...), so an output rewritten
+in the working tree, e.g. by an earlier run, does not become its own
+reference. ``update_golden`` pins the current outputs instead, under
+data/cache/regression/golden; a pinned copy is used until it is removed.
+``check`` keeps a copy of the working-tree outputs, reruns the selected
+stages one after the other (without their upstream stages, so nothing is
+downloaded), compares every output table with its golden version and puts
+the working-tree files back, so the working tree is left as it was.
+
+Tables are matched on their key columns rather than on row order (stages may
+order ties differently). Numbers must agree within ``rtol`` / ``atol``,
+everything else exactly. Missing rows or columns count as differences.
+Every rho and p-value of results.csv is compared this way.
+
+The wall-clock time of every stage is compared with a baseline kept in
+data/cache/regression/timings.json. The baseline is recorded with
+``update_timings`` (timings depend on the machine, so it is not part of the
+repository). A stage fails when it is slower than the baseline by more than
+``slowdown`` (a fraction) and by more than ``min_seconds``. Stages whose
+inputs are not available locally are reported as skipped, except those of
+OFFLINE: Table S2 without the statewide rasters is still rebuilt without
+its raster columns, and its area, lithology, Limiter and Name are compared
+(not timed). The gauge location is compared too when the site registry has
+it (it comes from the NHD gauge attributes, which may be missing locally).
+
+Examples
+--------
+
+    >>> report = check(update_timings=True)
+    >>> update_golden(['baseflow'])
+    >>> report = check(['sensitivity'], slowdown=0.25)
+    >>> report[report.status != 'ok']
+
+    From the notebooks folder:
+
+        $ python regression.py --slowdown 0.5
+        $ python regression.py sensitivity --rtol 1e-9
+        $ python regression.py baseflow --update-golden
+
+'''
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import cache
+import pipeline
+
+TIMINGS = os.path.join(cache.CACHE_DIR, 'regression', 'timings.json')
+GOLDEN_DIR = os.path.join(cache.CACHE_DIR, 'regression', 'golden')
+
+# stage -> output file -> read_csv arguments and key columns (default: the index)
+GOLDEN = {
+    'sensitivity': {'results.csv': {'read': {'index_col': 0, 'dtype': {'id': str}},
+                                    'keys': ['variable', 'id']},
+                    'winter_q.csv': {'read': {'index_col': 0}}},
+    'baseflow': {'baseflow_index.csv': {'read': {'index_col': [0, 1]}}},
+    'recession': {'recession.csv': {'read': {'dtype': {'id': str}}, 'keys': ['id', 'season']}},
+    'basin_summary': {'Table S2.csv': {'read': {'index_col': 0, 'dtype': {'id': str}},
+                                       'keys': ['id']}},
+}
+
+
+def _basin_summary_offline(stage):
+    '''
+    Table S2 without the raster columns, for when the rasters are missing;
+    without the gauge location too when the registry does not have it.
+    '''
+    import basinsummary
+    output = cache.cache_path('regression', 'new-Table S2.csv')
+    table = basinsummary.table_s2(stage.params['sites'], previous=stage.outputs[0],
+                                  covariates=())
+    gauge = ['Gage Latitude', 'Gage Longitude']
+    if table[gauge].isnull().any().any():
+        table = table.drop(gauge, axis=1)
+    with cache.atomic_write(output) as tmp:
+        table.to_csv(tmp)
+    return {'Table S2.csv': output}
+
+
+# stage -> function writing the outputs that can be checked without the stage's missing inputs
+OFFLINE = {'basin_summary': _basin_summary_offline}
+
+
+def golden_bytes(path):
+    '''
+    Golden content of an output file: the pinned copy if there is one, else
+    the file as committed at HEAD; None if there is neither.
+    '''
+    pinned = os.path.join(GOLDEN_DIR, os.path.basename(path))
+    if os.path.exists(pinned):
+        with open(pinned, 'rb') as fh:
+            return fh.read()
+    path = os.path.realpath(path)
+    try:
+        top = subprocess.check_output(['git', 'rev-parse', '--show-toplevel'],
+                                      cwd=os.path.dirname(path),
+                                      stderr=subprocess.DEVNULL).decode().strip()
+        name = os.path.relpath(path, os.path.realpath(top)).replace(os.sep, '/')
+        return subprocess.check_output(['git', 'show', 'HEAD:' + name], cwd=top,
+                                       stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def update_golden(stages=None):
+    '''
+    Function to pin the current outputs of stages as their golden values,
+    in place of the committed ones.
+
+    Parameters:
+        - stages: stage names (default: every stage of GOLDEN).
+
+    Returns:
+        - pinned: the pinned copies written.
+    '''
+    pipe = pipeline.Pipeline(pipeline.STAGES)
+    pinned = []
+    for name in (sorted(GOLDEN) if stages is None else stages):
+        for out in pipe.stages[name].outputs:
+            if os.path.basename(out) in GOLDEN.get(name, {}) and os.path.exists(out):
+                pinned.append(cache.cache_path(os.path.join('regression', 'golden'),
+                                               os.path.basename(out)))
+                shutil.copyfile(out, pinned[-1])
+    return pinned
+
+
+def _read(path, spec):
+    table = pd.read_csv(path, **spec.get('read', {}))
+    if spec.get('keys'):
+        table = table.set_index(spec['keys'])
+    return table
+
+
+def compare_tables(new, golden, rtol=1e-9, atol=1e-12):
+    '''
+    Function to compare a table with its golden version cell by cell.
+
+    Parameters:
+        - new, golden: DataFrames indexed by their key columns.
+        - rtol, atol: relative and absolute tolerance of numeric cells.
+
+    Returns:
+        - differences: DataFrame with row, column, golden and new value of
+          every cell that differs (empty when the tables agree).
+    '''
+    rows = []
+    for key in golden.index.difference(new.index):
+        rows.append({'row': key, 'column': '(row)', 'golden': 'present', 'new': 'missing'})
+    for key in new.index.difference(golden.index):
+        rows.append({'row': key, 'column': '(row)', 'golden': 'missing', 'new': 'present'})
+    for column in golden.columns.difference(new.columns):
+        rows.append({'row': '(column)', 'column': column, 'golden': 'present', 'new': 'missing'})
+    for column in new.columns.difference(golden.columns):
+        rows.append({'row': '(column)', 'column': column, 'golden': 'missing', 'new': 'present'})
+    index = golden.index.intersection(new.index)
+    for column in golden.columns.intersection(new.columns):
+        g, n = golden.loc[index, column], new.loc[index, column]
+        if g.dtype.kind in 'fiu' and n.dtype.kind in 'fiu':
+            gv, nv = g.values.astype('float64'), n.values.astype('float64')
+            same = np.isclose(nv, gv, rtol=rtol, atol=atol) | (np.isnan(gv) & np.isnan(nv))
+        else:
+            same = (g.astype(str).values == n.astype(str).values) | (g.isnull() & n.isnull()).values
+        for key in index[~same]:
+            rows.append({'row': key, 'column': column, 'golden': g.loc[key], 'new': n.loc[key]})
+    return pd.DataFrame(rows, columns=['row', 'column', 'golden', 'new'])
+
+
+def _load_timings(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+
+def check(stages=None, rtol=1e-9, atol=1e-12, slowdown=0.5, min_seconds=0.5, repeat=1,
+          update_timings=False, timings=TIMINGS, keep_outputs=False):
+    '''
+    Function to rerun stages and check their outputs and wall-clock times.
+
+    Parameters:
+        - stages: stage names (default: every stage of GOLDEN).
+        - rtol, atol: tolerances of numeric cells.
+        - slowdown: allowed slowdown as a fraction of the baseline time.
+        - min_seconds: slowdowns smaller than this are never reported.
+        - repeat: number of runs of every stage; the fastest counts.
+        - update_timings: record the measured times as the new baseline.
+        - timings: baseline file.
+        - keep_outputs: leave the new outputs in place instead of
+          restoring the working-tree files.
+
+    Returns:
+        - report: DataFrame indexed by stage with status ('ok', 'drift',
+          'slower', 'failed' or 'skipped'), seconds, baseline seconds,
+          number of differing cells and a note.
+    '''
+    pipe = pipeline.Pipeline(pipeline.STAGES)
+    stages = sorted(GOLDEN) if stages is None else list(stages)
+    baseline = _load_timings(timings)
+    measured = {}
+    rows = []
+    for name in stages:
+        stage = pipe.stages[name]
+        row = {'stage': name, 'status': 'ok', 'seconds': np.nan,
+               'baseline': baseline.get(name, np.nan), 'differences': 0, 'note': ''}
+        rows.append(row)
+        offline = pipe.digest(name) is None
+        if offline and name not in OFFLINE:
+            row.update(status='skipped', note='inputs not available locally')
+            continue
+        checked = GOLDEN.get(name, {})
+        targets = dict((os.path.basename(out), out) for out in stage.outputs)
+        saved = {}
+        for out in stage.outputs:
+            if os.path.exists(out) and not offline:
+                with open(out, 'rb') as fh:
+                    saved[out] = fh.read()
+        try:
+            notes = []
+            if offline:
+                written = OFFLINE[name](stage)
+                notes.append('inputs not available locally, partial check')
+            else:
+                seconds = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    stage.run()
+                    seconds.append(time.perf_counter() - start)
+                row['seconds'] = measured[name] = min(seconds)
+                written = targets
+            for filename, out in sorted(written.items()):
+                if filename not in checked or not os.path.exists(out):
+                    continue
+                content = golden_bytes(targets[filename])
+                if content is None:
+                    notes.append('%s: no golden version' % filename)
+                    continue
+                snapshot = cache.cache_path('regression', 'golden-' + filename)
+                with open(snapshot, 'wb') as fh:
+                    fh.write(content)
+                new, golden = _read(out, checked[filename]), _read(snapshot, checked[filename])
+                os.remove(snapshot)
+                if offline:
+                    golden = golden[golden.columns.intersection(new.columns)]
+                    os.remove(out)
+                diff = compare_tables(new, golden, rtol, atol)
+                if len(diff):
+                    row['differences'] += len(diff)
+                    first = diff.iloc[0]
+                    notes.append('%s: %d cells differ, e.g. %s / %s: %s -> %s' % (
+                        filename, len(diff), first.row, first.column, first.golden, first.new))
+            if row['differences']:
+                row['status'] = 'drift'
+            elif (not offline and not update_timings and row['baseline'] == row['baseline'] and
+                  row['seconds'] > row['baseline'] * (1 + slowdown) and
+                  row['seconds'] - row['baseline'] > min_seconds):
+                row['status'] = 'slower'
+                notes.append('%.2f s, baseline %.2f s' % (row['seconds'], row['baseline']))
+            row['note'] = '; '.join(notes)
+        except Exception as err:
+            row.update(status='failed', note='%s: %s' % (type(err).__name__, err))
+        finally:
+            if not keep_outputs:
+                for out, content in saved.items():
+                    with cache.atomic_write(out) as tmp:
+                        with open(tmp, 'wb') as fh:
+                            fh.write(content)
+    if update_timings and measured:
+        baseline.update(measured)
+        with cache.atomic_write(timings) as tmp:
+            with open(tmp, 'w') as fh:
+                json.dump(baseline, fh, indent=1, sort_keys=True)
+    return pd.DataFrame(rows, columns=['stage', 'status', 'seconds', 'baseline', 'differences',
+                                       'note']).set_index('stage')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Rerun pipeline stages and check their outputs and times against golden values.')
+    parser.add_argument('stages', nargs='*', help='stages (default: %s)' % ', '.join(sorted(GOLDEN)))
+    parser.add_argument('--rtol', type=float, default=1e-9)
+    parser.add_argument('--atol', type=float, default=1e-12)
+    parser.add_argument('--slowdown', type=float, default=0.5,
+                        help='allowed slowdown as a fraction of the baseline (default 0.5)')
+    parser.add_argument('--min-seconds', type=float, default=0.5,
+                        help='ignore slowdowns below this many seconds')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per stage, fastest counts')
+    parser.add_argument('--update-timings', action='store_true',
+                        help='record the measured times as the new baseline')
+    parser.add_argument('--keep-outputs', action='store_true',
+                        help='leave the new outputs instead of restoring the previous files')
+    parser.add_argument('--update-golden', action='store_true',
+                        help='pin the current outputs as the golden values, then exit')
+    args = parser.parse_args(argv)
+    if args.update_golden:
+        for path in update_golden(args.stages or None):
+            print('pinned %s' % path)
+        return 0
+    report = check(args.stages or None, args.rtol, args.atol, args.slowdown, args.min_seconds,
+                   args.repeat, args.update_timings, keep_outputs=args.keep_outputs)
+    print(report.to_string())
+    return int(not report.status.isin(['ok', 'skipped']).all())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+'''
+Versioned store of the sensitivity results (results.csv, Fig. S6, Fig. S7
+and any other configuration), in one compressed HDF5 file.
+
+Result store functions
+======================
+
+    - record:        Add the results of one run together with its configuration.
+    - runs:          The recorded runs, optionally filtered by configuration.
+    - run_results:   The results of one run (all sites).
+    - site_results:  The results of some sites across all runs.
+    - results_table: One run in the long form of results.csv.
+
+The store (data/results.h5) holds two tables. ``runs`` has one row per run:
+its number, time, label, first and last water year, season windows,
+driver / response pair, PET method, flow completeness threshold, number of
+sites, a digest of the site set and a digest of the configuration and input
+tables. ``results`` has one
+row per run, site and variable with typed columns: run (int), site (str),
+variable (str), rho and p_value (float) and significant (bool).
+
+Run, site and variable are indexed columns, so the results of a site across
+runs, or of a run across sites, are read without reading the rest of the
+file. Recording a configuration whose inputs did not change returns the
+existing run instead of adding a copy. Writers hold a lock on the store, so
+notebooks and pipeline stages may record concurrently.
+
+Examples
+--------
+
+    >>> results, order = sensitivity.sensitivity(seasons, driver='pet_summer')
+    >>> run = record(results, (2002, 2013), driver='pet_summer', pet_method='hargreaves',
+    ...              label='FigS6')
+    >>> runs(driver='pet_summer')
+    >>> site_results('11475560', variable='EVI')
+
+'''
+
+import contextlib
+import fcntl
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+import cache
+import sensitivity
+
+STORE = os.path.join(cache.DATA_DIR, 'results.h5')
+# widths of the string columns (HDF5 tables have fixed width strings)
+_RUN_STRINGS = {'label': 32, 'winter_start': 8, 'winter_end': 8, 'summer_end': 8,
+                'driver': 16, 'response': 16, 'pet_method': 16, 'site_set': 40, 'key': 40}
+_RESULT_STRINGS = {'site': 16, 'variable': 16}
+_COMPRESSION = {'complevel': 9, 'complib': 'zlib'}
+
+
+@contextlib.contextmanager
+def _open(path, mode):
+    '''Open the store holding a shared (read) or exclusive (write) lock.'''
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH if mode == 'r' else fcntl.LOCK_EX)
+        try:
+            with pd.HDFStore(path, mode=mode, **_COMPRESSION) as store:
+                yield store
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _digest(values):
+    return hashlib.sha1('\n'.join(sorted(values)).encode()).hexdigest()
+
+
+def record(results, water_years, driver='p_winter', response='evi_summer', pet_method=None,
+           label='', inputs=(), path=STORE, min_complete=0.0):
+    '''
+    Function to record the results of a sensitivity run.
+
+    Parameters:
+        - results: long-form results from ``sensitivity.sensitivity``.
+        - water_years: first and last water year (inclusive).
+        - driver, response: variable pair of the run.
+        - pet_method: PET estimate of a PET driver (e.g. 'hargreaves').
+        - label: free name of the run, e.g. 'FigS6'.
+        - inputs: table files the run read; their contents are part of the
+          run's key.
+        - path: store file.
+        - min_complete: fraction of valid flow days below which seasons
+          were masked (0: no masking).
+
+    Returns:
+        - run: number of the run (an earlier run if the same configuration
+          and inputs were recorded before).
+    '''
+    sites = [str(s) for s in results.id.unique()]
+    config = {'first_year': int(water_years[0]), 'last_year': int(water_years[1]),
+              'winter_start': sensitivity.WINTER_START, 'winter_end': sensitivity.WINTER_END,
+              'summer_end': sensitivity.SUMMER_END, 'driver': driver, 'response': response,
+              'pet_method': pet_method or '', 'min_complete': float(min_complete),
+              'n_sites': len(sites), 'site_set': _digest(sites)}
+    key = cache.input_hash([p for p in inputs if os.path.exists(p)], **config)
+    if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with _open(path, 'a') as store:
+        if '/runs' in store.keys():
+            found = store.select('runs', where='key == %r' % key, columns=['run'])
+            if len(found):
+                return int(found.run.iloc[0])
+            run = int(store.select_column('runs', 'run').max()) + 1
+        else:
+            run = 1
+        row = dict(config, run=run, key=key, label=label, created=pd.Timestamp.now())
+        store.append('runs', pd.DataFrame([row]), data_columns=True,
+                     min_itemsize=_RUN_STRINGS, index=False)
+        table = pd.DataFrame({'run': np.full(len(results), run, dtype='int32'),
+                              'site': results.id.astype(str).values,
+                              'variable': results.variable.astype(str).values,
+                              'rho': results.value.astype('float64').values,
+                              'p_value': results['p-value'].astype('float64').values,
+                              'significant': (results.Significant.astype(str) == 'True').values})
+        store.append('results', table, data_columns=['run', 'site', 'variable'],
+                     min_itemsize=_RESULT_STRINGS, index=False)
+        store.create_table_index('results', columns=['run', 'site', 'variable'], optlevel=9,
+                                 kind='full')
+    return run
+
+
+def runs(path=STORE, **config):
+    '''
+    Function to list the recorded runs.
+
+    Parameters:
+        - path: store file.
+        - config: column values to match, e.g. driver='pet_summer', last_year=2016.
+
+    Returns:
+        - runs: DataFrame indexed by run number, one row per run.
+    '''
+    where = ['%s == %r' % (k, v) for k, v in sorted(config.items())] or None
+    with _open(path, 'r') as store:
+        table = store.select('runs', where=where)
+    return table.set_index('run')
+
+
+def _select(where, path):
+    with _open(path, 'r') as store:
+        return store.select('results', where=where)
+
+
+def run_results(run, path=STORE, variable=None):
+    '''
+    Function to read the results of one run, in the order they were recorded.
+
+    Parameters:
+        - run: run number.
+        - path: store file.
+        - variable: 'EVI' or 'Storage' (default: both).
+
+    Returns:
+        - results: DataFrame with site, variable, rho, p_value, significant.
+    '''
+    where = ['run == %d' % run] + (['variable == %r' % variable] if variable else [])
+    return _select(where, path).drop('run', axis=1).reset_index(drop=True)
+
+
+def site_results(sites, path=STORE, variable=None):
+    '''
+    Function to read the results of some sites across all runs, with the
+    configuration of each run.
+
+    Parameters:
+        - sites: a site id or a list of site ids.
+        - path: store file.
+        - variable: 'EVI' or 'Storage' (default: both).
+
+    Returns:
+        - results: DataFrame with the run configuration columns, site,
+          variable, rho, p_value and significant.
+    '''
+    sites = [sites] if isinstance(sites, str) else [str(s) for s in sites]
+    where = ['site in %r' % sites] + (['variable == %r' % variable] if variable else [])
+    results = _select(where, path)
+    config = runs(path).drop('key', axis=1)
+    return results.join(config, on='run').reset_index(drop=True)
+
+
+def results_table(run, path=STORE):
+    '''
+    Function to read one run in the layout of results.csv (id, value,
+    p-value, variable, Significant as 'True'/'False').
+
+    Returns:
+        - results: DataFrame as returned by ``sensitivity.sensitivity``.
+    '''
+    table = run_results(run, path)
+    return pd.DataFrame({'id': table.site.values, 'value': table.rho.values,
+                         'p-value': table.p_value.values, 'variable': table.variable.values,
+                         'Significant': np.where(table.significant, 'True', 'False')})
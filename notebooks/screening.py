@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+'''
+Declarative basin screening over all GAGES-II basins of a region.
+
+Screening functions
+===================
+
+    - Screen:          Evaluate a list of criteria as vectorized masks.
+    - STUDY_CRITERIA:  The study-basin selection of basin_selection_and_summary.ipynb.
+    - DERIVED:         Registry of derived per-basin columns.
+
+A criterion is a plain dictionary:
+
+    {'name': 'rain_dominated', 'column': 'SNOW_PCT_PRECIP', 'op': '<', 'value': 20}
+
+with optional keys ``params`` (keyword arguments of a derived column),
+``keep`` (STAIDs that pass regardless, e.g. a dam that is only operated in
+summer; a basin added back after several filters is kept in each of them)
+and ``description``. ``column`` names a GAGES-II column, a derived
+column registered in DERIVED, or a table added with ``Screen.add_source``.
+Exclusion lists are written as ``{'column': 'STAID', 'op': 'notin', 'value': [...]}``.
+
+Every criterion evaluates to a boolean mask over all basins. Masks are cached
+in memory and under data/cache/screening, keyed by a hash of the criterion,
+of the data it reads and of this module (which holds the derived columns and
+the operators), so editing one threshold only re-evaluates that criterion.
+
+Examples
+--------
+
+    >>> screen = Screen(STUDY_CRITERIA)
+    >>> screen.funnel()
+    >>> study_gages = screen.selected()
+
+'''
+
+import hashlib
+import json
+import operator
+import os
+
+import numpy as np
+import pandas as pd
+
+import cache
+import gages2
+
+_MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+_OPS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+        '==': operator.eq, '!=': operator.ne}
+
+FIRES = os.path.join(cache.DATA_DIR, 'site_fires.csv')
+LOGGING = os.path.join(cache.DATA_DIR, 'Cal_USGS_Basins_TabulatedIntersection_'
+                       'THP_Clearcut_or_CommercialThin_Completed.csv')
+# NHD stream gage basins of region 18 (California), reprojected to UTM
+BASINS = os.path.join(cache.DATA_DIR, 'basins', 'basins18_utm.shp')
+# SF Eel at Leggett: its dam is only operated in summer, and the notebook adds
+# the gauge back after the dam, snow, flow record, summer and basin filters
+LEGGETT = 11475800
+
+
+def _summer_precip_pct(store):
+    '''Percent of mean annual precipitation falling May - September.'''
+    ppt = store.query([m + '_PPT7100_CM' for m in _MONTHS])
+    return 100 * ppt.iloc[:, 4:9].sum(axis=1) / ppt.sum(axis=1)
+
+
+def _flow_years(store, first=2003, last=2009):
+    '''Number of complete water years in GAGES-II flow records.'''
+    return store.query(['wy%d' % y for y in range(first, last + 1)]).sum(axis=1)
+
+
+def _developed_pct(store):
+    '''Percent developed land, NLCD classes 22, 23 and 24.'''
+    return store.query(['DEVLOWNLCD06', 'DEVMEDNLCD06', 'DEVHINLCD06']).sum(axis=1)
+
+
+def _burned_fraction(store, since=1990, path=FIRES):
+    '''Summed burned fraction of each basin for fires since ``since``.'''
+    fires = pd.read_csv(path)
+    fires = fires[fires.fire_year >= since]
+    burned = fires.groupby('USGS Basin').fraction_catchment.sum()
+    return burned.reindex(store.staid).fillna(0)
+
+
+def _logged_pct(store, path=LOGGING):
+    '''Summed percent of each basin under completed clearcut/thin harvest plans.'''
+    logged = pd.read_csv(path).groupby('SITE_NO').PERCENTAGE.sum()
+    return logged.reindex(store.staid).fillna(0)
+
+
+def _nhd_basin(store, path=BASINS):
+    '''Whether the basin is one of the NHD gauged basins of ``path``.'''
+    import geopandas as gp
+    sites = gp.read_file(path).SITE_NO.astype('int64')
+    return pd.Series(np.isin(store.staid, sites.values), index=store.staid)
+
+
+# name: (function, source files whose content the column depends on)
+DERIVED = {
+    'summer_precip_pct': (_summer_precip_pct, ()),
+    'flow_years': (_flow_years, ()),
+    'developed_pct': (_developed_pct, ()),
+    'burned_fraction': (_burned_fraction, (FIRES,)),
+    'logged_pct': (_logged_pct, (LOGGING,)),
+    'nhd_basin': (_nhd_basin, (BASINS,)),
+}
+
+STUDY_CRITERIA = [
+    {'name': 'no_dams', 'column': 'NDAMS_2009', 'op': '==', 'value': 0, 'keep': [LEGGETT],
+     'description': 'No dams (SF Eel at Leggett kept: dam only operated in summer)'},
+    {'name': 'rain_dominated', 'column': 'SNOW_PCT_PRECIP', 'op': '<', 'value': 20,
+     'keep': [LEGGETT], 'description': 'Less than 20% of precipitation as snow'},
+    {'name': 'complete_flow', 'column': 'flow_years', 'op': '==', 'value': 7,
+     'params': {'first': 2003, 'last': 2009}, 'keep': [LEGGETT],
+     'description': 'Complete flow records, water years 2003-2009'},
+    {'name': 'summer_dry', 'column': 'summer_precip_pct', 'op': '<', 'value': 10,
+     'keep': [LEGGETT], 'description': 'Less than 10% of precipitation May - September'},
+    {'name': 'nhd_basin', 'column': 'nhd_basin', 'op': '==', 'value': True, 'keep': [LEGGETT],
+     'description': 'Basin polygon in the NHD gauged basins (basins18_utm.shp)'},
+    {'name': 'undeveloped', 'column': 'developed_pct', 'op': '<', 'value': 10,
+     'description': 'Less than 10% developed land'},
+    {'name': 'uncultivated', 'column': 'CROPSNLCD06', 'op': '<', 'value': 5,
+     'description': 'Less than 5% cultivated crops'},
+    {'name': 'unburned', 'column': 'burned_fraction', 'op': '<=', 'value': 0.2,
+     'params': {'since': 1990},
+     'description': 'At most 20% of basin burned since 1990'},
+    {'name': 'unlogged', 'column': 'logged_pct', 'op': '<=', 'value': 20,
+     'description': 'At most 20% of basin clearcut or commercially thinned'},
+    {'name': 'no_diversions', 'column': 'STAID', 'op': 'notin', 'value': [11169500, 11160000],
+     'description': 'Saratoga and Soquel Creeks removed for municipal/irrigation diversions'},
+]
+
+
+class Screen(object):
+    '''
+    Vectorized evaluation of screening criteria over every basin in a
+    GAGES-II store.
+
+    Parameters:
+        - criteria: list of criterion dictionaries, applied in order.
+        - store: gages2.Gages2Store (default: conterminous US).
+        - use_cache: keep evaluated masks on disk between sessions.
+    '''
+
+    def __init__(self, criteria, store=None, use_cache=True):
+        self.criteria = [dict(c) for c in criteria]
+        self.store = store if store is not None else gages2.Gages2Store()
+        self.staid = self.store.staid
+        self.use_cache = use_cache
+        self.sources = {}
+        self._masks = {}
+
+    def add_source(self, name, values, files=()):
+        '''
+        Register an external per-basin column, e.g. a raster summary.
+
+        Parameters:
+            - name: column name used in criteria.
+            - values: Series indexed by STAID; missing basins become NaN.
+            - files: source files the values were derived from (cache key).
+        '''
+        values = pd.Series(values)
+        values.index = values.index.astype('int64')
+        values = values.reindex(self.staid)
+        digest = hashlib.sha1(pd.util.hash_pandas_object(values).values).hexdigest()
+        self.sources[name] = (values, tuple(files), digest)
+
+    def _column(self, name, params):
+        if name == 'STAID':
+            return pd.Series(self.staid, index=self.staid)
+        if name in self.sources:
+            return self.sources[name][0]
+        if name in DERIVED:
+            return DERIVED[name][0](self.store, **params)
+        return self.store.query(name)[name]
+
+    def _key(self, criterion):
+        name = criterion['column']
+        files, digest = (), None
+        if name in self.sources:
+            _, files, digest = self.sources[name]
+        elif name in DERIVED:
+            files = DERIVED[name][1]
+        signature = self.store.meta['signature']
+        # the code deriving and comparing the values is part of the key
+        files = tuple(files) + (os.path.abspath(__file__),)
+        return cache.input_hash(files, criterion=criterion, store=signature, values=digest)
+
+    def mask(self, criterion):
+        '''
+        Function to evaluate one criterion over all basins.
+
+        Returns:
+            - mask: boolean array aligned with ``self.staid``.
+        '''
+        key = self._key(criterion)
+        if key in self._masks:
+            return self._masks[key]
+        path = cache.cache_path('screening', key, '.npy')
+        if self.use_cache and os.path.exists(path):
+            mask = np.unpackbits(np.load(path))[:len(self.staid)].astype(bool)
+        else:
+            mask = self._evaluate(criterion)
+            if self.use_cache:
+                with cache.atomic_write(path) as tmp:
+                    with open(tmp, 'wb') as fh:
+                        np.save(fh, np.packbits(mask))
+        self._masks[key] = mask
+        return mask
+
+    def _evaluate(self, criterion):
+        values = self._column(criterion['column'], criterion.get('params', {}))
+        values = np.asarray(values)
+        op = criterion['op']
+        if op in ('in', 'notin'):
+            mask = np.isin(values, np.asarray(criterion['value'], dtype=values.dtype))
+            if op == 'notin':
+                mask = ~mask
+        elif op in _OPS:
+            mask = _OPS[op](values, criterion['value'])
+        else:
+            raise ValueError('Unknown operator %r in criterion %s' % (op, criterion['name']))
+        mask = np.asarray(mask, dtype=bool)
+        if criterion.get('keep'):
+            mask |= np.isin(self.staid, np.asarray(criterion['keep'], dtype='int64'))
+        return mask
+
+    def set(self, name, **changes):
+        '''
+        Edit a criterion in place, e.g. ``screen.set('rain_dominated', value=30)``.
+        Only the edited criterion is re-evaluated on the next query.
+        '''
+        for criterion in self.criteria:
+            if criterion['name'] == name:
+                criterion.update(changes)
+                return
+        raise KeyError(name)
+
+    def combined(self, upto=None):
+        '''Mask of basins passing all criteria (or the first ``upto``).'''
+        mask = np.ones(len(self.staid), dtype=bool)
+        for criterion in self.criteria[:upto]:
+            mask &= self.mask(criterion)
+        return mask
+
+    def selected(self):
+        '''STAIDs passing every criterion.'''
+        return self.staid[self.combined()]
+
+    def funnel(self):
+        '''
+        Function to report how many basins survive each screening step.
+
+        Returns:
+            - report: DataFrame with, per criterion, the number of basins
+              passing it alone and the number remaining after applying it
+              together with all earlier criteria.
+        '''
+        remaining = np.ones(len(self.staid), dtype=bool)
+        rows = [{'step': 0, 'criterion': 'all basins', 'description': '',
+                 'passing': len(self.staid), 'remaining': len(self.staid)}]
+        for i, criterion in enumerate(self.criteria):
+            mask = self.mask(criterion)
+            remaining &= mask
+            rows.append({'step': i + 1, 'criterion': criterion['name'],
+                         'description': criterion.get('description', ''),
+                         'passing': int(mask.sum()), 'remaining': int(remaining.sum())})
+        return pd.DataFrame(rows, columns=['step', 'criterion', 'description',
+                                           'passing', 'remaining']).set_index('step')
+
+    def to_json(self, path):
+        '''Save the criteria list, so a screening can be rerun from data.'''
+        with open(path, 'w') as fh:
+            json.dump(self.criteria, fh, indent=1)
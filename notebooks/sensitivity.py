@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+'''
+Headless storage and EVI sensitivity analysis of empirical_analysis_evi.ipynb
+and its revisions (Fig. S6: summer PET instead of winter P, Fig. S7: water
+years through 2016), without any plotting library.
+
+Sensitivity functions
+=====================
+
+    - load_tables:      Monthly precip, ET, EVI, discharge (and PET) tables.
+    - water_year:       The winter and summer months of one water year.
+    - seasonal_totals:  Winter P, end-of-winter storage, summer EVI/PET per water year.
+    - spearman_table:   Per-site Spearman rho, p-value and significance.
+    - sensitivity:      The long-form results table (results.csv).
+    - main:             Command-line entry point.
+
+For every water year, winter runs from Oct 1 to Mar 30 and summer from then
+to Sep 30. Storage is S = P - Q - ET accumulated over the winter. Dry Creek
+has no storage estimate and its storage row is fixed (rho -1, p 1), as in
+the notebooks.
+
+Every run is recorded in the results store (resultstore.py) with its
+configuration.
+
+Examples
+--------
+
+    From the notebooks folder, the results of the main analysis
+    (water years 2002-2013) and of Fig. S6:
+
+        $ python sensitivity.py --water-years 2002 2013 --output ../data/results.csv
+        $ python sensitivity.py --driver pet_summer --output results_pet.csv
+
+'''
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import cache
+import instrument
+from tablecache import read_table
+
+DRY_CREEK = '00000000'
+# month-day-, as used to build the season limits in the notebooks
+WINTER_START = '10-1-'
+WINTER_END = '3-30-'
+SUMMER_END = '9-30-'
+SIGNIFICANCE = 0.05
+
+TABLES = {'precip': 'precip_sites.csv', 'et': 'et_sites.csv', 'evi': 'evi_sites.csv',
+          'discharge': 'discharge_df.csv', 'pet': 'pet_prism_hargreaves.csv'}
+# PET estimate of the pet table
+PET_METHOD = 'hargreaves'
+# variables of seasonal_totals that can be correlated, and their result label
+DRIVERS = ('p_winter', 'pet_summer')
+# labels of the response rows; 'Storage' labels the storage vs winter precipitation rows
+RESPONSES = {'evi_summer': 'EVI', 's_end': 'Storage response'}
+
+
+def load_tables(data_dir=cache.DATA_DIR, names=('precip', 'et', 'evi', 'discharge')):
+    '''
+    Function to read the monthly site tables.
+
+    Returns:
+        - tables: dict name -> DataFrame (month x site).
+    '''
+    return dict((n, read_table(os.path.join(data_dir, TABLES[n]))) for n in names)
+
+
+def water_year(tables, wy):
+    '''
+    Function to select the months of one water year.
+
+    Parameters:
+        - tables: dict from ``load_tables`` (``pet`` optional).
+        - wy: water year, e.g. 2002 for Oct 2001 - Sep 2002.
+
+    Returns:
+        - season: dict of DataFrames (month x site): winter ``wyrain``,
+          ``wyq`` and ``winteret``, summer ``summerevi`` (and ``summerpet``).
+    '''
+    sd = pd.to_datetime(WINTER_START + str(wy - 1))
+    ed = pd.to_datetime(WINTER_END + str(wy))
+    esummer = pd.to_datetime(SUMMER_END + str(wy))
+    precip, et, evi = tables['precip'], tables['et'], tables['evi']
+    discharge = tables['discharge']
+    season = {'wyrain': precip[(precip.index >= sd) & (precip.index <= ed)],
+              'wyq': discharge.loc[(discharge.index >= sd) & (discharge.index <= ed)],
+              'winteret': et.loc[(et.index >= sd) & (et.index <= ed)],
+              'summerevi': evi.loc[(evi.index > ed) & (evi.index <= esummer)]}
+    if tables.get('pet') is not None:
+        pet = tables['pet']
+        season['summerpet'] = pet.loc[(pet.index > ed) & (pet.index <= esummer)]
+    return season
+
+
+def seasonal_totals(tables, water_years, sites=None, complete=None):
+    '''
+    Function to compute the seasonal values of every site and water year.
+
+    Parameters:
+        - tables: dict from ``load_tables`` (``pet`` optional).
+        - water_years: iterable of water years (e.g. range(2002, 2014)).
+        - sites: site ids to keep (default: all columns of the precip table).
+        - complete: bool DataFrame (water year x site) of seasons with a
+          complete discharge record (``completeness.CompletenessIndex.season_complete``);
+          storage and winter discharge of other seasons are NaN. Sites it
+          does not cover are kept.
+
+    Returns:
+        - seasons: dict of DataFrames (water year x site): ``p_winter`` winter
+          precipitation, ``s_end`` end-of-winter storage, ``q_winter`` winter
+          discharge, ``evi_summer`` mean summer EVI and, with a PET table,
+          ``pet_summer`` mean summer PET.
+    '''
+    precip, discharge = tables['precip'], tables['discharge']
+    rows = dict((k, []) for k in ('p_winter', 's_end', 'q_winter', 'evi_summer', 'pet_summer'))
+    index = []
+    with instrument.span('sensitivity.seasonal_totals', sites=precip.shape[1]) as sp:
+        for wy in water_years:
+            season = water_year(tables, wy)
+            wyq = season['wyq']
+            s = season['wyrain'].cumsum() - wyq.cumsum() - season['winteret'].cumsum()
+            p = season['wyrain'].cumsum()
+            columns = p.columns
+            rows['p_winter'].append(p.values[-1, :])
+            rows['s_end'].append(s[columns].values[-1, :])
+            rows['evi_summer'].append(season['summerevi'].mean()[columns].values)
+            rows['q_winter'].append((wyq.mean() * len(wyq)).reindex(columns).values)
+            if 'summerpet' in season:
+                rows['pet_summer'].append(season['summerpet'].mean()[columns].values)
+            index.append(wy)
+        sp.count(water_years=len(index))
+    seasons = {}
+    for name, values in rows.items():
+        if values:
+            seasons[name] = pd.DataFrame(np.array(values), index=index, columns=columns)
+    seasons['q_winter'] = seasons['q_winter'][[c for c in discharge.columns if c in columns]]
+    if complete is not None:
+        for name in ('s_end', 'q_winter'):
+            mask = complete.reindex(index=seasons[name].index, columns=seasons[name].columns)
+            seasons[name] = seasons[name].where(mask.fillna(True).astype(bool))
+    if sites is not None:
+        seasons = dict((k, v[[str(s) for s in sites]]) for k, v in seasons.items())
+    return seasons
+
+
+def spearman_table(x, y, variable, fixed=()):
+    '''
+    Function to correlate two (water year x site) tables site by site.
+
+    Parameters:
+        - x, y: DataFrames with the same columns; NaN years are omitted.
+        - variable: label of the result rows.
+        - fixed: sites reported as rho -1, p 1, not significant.
+
+    Returns:
+        - table: DataFrame with id, value (Spearman rho), p-value, variable and
+          Significant ('True'/'False').
+    '''
+    values, pvalues, significant = [], [], []
+    for site in x.columns:
+        if site in fixed:
+            rho, p = -1, 1
+        else:
+            rho, p = stats.spearmanr(x[site].values, y[site].values, nan_policy='omit')
+        values.append(rho)
+        pvalues.append(p)
+        significant.append('True' if p < SIGNIFICANCE else 'False')
+    return pd.DataFrame.from_dict({'id': x.columns, 'value': values, 'p-value': pvalues,
+                                   'variable': variable, 'Significant': significant})
+
+
+def sensitivity(seasons, driver='p_winter', response='evi_summer'):
+    '''
+    Function to build the long-form sensitivity results: response vs driver
+    for every site, followed by storage vs winter precipitation sorted by rho.
+
+    Parameters:
+        - seasons: dict from ``seasonal_totals``.
+        - driver: 'p_winter' (main analysis) or 'pet_summer' (Fig. S6).
+        - response: 'evi_summer' or 's_end'.
+
+    Returns:
+        - results: DataFrame as written to results.csv.
+        - order: site ids sorted by storage sensitivity (plot order).
+    '''
+    if driver not in seasons:
+        raise KeyError('No %s in the seasonal totals (is the PET table loaded?)' % driver)
+    storage = spearman_table(seasons['p_winter'], seasons['s_end'], 'Storage', fixed=(DRY_CREEK,))
+    storage = storage.sort_values(by=['value'])
+    response_table = spearman_table(seasons[driver], seasons[response], RESPONSES[response])
+    results = pd.concat([response_table, storage])
+    results.id = results.id.astype('str')
+    return results, storage.id
+
+
+def run(water_years=(2002, 2013), driver='p_winter', response='evi_summer', sites=None,
+        data_dir=cache.DATA_DIR, output=None, winter_q=None, store=True, label='',
+        min_complete=None):
+    '''
+    Function to run the analysis for a water-year range, record it in the
+    results store and write its tables.
+
+    Parameters:
+        - water_years: first and last water year (inclusive).
+        - driver, response: variable pair (see ``sensitivity``).
+        - sites: site ids to analyse (default: all).
+        - data_dir: folder of the monthly site tables.
+        - output: CSV file for the results table.
+        - winter_q: CSV file for the winter discharge per water year.
+        - store: record the run in the results store (True: data/results.h5,
+          or the path of a store; False: do not record).
+        - label: name of the run in the store.
+        - min_complete: mask seasons whose daily flow record has a month
+          with fewer valid days than this fraction (completeness.py); by
+          default missing days count as zero flow, as in the paper.
+
+    Returns:
+        - results: the results table.
+    '''
+    names = ['precip', 'et', 'evi', 'discharge'] + (['pet'] if driver == 'pet_summer' else [])
+    tables = load_tables(data_dir, names)
+    years = range(water_years[0], water_years[1] + 1)
+    complete = None
+    if min_complete is not None:
+        import completeness
+        complete = completeness.load().season_complete(years, min_complete=min_complete)
+    seasons = seasonal_totals(tables, years, sites, complete)
+    results, _ = sensitivity(seasons, driver, response)
+    if store:
+        import resultstore
+        path = resultstore.STORE if store is True else store
+        resultstore.record(results, water_years, driver, response,
+                           PET_METHOD if 'pet' in names else None, label,
+                           [os.path.join(data_dir, TABLES[n]) for n in names], path,
+                           min_complete or 0.0)
+    if output is not None:
+        results.to_csv(output)
+    if winter_q is not None:
+        seasons['q_winter'].to_csv(winter_q)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Storage and summer EVI sensitivity to winter precipitation (or PET).')
+    parser.add_argument('--water-years', nargs=2, type=int, default=[2002, 2013],
+                        metavar=('FIRST', 'LAST'), help='water year range (default 2002 2013)')
+    parser.add_argument('--driver', choices=DRIVERS, default='p_winter',
+                        help='seasonal variable the response is correlated with')
+    parser.add_argument('--response', choices=sorted(RESPONSES), default='evi_summer')
+    parser.add_argument('--sites', nargs='+', help='site ids (default: all)')
+    parser.add_argument('--data-dir', default=cache.DATA_DIR,
+                        help='folder with the monthly site tables')
+    parser.add_argument('--output', help='results CSV (default: print to stdout)')
+    parser.add_argument('--winter-q', help='CSV for winter discharge per water year')
+    parser.add_argument('--store', default=True,
+                        help='results store to record the run in (default: data/results.h5)')
+    parser.add_argument('--no-store', dest='store', action='store_false',
+                        help='do not record the run')
+    parser.add_argument('--label', default='', help='name of the run in the results store')
+    parser.add_argument('--min-complete', type=float,
+                        help='mask seasons with a flow month below this fraction of valid days')
+    args = parser.parse_args(argv)
+    results = run(args.water_years, args.driver, args.response, args.sites, args.data_dir,
+                  args.output, args.winter_q, args.store, args.label, args.min_complete)
+    if args.output is None:
+        results.to_csv(sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
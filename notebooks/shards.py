@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+'''
+Sharded storage sensitivity analysis of many basins, e.g. every
+rain-dominated GAGES-II basin of the western conterminous US.
+
+Shard functions
+===============
+
+    - select_basins:   STAIDs passing screening criteria (default: WESTERN_CRITERIA).
+    - read_boundaries: GAGES-II basin polygons of a set of STAIDs.
+    - make_shards:     Split basins into spatially compact batches.
+    - run:             Extract, aggregate and correlate every shard; merge the results.
+    - main:            Command-line entry point.
+
+Basins are ordered along a Morton (Z-order) curve of their centroids and cut
+into shards of ``size`` basins, so the basins of a shard are close together
+and every raster is read only over a small window. Each shard runs the whole
+chain in a worker process: monthly precipitation and ET means (zonal),
+monthly EVI (from a monthly table or local MODIS tiles), monthly runoff from
+the local NWIS flow files, water-year aggregation and Spearman sensitivity
+(sensitivity). Only the shard's basins and results are held, so memory does
+not grow with the number of basins, and shards are independent, so
+throughput grows with the number of workers.
+
+Daily flows are fetched from NWIS in the main process, one shard at a time,
+while earlier shards are computed. The result of every shard is written to
+data/cache/shards, keyed by its basins, the water years and the input files,
+so an interrupted run resumes with the shards that are not done.
+
+Basin boundaries are the GAGES-II boundary shapefiles
+(boundaries-shapefiles-by-aggeco), which are not included in the repository.
+
+Examples
+--------
+
+    >>> staids = select_basins()
+    >>> basins = read_boundaries(staids)
+    >>> results, winter_q = run(basins, water_years=(2002, 2013), workers=8)
+
+    From the notebooks folder:
+
+        $ python shards.py --workers 8 --output ../data/results_western.csv
+
+'''
+
+import argparse
+import glob
+import hashlib
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+import cache
+import screening
+
+BOUNDARY_DIR = os.path.join(cache.DATA_DIR, 'boundaries-shapefiles-by-aggeco')
+GAGE_ID = 'GAGE_ID'
+SHARD_SIZE = 200
+
+# rain-dominated, summer-dry and undammed basins of the western regions
+# (HUC02 15 Lower Colorado, 16 Great Basin, 17 Pacific Northwest, 18 California)
+WESTERN_CRITERIA = [
+    {'name': 'no_dams', 'column': 'NDAMS_2009', 'op': '==', 'value': 0,
+     'description': 'No dams'},
+    {'name': 'rain_dominated', 'column': 'SNOW_PCT_PRECIP', 'op': '<', 'value': 20,
+     'description': 'Less than 20% of precipitation as snow'},
+    {'name': 'summer_dry', 'column': 'summer_precip_pct', 'op': '<', 'value': 10,
+     'description': 'Less than 10% of precipitation May - September'},
+    {'name': 'western', 'column': 'HUC02', 'op': 'in', 'value': ['15', '16', '17', '18'],
+     'description': 'Western US regions (HUC02 15 - 18)'},
+]
+
+# monthly raster series: glob pattern, position and format of the date in the file name
+RASTERS = {
+    'precip': (os.path.join(cache.DATA_DIR, 'monthly_ppt', '2*', '*.tif'), (-10, -4), '%Y%m'),
+    'et': (os.path.join(cache.DATA_DIR, 'monthly_ET', '*.tif'), (-11, -4), '%m-%Y'),
+}
+
+
+def select_basins(criteria=WESTERN_CRITERIA):
+    '''
+    Function to screen the GAGES-II basins.
+
+    Returns:
+        - staids: zero-padded 8 character STAIDs passing every criterion.
+    '''
+    return ['%08d' % s for s in screening.Screen(criteria).selected()]
+
+
+def read_boundaries(staids, folder=BOUNDARY_DIR):
+    '''
+    Function to read the GAGES-II boundaries of a set of basins. Basins that
+    appear in more than one shapefile (reference and non-reference) are
+    kept once.
+
+    Parameters:
+        - staids: STAIDs to keep.
+        - folder: directory of the GAGES-II boundary shapefiles.
+
+    Returns:
+        - basins: GeoDataFrame (Albers equal area) indexed by STAID.
+    '''
+    import geopandas as gp
+    staids = set(str(s).zfill(8) for s in staids)
+    parts = []
+    for path in sorted(glob.glob(os.path.join(folder, '*.shp'))):
+        df = gp.read_file(path)
+        df[GAGE_ID] = df[GAGE_ID].astype(str).str.zfill(8)
+        parts.append(df.loc[df[GAGE_ID].isin(staids), [GAGE_ID, 'geometry']])
+    if not parts:
+        raise IOError('No GAGES-II boundary shapefiles in %s' % folder)
+    basins = gp.GeoDataFrame(pd.concat(parts, ignore_index=True), crs=parts[0].crs)
+    basins = basins.drop_duplicates(GAGE_ID).set_index(GAGE_ID, drop=False)
+    return basins.sort_index()
+
+
+def _morton(x, y, bits=16):
+    '''Z-order codes of points, quantized to 2**bits cells per axis.'''
+    def _quantize(v):
+        span = v.max() - v.min()
+        scaled = (v - v.min()) / (span if span > 0 else 1)
+        return np.minimum((scaled * (1 << bits)).astype('uint64'), (1 << bits) - 1)
+    qx, qy = _quantize(np.asarray(x, float)), _quantize(np.asarray(y, float))
+    code = np.zeros(len(qx), dtype='uint64')
+    for b in range(bits):
+        code |= ((qx >> np.uint64(b)) & np.uint64(1)) << np.uint64(2 * b)
+        code |= ((qy >> np.uint64(b)) & np.uint64(1)) << np.uint64(2 * b + 1)
+    return code
+
+
+def make_shards(basins, size=SHARD_SIZE):
+    '''
+    Function to split basins into spatially compact shards.
+
+    Parameters:
+        - basins: GeoDataFrame of basins.
+        - size: number of basins per shard.
+
+    Returns:
+        - shards: list of GeoDataFrames.
+    '''
+    centroids = basins.geometry.centroid
+    order = np.argsort(_morton(centroids.x.values, centroids.y.values), kind='mergesort')
+    return [basins.iloc[order[i:i + size]] for i in range(0, len(basins), size)]
+
+
+def _stamp(paths):
+    '''Digest of the names, sizes and modification times of input files.'''
+    h = hashlib.sha1()
+    for p in sorted(paths):
+        st = os.stat(p)
+        h.update(('%s %d %d\n' % (os.path.basename(p), st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+
+def _shard_key(shard, params):
+    geoms = [hashlib.sha1(g.wkb).hexdigest() for g in shard.geometry]
+    return cache.input_hash(geoms=geoms, ids=list(shard.index), **params)
+
+
+def _water_year_period(water_years):
+    '''Start and end dates of the daily flows needed for the water years.'''
+    return '%d-10-01' % (water_years[0] - 1), '%d-09-30' % water_years[1]
+
+
+def _run_shard(job):
+    '''
+    Worker: monthly tables, seasonal totals and sensitivity of one shard,
+    written to the shard's checkpoint file.
+    '''
+    import composite
+    import discharge
+    import nwis
+    import sensitivity
+    import zonal
+    from tablecache import read_table
+
+    shard, params, path = job
+    ids = list(shard.index)
+    tables = {}
+    for name, (pattern, date_slice, date_format) in RASTERS.items():
+        tables[name] = zonal.monthly_means(pattern, date_slice, date_format, shard, ids,
+                                           method=params['method'], minimum=0, workers=1)
+    if params['evi_table']:
+        evi = read_table(params['evi_table'])
+        tables['evi'] = evi.reindex(columns=ids)
+    else:
+        tables['evi'] = composite.monthly_evi(shard, ids, workers=1)
+    start, end = _water_year_period(params['water_years'])
+    flows = dict((g, nwis.read_flow(g)) for g in ids)
+    tables['discharge'], _ = discharge.discharge_table(shard, flows, start, end, dry_creek=None)
+    years = range(params['water_years'][0], params['water_years'][1] + 1)
+    seasons = sensitivity.seasonal_totals(tables, years)
+    response = sensitivity.spearman_table(seasons['p_winter'], seasons['evi_summer'], 'EVI')
+    storage = sensitivity.spearman_table(seasons['p_winter'], seasons['s_end'], 'Storage')
+    with cache.atomic_write(path) as tmp:
+        pd.to_pickle({'response': response, 'storage': storage,
+                      'q_winter': seasons['q_winter']}, tmp)
+    return path
+
+
+def run(basins, water_years=(2002, 2013), size=SHARD_SIZE, workers=None, method='fraction',
+        evi_table=None, fetch=True):
+    '''
+    Function to run the sensitivity analysis of many basins in shards.
+
+    Parameters:
+        - basins: GeoDataFrame of basins (projected CRS) indexed by STAID.
+        - water_years: first and last water year (inclusive).
+        - size: number of basins per shard.
+        - workers: number of worker processes (default: all cores).
+        - method: zonal weighting method of the precipitation and ET means.
+        - evi_table: monthly EVI CSV (month x STAID) covering the basins;
+          default: composite local MODIS tiles.
+        - fetch: update the daily flow files from NWIS before each shard.
+
+    Returns:
+        - results: long-form results (as results.csv): the EVI rows of all
+          basins followed by the storage rows sorted by rho.
+        - winter_q: DataFrame (water year x basin) of winter runoff [mm].
+    '''
+    import nwis
+    inputs = [f for pattern, _, _ in RASTERS.values() for f in glob.glob(pattern)]
+    if evi_table:
+        inputs.append(evi_table)
+    params = {'water_years': list(water_years), 'method': method, 'evi_table': evi_table,
+              'inputs': _stamp(inputs)}
+    start, end = _water_year_period(water_years)
+    shards = make_shards(basins, size)
+    paths = [cache.cache_path('shards', _shard_key(s, params), '.pkl') for s in shards]
+
+    running = set()
+    limit = (workers or os.cpu_count() or 1) + 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for shard, path in zip(shards, paths):
+            if os.path.exists(path):
+                continue
+            if fetch:
+                nwis.fetch_flows(list(shard.index), start, end)
+            # keep at most one shard waiting per worker
+            while len(running) >= limit:
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    future.result()
+            running.add(pool.submit(_run_shard, (shard, params, path)))
+        for future in wait(running)[0]:
+            future.result()
+
+    parts = [pd.read_pickle(p) for p in paths]
+    storage = pd.concat([p['storage'] for p in parts]).sort_values(by=['value'])
+    results = pd.concat([pd.concat([p['response'] for p in parts]), storage])
+    results.id = results.id.astype('str')
+    winter_q = pd.concat([p['q_winter'] for p in parts], axis=1)
+    return results, winter_q
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Storage and summer EVI sensitivity of many basins, run in shards.')
+    parser.add_argument('--water-years', nargs=2, type=int, default=[2002, 2013],
+                        metavar=('FIRST', 'LAST'), help='water year range (default 2002 2013)')
+    parser.add_argument('--sites', nargs='+',
+                        help='STAIDs (default: GAGES-II basins passing WESTERN_CRITERIA)')
+    parser.add_argument('--boundaries', default=BOUNDARY_DIR,
+                        help='folder of the GAGES-II boundary shapefiles')
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE)
+    parser.add_argument('--workers', type=int, help='worker processes (default: all cores)')
+    parser.add_argument('--method', choices=('fraction', 'centers', 'all_touched'),
+                        default='fraction', help='zonal weighting of precipitation and ET')
+    parser.add_argument('--evi-table', help='monthly EVI CSV (default: local MODIS tiles)')
+    parser.add_argument('--no-fetch', action='store_true',
+                        help='use the local flow files as they are')
+    parser.add_argument('--output', required=True, help='results CSV')
+    parser.add_argument('--winter-q', help='CSV for winter runoff per water year')
+    args = parser.parse_args(argv)
+    staids = args.sites if args.sites else select_basins()
+    basins = read_boundaries(staids, args.boundaries)
+    results, winter_q = run(basins, args.water_years, args.shard_size, args.workers,
+                            args.method, args.evi_table, not args.no_fetch)
+    results.to_csv(args.output)
+    if args.winter_q:
+        winter_q.to_csv(args.winter_q)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+'''
+Binary columnar cache for the date-indexed site tables (et_sites.csv,
+evi_sites.csv, precip_sites.csv, discharge_df.csv, pet_prism_hargreaves.csv,
+tmax_prism.csv, tmin_prism.csv).
+
+Table cache functions
+=====================
+
+    - read_table:  Drop-in for ``pd.read_csv(path, index_col=0, parse_dates=True)``.
+    - write_cache: Convert a CSV table to its binary form.
+    - clear_cache: Remove the cached form of a table.
+
+The first read of a table parses the CSV once and stores the datetime64 index
+and a column-major value matrix as .npy files; later reads memory-map them.
+The cache is invalidated when the size, modification time and content of the
+source CSV no longer match the recorded ones. Entries are keyed by the
+table's absolute path, so tables of the same name in different folders
+(e.g. a ``data_dir`` override) are cached separately.
+
+'''
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import cache
+import instrument
+
+_INDEX = 'index.npy'
+_VALUES = 'values.npy'
+_META = 'meta.json'
+
+
+def _stat(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def _prefix(path):
+    '''Cache name prefix of a table: its file name and a digest of its absolute path.'''
+    where = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12]
+    return os.path.basename(path) + '.' + where + '.'
+
+
+def _cache_dir(path, dtype):
+    return cache.cache_path('tables', _prefix(path) + np.dtype(dtype).name)
+
+
+def _is_current(folder, path):
+    '''
+    Check whether the cache in ``folder`` was built from the current contents
+    of ``path``. A changed stat triggers a content comparison, so touching a
+    file without changing it does not force a rebuild.
+    '''
+    try:
+        with open(os.path.join(folder, _META)) as fh:
+            meta = json.load(fh)
+    except (IOError, ValueError):
+        return False
+    stat = _stat(path)
+    if meta['stat'] == stat:
+        return True
+    if meta['digest'] != cache.file_digest(path):
+        return False
+    meta['stat'] = stat
+    with cache.atomic_write(os.path.join(folder, _META)) as tmp:
+        with open(tmp, 'w') as fh:
+            json.dump(meta, fh)
+    return True
+
+
+def write_cache(path, dtype='float64'):
+    '''
+    Function to parse a date-indexed CSV table and store it in binary
+    columnar form.
+
+    Parameters:
+        - path: CSV file with dates in the first column and one site per column.
+        - dtype: value type of the stored columns, float64 or float32.
+
+    Returns:
+        - folder: directory holding the cached table.
+    '''
+    folder = _cache_dir(path, dtype)
+    digest = cache.file_digest(path)
+    df = pd.read_csv(path, index_col=0, parse_dates=True)
+    index = np.asarray(df.index.values, dtype='datetime64[ns]')
+    values = np.asfortranarray(df.values.astype(dtype))
+    for name, arr in ((_INDEX, index), (_VALUES, values)):
+        with cache.atomic_write(os.path.join(folder, name)) as tmp:
+            with open(tmp, 'wb') as fh:
+                np.save(fh, arr)
+    meta = {'columns': [str(c) for c in df.columns], 'index_name': df.index.name,
+            'digest': digest, 'stat': _stat(path)}
+    # meta is written last: its presence marks a complete cache entry
+    with cache.atomic_write(os.path.join(folder, _META)) as tmp:
+        with open(tmp, 'w') as fh:
+            json.dump(meta, fh)
+    return folder
+
+
+def read_table(path, dtype='float64', mmap=True):
+    '''
+    Function to read a date-indexed site table through the binary cache.
+
+    Parameters:
+        - path: CSV file, e.g. '../data/et_sites.csv'.
+        - dtype: value type of the columns, float64 (default) or float32.
+        - mmap: memory-map the cached values instead of reading them. The
+          map is copy-on-write, so in-place edits never reach the cache.
+
+    Returns:
+        - df: DataFrame with a DatetimeIndex and one float column per site.
+
+    Examples
+    --------
+
+        >>> et = read_table('../data/et_sites.csv')
+    '''
+    with instrument.span('tablecache.read_table', files=1) as sp:
+        folder = _cache_dir(path, dtype)
+        if not _is_current(folder, path):
+            with instrument.span('tablecache.write_cache', files=1):
+                write_cache(path, dtype)
+        with open(os.path.join(folder, _META)) as fh:
+            meta = json.load(fh)
+        mode = 'c' if mmap else None
+        index = np.load(os.path.join(folder, _INDEX))
+        values = np.load(os.path.join(folder, _VALUES), mmap_mode=mode)
+        index = pd.DatetimeIndex(index, name=meta['index_name'])
+        sp.count(months=len(index), sites=len(meta['columns']))
+        return pd.DataFrame(values, index=index, columns=meta['columns'], copy=False)
+
+
+def clear_cache(path=None):
+    '''
+    Remove the cached form of ``path`` (all dtypes), or of every table when
+    ``path`` is None.
+    '''
+    root = os.path.join(cache.CACHE_DIR, 'tables')
+    if not os.path.isdir(root):
+        return
+    for name in os.listdir(root):
+        if path is None or name.startswith(_prefix(path)):
+            shutil.rmtree(os.path.join(root, name))
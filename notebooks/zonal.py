@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+'''
+Zonal statistics of rasters over basin polygons with precomputed sparse
+(zone x pixel) weight matrices.
+
+Zonal functions
+===============
+
+    - ZoneWeights:  Sparse weights of zones on one raster grid.
+    - zonal_means:  Zone means of many rasters on a common grid.
+    - monthly_means: Zone means of a monthly raster series, indexed by month.
+    - dated_files:  Raster files of a series with the dates in their names.
+    - stream_means: Zone means of a long raster series, in worker processes.
+
+The weights of every basin are rasterized once per raster grid and cached
+under data/cache/zonal, keyed by the basin geometries and the grid. A zonal
+mean is then one sparse matrix product over the window of the raster that
+covers all basins, so rasters are read once, only over that window, and
+never clipped per basin.
+
+Weights are the fraction of each pixel covered by the basin (``fraction``),
+or 1 for pixels whose centre falls inside the basin (``centers``) or that
+the basin touches at all (``all_touched``). A point zone gets the pixel it
+falls in.
+
+Examples
+--------
+
+    >>> weights = ZoneWeights.from_raster('../data/monthly_ppt/2000/ppt200001.tif', sites)
+    >>> values, valid = weights.read('../data/monthly_ppt/2000/ppt200001.tif')
+    >>> means = weights.mean(values, valid)
+
+'''
+
+import glob
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.features
+from affine import Affine
+from rasterio.windows import Window
+from scipy import sparse
+from shapely.geometry import box
+
+import cache
+import instrument
+
+METHODS = ('fraction', 'centers', 'all_touched')
+
+
+def _coefficients(transform):
+    '''The six coefficients (a, b, c, d, e, f) of an affine transform.'''
+    return [transform.a, transform.b, transform.c, transform.d, transform.e, transform.f]
+
+
+def _grid_window(bounds, transform, shape):
+    '''
+    Rows and columns (r0, c0, r1, c1) of the pixels overlapping ``bounds``,
+    clipped to the grid. Only north-up grids are supported.
+    '''
+    if transform.b != 0 or transform.d != 0:
+        raise ValueError('Rotated raster grids are not supported')
+    x0, y0, x1, y1 = bounds
+    c0 = int(np.floor((x0 - transform.c) / transform.a))
+    c1 = int(np.ceil((x1 - transform.c) / transform.a))
+    r0 = int(np.floor((y1 - transform.f) / transform.e))
+    r1 = int(np.ceil((y0 - transform.f) / transform.e))
+    return max(r0, 0), max(c0, 0), min(r1, shape[0]), min(c1, shape[1])
+
+
+def _zone_pixels(geom, transform, shape, method):
+    '''
+    Worker: rows, columns and weights of the pixels of one zone.
+    '''
+    r0, c0, r1, c1 = _grid_window(geom.bounds, transform, shape)
+    if r1 <= r0 or c1 <= c0:
+        return np.zeros(0, 'i8'), np.zeros(0, 'i8'), np.zeros(0)
+    a, b, c, d, e, f = _coefficients(transform)
+    wt = Affine(a, b, c + c0 * a, d, e, f + r0 * e)
+    wshape = (r1 - r0, c1 - c0)
+    touched = method != 'centers'
+    inside = rasterio.features.rasterize([(geom, 1)], out_shape=wshape, transform=wt,
+                                         all_touched=touched, dtype='uint8')
+    weights = inside.astype('float64')
+    if method == 'fraction' and geom.area > 0:
+        edge = rasterio.features.rasterize([(geom.boundary, 1)], out_shape=wshape,
+                                           transform=wt, all_touched=True,
+                                           dtype='uint8').astype(bool)
+        edge &= inside.astype(bool)
+        pixel_area = abs(a * e)
+        for i, j in zip(*np.nonzero(edge)):
+            x0, y0 = wt.c + j * a, wt.f + i * e
+            cell = box(min(x0, x0 + a), min(y0, y0 + e), max(x0, x0 + a), max(y0, y0 + e))
+            weights[i, j] = cell.intersection(geom).area / pixel_area
+    rows, cols = np.nonzero(weights > 0)
+    return rows + r0, cols + c0, weights[rows, cols]
+
+
+class ZoneWeights(object):
+    '''
+    Sparse (zone x pixel) weights of zones on one raster grid.
+
+    Parameters:
+        - ids: zone identifiers (row order of the matrix).
+        - matrix: scipy CSR matrix (zone x pixel of the window).
+        - window: (row_off, col_off, height, width) of the raster covering all zones.
+        - transform, shape: raster grid the weights were built for.
+    '''
+
+    def __init__(self, ids, matrix, window, transform, shape):
+        self.ids = list(ids)
+        self.matrix = matrix.tocsr()
+        self.window = tuple(int(w) for w in window)
+        # plain coefficients, so weights pickle cheaply to worker processes
+        self.transform = _coefficients(transform)
+        self.shape = tuple(shape)
+
+    @classmethod
+    def build(cls, geometries, transform, shape, ids, method='fraction'):
+        '''
+        Function to rasterize zone polygons onto a raster grid.
+
+        Parameters:
+            - geometries: zone polygons in the CRS of the grid.
+            - transform: affine transform of the grid.
+            - shape: (rows, columns) of the grid.
+            - ids: zone identifiers.
+            - method: 'fraction', 'centers' or 'all_touched' (see module doc).
+
+        Returns:
+            - weights: ZoneWeights.
+        '''
+        if method not in METHODS:
+            raise ValueError('Unknown method %r, use one of %s' % (method, ', '.join(METHODS)))
+        pixels = [_zone_pixels(g, transform, shape, method) for g in geometries]
+        nonempty = [p for p in pixels if len(p[0])]
+        if nonempty:
+            r0 = min(p[0].min() for p in nonempty)
+            c0 = min(p[1].min() for p in nonempty)
+            r1 = max(p[0].max() for p in nonempty) + 1
+            c1 = max(p[1].max() for p in nonempty) + 1
+        else:
+            r0 = c0 = r1 = c1 = 0
+        width = c1 - c0
+        zone = np.concatenate([np.full(len(p[0]), i, 'i8') for i, p in enumerate(pixels)])
+        pixel = np.concatenate([(p[0] - r0) * width + (p[1] - c0) for p in pixels])
+        weight = np.concatenate([p[2] for p in pixels])
+        matrix = sparse.csr_matrix((weight, (zone, pixel)),
+                                   shape=(len(pixels), (r1 - r0) * width))
+        return cls(ids, matrix, (r0, c0, r1 - r0, width), transform, shape)
+
+    @classmethod
+    def from_raster(cls, path, zones, ids=None, method='fraction', use_cache=True):
+        '''
+        Function to get the weights of ``zones`` on the grid of a raster file,
+        from the cache when the same zones were rasterized on the same grid.
+
+        Parameters:
+            - path: raster file defining the grid.
+            - zones: GeoDataFrame of zone polygons (reprojected if needed).
+            - ids: zone identifiers (default: the index of ``zones``).
+            - method: weighting method (see module doc).
+            - use_cache: keep weights under data/cache/zonal.
+
+        Returns:
+            - weights: ZoneWeights.
+        '''
+        with rasterio.open(path) as src:
+            transform, shape, crs = src.transform, src.shape, src.crs
+        if zones.crs is not None and crs is not None and zones.crs != crs:
+            zones = zones.to_crs(crs)
+        ids = [str(i) for i in (zones.index if ids is None else ids)]
+        geoms = [hashlib.sha1(g.wkb).hexdigest() for g in zones.geometry]
+        key = cache.input_hash(geoms=geoms, ids=ids, transform=_coefficients(transform),
+                               shape=list(shape), method=method)
+        store = cache.cache_path('zonal', key, '.npz')
+        if use_cache and os.path.exists(store):
+            data = np.load(store)
+            matrix = sparse.csr_matrix((data['data'], data['indices'], data['indptr']),
+                                       shape=tuple(data['shape']))
+            return cls(ids, matrix, data['window'], transform, shape)
+        with instrument.span('zonal.weights', zones=len(ids)) as sp:
+            weights = cls.build(zones.geometry.values, transform, shape, ids, method)
+            sp.count(pixels=weights.matrix.shape[1])
+        if use_cache:
+            m = weights.matrix
+            with cache.atomic_write(store) as tmp:
+                with open(tmp, 'wb') as fh:
+                    np.savez(fh, data=m.data, indices=m.indices, indptr=m.indptr,
+                             shape=np.array(m.shape), window=np.array(weights.window))
+        return weights
+
+    def read(self, path, band=1, src=None):
+        '''
+        Function to read the window of a raster covering all zones.
+
+        Parameters:
+            - path: raster file on the grid of the weights.
+            - band: band number.
+            - src: already open rasterio dataset (``path`` is then ignored).
+
+        Returns:
+            - values: flat float64 array of the window pixels.
+            - valid: flat boolean array, False for nodata and non-finite pixels.
+        '''
+        if src is None:
+            with rasterio.open(path) as src:
+                return self.read(path, band, src)
+        if src.shape != self.shape or not np.allclose(_coefficients(src.transform),
+                                                      self.transform):
+            raise ValueError('%s is not on the grid of the zone weights' % src.name)
+        row, col, height, width = self.window
+        values = src.read(band, window=Window(col, row, width, height)).ravel()
+        valid = np.ones(values.shape, dtype=bool)
+        if src.nodata is not None:
+            valid &= values != src.nodata
+        values = values.astype('float64')
+        valid &= np.isfinite(values)
+        return values, valid
+
+    def totals(self, values, valid=None):
+        '''
+        Function to accumulate weighted sums over each zone. Sums and weights
+        of several tiles or blocks can be added before dividing.
+
+        Parameters:
+            - values: window pixels, flat (pixel,) or (pixel x layer).
+            - valid: boolean mask of the same shape; invalid pixels are ignored.
+
+        Returns:
+            - sums: weighted sums per zone (zone,) or (zone x layer).
+            - weights: summed weights of the valid pixels, same shape.
+        '''
+        if valid is None:
+            valid = np.isfinite(values)
+        sums = self.matrix.dot(np.where(valid, values, 0.0))
+        weights = self.matrix.dot(valid.astype('float64'))
+        return sums, weights
+
+    def mean(self, values, valid=None):
+        '''
+        Weighted mean of the valid pixels of each zone; NaN for zones
+        without valid pixels.
+        '''
+        sums, weights = self.totals(values, valid)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(weights > 0, sums / weights, np.nan)
+
+
+def zonal_means(paths, zones, ids=None, method='fraction', band=1, minimum=None,
+                workers=4, use_cache=True):
+    '''
+    Function to compute zone means of many rasters, e.g. a monthly series.
+
+    Parameters:
+        - paths: raster files. Files on the same grid share one weight matrix.
+        - zones: GeoDataFrame of zone polygons.
+        - ids: zone identifiers (default: the index of ``zones``).
+        - method: weighting method (see module doc).
+        - band: band number.
+        - minimum: values below it are ignored, as nodata.
+        - workers: number of threads reading rasters.
+        - use_cache: keep weights under data/cache/zonal.
+
+    Returns:
+        - means: DataFrame (raster x zone) indexed by path.
+    '''
+    paths = list(paths)
+    grids = {}
+
+    def _weights(path):
+        with rasterio.open(path) as src:
+            grid = (tuple(_coefficients(src.transform)), src.shape, str(src.crs))
+        if grid not in grids:
+            grids[grid] = ZoneWeights.from_raster(path, zones, ids, method, use_cache)
+        return grids[grid]
+
+    def _mean(job):
+        w, path = job
+        values, valid = w.read(path, band)
+        if minimum is not None:
+            valid &= values >= minimum
+        return w.mean(values, valid)
+
+    with instrument.span('zonal.zonal_means', files=len(paths), zones=len(zones)) as sp:
+        weights = [_weights(p) for p in paths]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            rows = list(pool.map(_mean, zip(weights, paths)))
+        sp.count(pixels=sum(int(w.window[2]) * int(w.window[3]) for w in weights))
+    columns = weights[0].ids if weights else [str(i) for i in (zones.index if ids is None else ids)]
+    return pd.DataFrame(np.array(rows).reshape(len(paths), len(columns)),
+                        index=paths, columns=columns)
+
+
+def monthly_means(pattern, date_slice, date_format, zones, ids=None, **kwargs):
+    '''
+    Function to compute zone means of a monthly raster series, e.g. the
+    PRISM precipitation or ET grids, dated by their file names.
+
+    Parameters:
+        - pattern: glob pattern of the raster files.
+        - date_slice: (start, stop) of the date in the file name.
+        - date_format: format of that date, e.g. '%Y%m'.
+        - zones, ids: zones, as in ``zonal_means``.
+        - kwargs: further arguments of ``zonal_means``.
+
+    Returns:
+        - means: DataFrame (month x zone), sorted by date.
+    '''
+    dates, files = dated_files(pattern, date_slice, date_format)
+    means = zonal_means(files, zones, ids, **kwargs)
+    means.index = dates
+    return means
+
+
+def dated_files(pattern, date_slice, date_format):
+    '''
+    Function to find the files of a raster series, sorted by the date in
+    their names.
+
+    Parameters:
+        - pattern: glob pattern of the raster files.
+        - date_slice: (start, stop) of the date in the file name.
+        - date_format: format of that date, e.g. '%Y%m'.
+
+    Returns:
+        - dates: DatetimeIndex of the files.
+        - files: file names, in the same order.
+    '''
+    files = glob.glob(pattern)
+    dates = [pd.to_datetime(os.path.basename(f)[slice(*date_slice)], format=date_format)
+             for f in files]
+    order = np.argsort(dates, kind='mergesort')
+    return pd.DatetimeIndex([dates[i] for i in order]), [files[i] for i in order]
+
+
+def _reduce_files(job):
+    '''
+    Worker: zone means of a chunk of rasters, read and reduced one at a time.
+    '''
+    weights, paths, band, minimum = job
+    out = np.full((len(paths), len(weights.ids)), np.nan)
+    with instrument.span('zonal.stream_chunk', files=len(paths), zones=len(weights.ids),
+                         pixels=len(paths) * int(weights.window[2]) * int(weights.window[3])):
+        for k, path in enumerate(paths):
+            values, valid = weights.read(path, band)
+            if minimum is not None:
+                valid &= values >= minimum
+            out[k] = weights.mean(values, valid)
+    return out
+
+
+def stream_means(paths, weights, band=1, minimum=None, workers=None, chunk=64):
+    '''
+    Function to reduce a long series of rasters on one grid (e.g. daily
+    grids) to zone means. Files are decoded in parallel worker processes;
+    every worker holds one raster window at a time, so memory does not grow
+    with the length of the series.
+
+    Parameters:
+        - paths: raster files, all on the grid of ``weights``.
+        - weights: ZoneWeights of the grid.
+        - band: band number.
+        - minimum: values below it are ignored, as nodata.
+        - workers: number of worker processes (default: all cores).
+        - chunk: number of files handled per task.
+
+    Returns:
+        - means: float array (raster x zone).
+    '''
+    paths = list(paths)
+    jobs = [(weights, paths[i:i + chunk], band, minimum) for i in range(0, len(paths), chunk)]
+    if not jobs:
+        return np.zeros((0, len(weights.ids)))
+    with instrument.span('zonal.stream_means', files=len(paths), zones=len(weights.ids)):
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return np.vstack(list(pool.map(_reduce_files, jobs)))